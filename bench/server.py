@@ -0,0 +1,302 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+A local HTTP server for benchmarks. It runs in a separate process, so that
+the CPU time measured in the benchmark process only includes the client.
+All data is synthetic and the same for every run. The server answers
+
+* `/<size>`, for example `/1048576` or `/64M`, with that many bytes,
+* `/gaia/<count>x<size>/` with a Gaia-style directory listing of *count*
+  `.csv.gz` parts of *size* bytes of CSV each and an `MD5SUM.txt`,
+* `/kelt/<count>x<size>.bat` with a KELT-style wget batch file for *count*
+  `.tbl` files of *size* bytes each.
+
+Every response supports `Range` requests. The *latency* before every
+response, the *bandwidth* of every response and the rate of responses
+for files that fail with a 503 error (*error_rate*) or that are cut off in
+the middle of the body (*cut_rate*) are configurable. Whether a request fails only
+depends on its path and on how often the path was requested before, thus
+the same requests fail in every run. `/reset` forgets the requests.
+"""
+
+import gzip
+import hashlib
+import http.server
+import multiprocessing
+import os
+import random
+import re
+import threading
+import time
+import urllib.request
+import zlib
+
+import {parse_size} from '../utils/units'
+
+#: The data is a repetition of a block of this size.
+block_size = 1024 * 1024
+
+
+def csv_part(size, seed=0):
+  """
+  Returns a gzip-compressed CSV table with Gaia-style columns and about
+  *size* bytes of uncompressed data.
+  """
+
+  rng = random.Random(seed)
+  lines = ['solution_id,source_id,ra,dec,parallax,phot_g_mean_mag\n']
+  total = len(lines[0])
+  while total < size:
+    line = '1635721458409799680,{},{:.12f},{:.12f},{:.6f},{:.5f}\n'.format(
+      rng.getrandbits(60), rng.uniform(0, 360), rng.uniform(-90, 90),
+      rng.gauss(1, 2), rng.uniform(3, 21))
+    lines.append(line)
+    total += len(line)
+  return gzip.compress(''.join(lines).encode('ascii'), 6)
+
+
+def tbl_file(size, seed=0):
+  """
+  Returns an IPAC-style table of *size* bytes.
+  """
+
+  rng = random.Random(seed)
+  header = '\\fixlen = T\n|   HJD        |  MAG     |  MAG_ERR |\n'
+  rows = []
+  total = len(header)
+  while total < size:
+    row = ' {:.7f}  {:9.6f}  {:9.6f}\n'.format(rng.uniform(2456000, 2458000),
+      rng.uniform(8, 12), rng.uniform(0, 0.05))
+    rows.append(row)
+    total += len(row)
+  return (header + ''.join(rows)).encode('ascii')[:size]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+  protocol_version = 'HTTP/1.1'
+  block = None
+
+  # The headers and the body are written separately, small responses would
+  # otherwise wait for the delayed ACK of the client.
+  disable_nagle_algorithm = True
+
+  #: Seconds to wait before every response.
+  latency = 0.0
+
+  #: Bytes per second of every response, or #None.
+  bandwidth = None
+
+  #: Fraction of the requests that are answered with a 503 error.
+  error_rate = 0.0
+
+  #: Fraction of the responses that are closed after half of the body.
+  cut_rate = 0.0
+
+  _cache = {}
+  _requests = {}
+  _lock = threading.Lock()
+
+  def log_message(self, *args):
+    pass
+
+  def do_HEAD(self):
+    self.__respond(send_body=False)
+
+  def do_GET(self):
+    self.__respond()
+
+  def __content(self, path):
+    """
+    Returns the body for *path* and its content type, or #None.
+    """
+
+    match = re.match(r'/gaia/(\d+)x(\w+)(?:/(.*))?$', path)
+    if match:
+      count, size, name = int(match.group(1)), parse_size(match.group(2)), match.group(3) or ''
+      names = ['GaiaSource_{:06d}.csv.gz'.format(i) for i in range(count)]
+      if name == '':
+        links = ''.join('<a href="{0}">{0}</a><br>\n'.format(x) for x in ['MD5SUM.txt'] + names)
+        return '<html><body>\n{}</body></html>\n'.format(links).encode(), 'text/html'
+      data = self.__cached(('csv', size), csv_part, size)
+      if name == 'MD5SUM.txt':
+        digest = hashlib.md5(data).hexdigest()
+        return ''.join('{}  {}\n'.format(digest, x) for x in names).encode(), 'text/plain'
+      if name in names:
+        return data, 'application/gzip'
+      return None
+
+    match = re.match(r'/kelt/(\d+)x(\w+)\.bat$', path)
+    if match:
+      count, size = int(match.group(1)), match.group(2)
+      base = 'http://{}:{}/kelt/{}'.format(self.server.server_address[0],
+        self.server.server_address[1], size)
+      lines = ['#!/bin/sh\n'] + ["wget -O 'KELT_N{0:06d}.tbl' '{1}/KELT_N{0:06d}.tbl' -a kelt.log\n"
+        .format(i, base) for i in range(count)]
+      return ''.join(lines).encode(), 'text/plain'
+
+    match = re.match(r'/kelt/(\w+)/KELT_N\d+\.tbl$', path)
+    if match:
+      return self.__cached(('tbl', match.group(1)), tbl_file, parse_size(match.group(1))), 'text/plain'
+
+    return None
+
+  def __cached(self, key, function, *args):
+    with self._lock:
+      if key not in self._cache:
+        self._cache[key] = function(*args)
+      return self._cache[key]
+
+  def __fails(self, path, rate):
+    """
+    Decides whether the request for *path* fails. The decision is the same
+    for the n-th request of a path in every run.
+    """
+
+    if not rate:
+      return False
+    with self._lock:
+      count = self._requests.get((path, rate), 0)
+      self._requests[(path, rate)] = count + 1
+    return zlib.crc32('{}:{}'.format(path, count).encode()) / 2 ** 32 < rate
+
+  def __respond(self, send_body=True):
+    path = self.path.split('?')[0]
+    if path == '/reset':
+      with self._lock:
+        self._requests.clear()
+      self.send_response(204)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    if self.latency:
+      time.sleep(self.latency)
+    try:
+      content = self.__content(path)
+      if content is None:
+        size = parse_size(path.strip('/'))
+    except ValueError:
+      self.send_error(404)
+      return
+    # Errors are only injected into the downloads, not into the listings.
+    inject = send_body and not path.endswith(('/', '.txt', '.bat')) and \
+      not re.match(r'/gaia/\w+$', path)
+    if inject and self.__fails(path, self.error_rate):
+      self.send_error(503)
+      return
+    if content is not None:
+      data, content_type = content
+      size = len(data)
+    else:
+      data, content_type = None, 'application/octet-stream'
+
+    start, end, status = 0, size, 200
+    match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+    if match and int(match.group(1)) < size:
+      start = int(match.group(1))
+      end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+      status = 206
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(end - start))
+    self.send_header('Accept-Ranges', 'bytes')
+    self.send_header('ETag', '"{}"'.format(hashlib.md5(path.encode()).hexdigest()))
+    if status == 206:
+      self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, size))
+    self.end_headers()
+    if not send_body:
+      return
+    if inject and self.__fails('cut:' + path, self.cut_rate):
+      end = start + (end - start) // 2
+      self.close_connection = True
+
+    view = memoryview(data if data is not None else self.block)
+    began = time.perf_counter()
+    offset = start
+    while offset < end:
+      if data is None:
+        index = offset % block_size
+        chunk = view[index:index + min(block_size - index, end - offset)]
+      else:
+        chunk = view[offset:end]
+      if self.bandwidth:
+        chunk = chunk[:64 * 1024]
+      self.wfile.write(chunk)
+      offset += len(chunk)
+      if self.bandwidth:
+        delay = began + (offset - start) / self.bandwidth - time.perf_counter()
+        if delay > 0:
+          time.sleep(delay)
+
+
+def _serve(conn, host, handler, options):
+  handler.block = random.Random(0).randbytes(block_size)
+  for key, value in options.items():
+    setattr(handler, key, value)
+  server = http.server.ThreadingHTTPServer((host, 0), handler)
+  server.daemon_threads = True
+  conn.send(server.server_address[1])
+  server.serve_forever()
+
+
+class BenchServer(object):
+  """
+  Starts the server in a child process when entered and stops it when
+  exited. The *options* set the *latency*, *bandwidth*, *error_rate* and
+  *cut_rate* of the #Handler. Use #url() to get the URL for a number of
+  bytes, #gaia_url() for a directory of CSV parts and #kelt_url() for a
+  batch file.
+  """
+
+  def __init__(self, host='127.0.0.1', handler=Handler, **options):
+    self.host = host
+    self.handler = handler
+    self.options = options
+    self.port = None
+    self._process = None
+
+  def __enter__(self):
+    context = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+    parent, child = context.Pipe()
+    self._process = context.Process(target=_serve,
+      args=(child, self.host, self.handler, self.options), daemon=True)
+    self._process.start()
+    self.port = parent.recv()
+    return self
+
+  def __exit__(self, *args):
+    self._process.terminate()
+    self._process.join()
+
+  def reset(self):
+    """
+    Makes the server inject the same errors as in the previous run.
+    """
+
+    urllib.request.urlopen(self.url('reset')).close()
+
+  def url(self, size):
+    return 'http://{}:{}/{}'.format(self.host, self.port, size)
+
+  def gaia_url(self, count, size):
+    return 'http://{}:{}/gaia/{}x{}/'.format(self.host, self.port, count, size)
+
+  def kelt_url(self, count, size):
+    return 'http://{}:{}/kelt/{}x{}.bat'.format(self.host, self.port, count, size)
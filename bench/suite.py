@@ -0,0 +1,215 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Runs the download tools against the local benchmark server for a number of
+engine and option combinations and reports the throughput, the tail latency
+of the transfers, the CPU time per MiB and the peak memory of every run.
+
+    $ nodepy bench/suite --scenario gaia --count 64 --size 4M
+    $ nodepy bench/suite --scenario kelt --count 5000 --size 8K --latency 0.02
+
+Every configuration runs in a forked child process (thus the suite requires
+a Unix system) so that its CPU time and peak memory can be measured
+separately. The results can be saved with `--json` to compare them between
+two versions of the code.
+"""
+
+import argparse
+import json
+import logging
+import os
+import requests
+import shlex
+import shutil
+import tempfile
+import time
+import traceback
+
+import {main as gaia_main} from '../esa/gaia'
+import {main as exoplanetarchive_main} from '../nasa/exoplanetarchive'
+import {format_size, parse_size} from '../utils/units'
+import {BenchServer} from './server'
+
+#: The default configurations as `(name, arguments)`.
+CONFIGS = [
+  ('thread x1', '--engine thread --parallel 1'),
+  ('thread x8', '--engine thread --parallel 8'),
+  ('thread auto', '--engine thread --parallel auto'),
+  ('async x8', '--engine async --parallel 8'),
+  ('async x64', '--engine async --parallel 64'),
+]
+
+SCENARIOS = ('gaia', 'kelt')
+
+
+def percentile(values, p):
+  """
+  Returns the *p*-th percentile of *values* (nearest rank).
+  """
+
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+
+def run_child(function, argv):
+  """
+  Calls *function* with *argv* in a forked child process and returns the
+  exit status and the resource usage of the child.
+  """
+
+  pid = os.fork()
+  if pid == 0:
+    status = 0
+    try:
+      function(argv)
+    except SystemExit as exc:
+      status = exc.code if isinstance(exc.code, int) else 1
+    except BaseException:
+      traceback.print_exc()
+      status = 1
+    finally:
+      os._exit(status)
+  _, status, usage = os.wait4(pid, 0)
+  return os.waitstatus_to_exitcode(status), usage
+
+
+def run_config(server, scenario, args, extra_args, directory):
+  """
+  Runs the tool of the *scenario* once with the *args* of a configuration
+  and returns a dictionary with the measurements.
+  """
+
+  shutil.rmtree(directory, ignore_errors=True)
+  os.makedirs(directory)
+  server.reset()
+  metrics_file = os.path.join(directory, 'metrics.jsonl')
+  to = os.path.join(directory, 'files')
+  common = ['--to', to, '--metrics', metrics_file] + args + extra_args
+
+  if scenario == 'gaia':
+    path = 'gaia/{}x{}'.format(server.count, server.size)
+    argv = [path, '--server', server.url('')] + common
+    function = gaia_main
+  else:
+    batch_file = os.path.join(directory, 'kelt.bat')
+    with open(batch_file, 'wb') as fp:
+      fp.write(requests.get(server.kelt_url(server.count, server.size)).content)
+    argv = ['bulk-download', batch_file] + common
+    function = lambda argv: exoplanetarchive_main(argv, standalone_mode=False)
+
+  wall = time.perf_counter()
+  status, usage = run_child(function, argv)
+  wall = time.perf_counter() - wall
+
+  with open(metrics_file) as fp:
+    records = [json.loads(line) for line in fp]
+  received = sum(x['bytes'] for x in records)
+  durations = [x['duration'] for x in records if x['status'] == 'complete']
+  cpu = usage.ru_utime + usage.ru_stime
+  mib = received / 1024 ** 2
+  return {
+    'status': status,
+    'files': len(durations),
+    'failed': sum(1 for x in records if x['status'] != 'complete'),
+    'bytes': received,
+    'wall': wall,
+    'throughput': received / wall,
+    'p50': percentile(durations, 50),
+    'p95': percentile(durations, 95),
+    'p99': percentile(durations, 99),
+    'cpu': cpu,
+    'cpu_per_mib': cpu / mib if mib else None,
+    'max_rss': usage.ru_maxrss * 1024,
+  }
+
+
+def format_row(name, result):
+  def ms(value):
+    return '-' if value is None else '{:.0f}'.format(value * 1000)
+  cpu_per_mib = result['cpu_per_mib']
+  return '{:<20} {:>7} {:>6} {:>12} {:>8} {:>8} {:>8} {:>10} {:>10}'.format(
+    name, result['files'], result['failed'], format_size(result['throughput']) + '/s',
+    ms(result['p50']), ms(result['p95']), ms(result['p99']),
+    '-' if cpu_per_mib is None else '{:.3f}'.format(cpu_per_mib),
+    format_size(result['max_rss']))
+
+
+def main(argv=None, prog=None):
+  parser = argparse.ArgumentParser(prog=prog, description=__doc__.split('\n\n')[1].replace('\n', ' '))
+  parser.add_argument('--scenario', choices=SCENARIOS, default='gaia', help='"gaia" downloads a directory of .csv.gz parts with esa/gaia, "kelt" a batch file of small .tbl files with nasa/exoplanetarchive. Default is "gaia".')
+  parser.add_argument('--count', type=int, help='The number of files. Default is 32 for "gaia" and 2000 for "kelt".')
+  parser.add_argument('--size', help='The size of every file (uncompressed for "gaia"). Default is 4M for "gaia" and 8K for "kelt".')
+  parser.add_argument('--latency', type=float, default=0.0, help='Seconds the server waits before every response. Default is 0.')
+  parser.add_argument('--bandwidth', type=parse_size, help='Bytes per second of every response, for example 10M. Default is unlimited.')
+  parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of the downloads that fail with a 503 error. Default is 0.')
+  parser.add_argument('--cut-rate', type=float, default=0.0, help='Fraction of the downloads that are cut off in the middle. Default is 0.')
+  parser.add_argument('--config', action='append', default=[], metavar='NAME=ARGS', help='Run a configuration with the given command-line arguments instead of the default configurations. Can be specified multiple times.')
+  parser.add_argument('--args', default='', help='Additional arguments for every configuration, for example "--no-manifest".')
+  parser.add_argument('--repeat', type=int, default=1, help='Number of runs per configuration, the fastest counts. Default is 1.')
+  parser.add_argument('--json', help='Write the results to this file.')
+  parser.add_argument('--dir', help='The directory to download to. Default is a temporary directory.')
+  args = parser.parse_args(argv)
+
+  if not hasattr(os, 'fork'):
+    parser.error('the benchmark suite requires os.fork()')
+  # Retries of injected errors are expected, only show real errors.
+  logging.basicConfig(level=logging.ERROR, format='[%(levelname)s - %(asctime)s]: %(message)s')
+
+  count = args.count or (32 if args.scenario == 'gaia' else 2000)
+  size = args.size or ('4M' if args.scenario == 'gaia' else '8K')
+  configs = CONFIGS
+  if args.config:
+    configs = [tuple(x.split('=', 1)) if '=' in x else (x, x) for x in args.config]
+
+  options = {'latency': args.latency, 'bandwidth': args.bandwidth,
+    'error_rate': args.error_rate, 'cut_rate': args.cut_rate}
+  print('Scenario "{}": {} files of {}, {}'.format(args.scenario, count, size,
+    ', '.join('{}={}'.format(k, v) for k, v in sorted(options.items()))))
+  print('{:<20} {:>7} {:>6} {:>12} {:>8} {:>8} {:>8} {:>10} {:>10}'.format('config',
+    'files', 'failed', 'throughput', 'p50 ms', 'p95 ms', 'p99 ms', 'CPU s/MiB', 'peak RSS'))
+
+  results = []
+  directory = tempfile.mkdtemp(dir=args.dir)
+  try:
+    with BenchServer(**options) as server:
+      server.count, server.size = count, size
+      for name, config_args in configs:
+        runs = [run_config(server, args.scenario, shlex.split(config_args),
+          shlex.split(args.args), directory) for _ in range(args.repeat)]
+        result = min(runs, key=lambda x: x['wall'])
+        result.update(name=name, args=config_args)
+        results.append(result)
+        print(format_row(name, result))
+        if result['status'] != 0:
+          print('  exited with status {}'.format(result['status']))
+  finally:
+    shutil.rmtree(directory)
+
+  if args.json:
+    with open(args.json, 'w') as fp:
+      json.dump({'scenario': args.scenario, 'count': count, 'size': size,
+        'server': options, 'results': results}, fp, indent=2)
+
+
+if require.main == module:
+  main()
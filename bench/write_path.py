@@ -0,0 +1,95 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Measures the throughput and the CPU time of the download write path for
+different buffer sizes against a local server.
+
+    $ nodepy bench/write_path --size 1G --buffer-sizes 1K,64K,256K,1M
+"""
+
+import argparse
+import logging
+import os
+import requests
+import shutil
+import tempfile
+import time
+
+import {BatchDownloader} from '../utils/batchdownloader'
+import {format_size, parse_size} from '../utils/units'
+import {BenchServer} from './server'
+
+
+def iter_content_download(url, filename):
+  """
+  The write path before the downloaders read into reusable buffers: one
+  #requests.Response.iter_content() chunk of 1 KiB per write.
+  """
+
+  with requests.get(url, stream=True) as response:
+    with open(filename, 'wb') as fp:
+      for chunk in response.iter_content(chunk_size=1024):
+        fp.write(chunk)
+
+
+def downloader_download(url, filename, buffer_size, preallocate):
+  logger = logging.getLogger('bench')
+  logger.setLevel(logging.WARNING)
+  with BatchDownloader(1, logger, buffer_size=buffer_size, preallocate=preallocate) as downloader:
+    downloader.submit(url, filename)
+
+
+def measure(function, *args):
+  wall, cpu = time.perf_counter(), time.process_time()
+  function(*args)
+  return time.perf_counter() - wall, time.process_time() - cpu
+
+
+def main(argv=None, prog=None):
+  parser = argparse.ArgumentParser(prog=prog, description=__doc__.split('\n\n')[0])
+  parser.add_argument('--size', type=parse_size, default='512M', help='The size of the file to download. Default is 512M.')
+  parser.add_argument('--buffer-sizes', default='1K,64K,256K,1M', help='Comma separated buffer sizes to compare. Default is 1K,64K,256K,1M.')
+  parser.add_argument('--repeat', type=int, default=3, help='Number of downloads per configuration, the fastest counts. Default is 3.')
+  parser.add_argument('--dir', help='The directory to download to. Default is a temporary directory.')
+  args = parser.parse_args(argv)
+
+  configs = [('iter_content 1K', iter_content_download, ())]
+  for buffer_size in map(parse_size, args.buffer_sizes.split(',')):
+    for preallocate in (False, True):
+      name = 'readinto {}{}'.format(format_size(buffer_size), ' + prealloc' if preallocate else '')
+      configs.append((name, downloader_download, (buffer_size, preallocate)))
+
+  directory = tempfile.mkdtemp(dir=args.dir)
+  filename = os.path.join(directory, 'data')
+  try:
+    with BenchServer() as server:
+      url = server.url(args.size)
+      print('{:<28} {:>12} {:>10} {:>14}'.format('write path', 'MiB/s', 'CPU s', 'MiB/CPU s'))
+      for name, function, extra in configs:
+        wall, cpu = min(measure(function, url, filename, *extra) for _ in range(args.repeat))
+        os.remove(filename)
+        mib = args.size / 1024 ** 2
+        print('{:<28} {:>12.1f} {:>10.2f} {:>14.1f}'.format(name, mib / wall, cpu, mib / max(cpu, 1e-6)))
+  finally:
+    shutil.rmtree(directory)
+
+
+if require.main == module:
+  main()
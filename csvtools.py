@@ -19,9 +19,84 @@
 # THE SOFTWARE.
 
 import click
+import collections
+import concurrent.futures
 import csv
 import gzip
+import io
+import os
+import queue
 import sys
+import threading
+import zlib
+from functools import partial
+
+import columnar from './utils/columnar'
+import predicate from './utils/predicate'
+import {ChunkError, decode_rows, map_chunks, read_header} from './utils/csvchunks'
+import {parse_size} from './utils/units'
+
+#: The block size in which parts are read.
+COPY_BUFFER_SIZE = 1024 * 1024
+
+#: The number of blocks of a part that a worker reads ahead of the output.
+READ_AHEAD_BLOCKS = 4
+
+
+def read_part(filename, skip_header, compress_level=None):
+  """
+  Yields the content of the CSV part *filename* (decompressed if it ends
+  with `.gz`) in blocks of up to #COPY_BUFFER_SIZE bytes, without the
+  header line if *skip_header* is #True, and always ending with a newline.
+  If *compress_level* is not #None, the blocks form a gzip member
+  compressed with that level.
+  """
+
+  compressor = None
+  if compress_level is not None:
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 31)
+  opener = gzip.open if filename.endswith('.gz') else open
+  last = b'\n'
+  with opener(filename, 'rb') as fp:
+    if skip_header:
+      fp.readline()
+    while True:
+      block = fp.read(COPY_BUFFER_SIZE)
+      if not block:
+        break
+      last = block[-1:]
+      if compressor:
+        block = compressor.compress(block)
+      if block:
+        yield block
+  tail = b'' if last == b'\n' else b'\n'
+  if compressor:
+    tail = compressor.compress(tail) + compressor.flush()
+  if tail:
+    yield tail
+
+
+def read_ahead(blocks, cancelled, filename, skip_header, compress_level=None):
+  """
+  Puts the blocks of #read_part() into the bounded queue *blocks*, followed
+  by #None, unless the *cancelled* event is set.
+  """
+
+  def put(item):
+    while not cancelled.is_set():
+      try:
+        blocks.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  try:
+    for block in read_part(filename, skip_header, compress_level):
+      if not put(block):
+        return
+  finally:
+    put(None)
 
 
 @click.group()
@@ -33,9 +108,24 @@ def main():
 @click.argument('directory')
 @click.argument('suffix')
 @click.option('--has-header/--no-header')
+@click.option('-o', '--output', help='The output file. Defaults to stdout.')
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output with gzip.')
+@click.option('--compress-level', type=click.IntRange(0, 9), default=6,
+  help='The gzip compression level.')
+@click.option('--workers', type=int, default=os.cpu_count() or 1,
+  help='Number of threads that decompress and compress parts ahead of the '
+       'output. Defaults to the number of CPUs.')
 @click.pass_context
-def join(ctx, directory, suffix, has_header):
-  " Join CSV tables into one. "
+def join(ctx, directory, suffix, has_header, output, compress, compress_level, workers):
+  """
+  Join CSV tables into one.
+
+  The files in DIRECTORY that end with SUFFIX are concatenated in the order
+  of their names without decoding them. If --has-header is specified, the
+  first line of every file but the first is skipped. Files that end with
+  `.gz` are decompressed. With --gzip, every file is compressed as a
+  separate gzip member, which together form a valid gzip file.
+  """
 
   files = []
   for name in os.listdir(directory):
@@ -44,29 +134,88 @@ def join(ctx, directory, suffix, has_header):
   files.sort()
   if not files:
     ctx.fail('no input files')
+  if workers < 1:
+    ctx.fail('--workers must be at least 1')
 
-  count = 0
-  for index, name in enumerate(files):
-    filename = os.path.join(directory, name)
-    if name.endswith('.gz'):
-      fp = gzip.open(filename)
-    else:
-      fp = open(filename, 'rb')
-    try:
-      fp = codecs.getreader('utf8')(fp)
-      if has_header and index != 0:
-        fp.readline()
-      for line in fp:
-        print(line)
-    finally:
-      fp.close()
+  out = open(output, 'wb') if output else sys.stdout.buffer
+  level = compress_level if compress else None
+  pending = collections.deque()
+  cancelled = threading.Event()
+  try:
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+      def write_next():
+        filename, skip_header, blocks, future = pending.popleft()
+        if future is None:
+          for block in read_part(filename, skip_header):
+            out.write(block)
+          return
+        while True:
+          block = blocks.get()
+          if block is None:
+            break
+          out.write(block)
+        future.result()
+
+      try:
+        for index, name in enumerate(files):
+          filename = os.path.join(directory, name)
+          skip_header = has_header and index != 0
+          blocks = future = None
+          # Uncompressed parts are copied in blocks unless they need to be
+          # compressed, everything else is streamed from the workers through
+          # a bounded queue of blocks.
+          if name.endswith('.gz') or level is not None:
+            blocks = queue.Queue(READ_AHEAD_BLOCKS)
+            future = executor.submit(read_ahead, blocks, cancelled, filename,
+              skip_header, level)
+          pending.append((filename, skip_header, blocks, future))
+          # Keep a few parts ahead so that the workers are always busy.
+          while len(pending) > workers + 1:
+            write_next()
+        while pending:
+          write_next()
+        out.flush()
+      finally:
+        cancelled.set()
+        for filename, skip_header, blocks, future in pending:
+          if future:
+            future.cancel()
+  except BrokenPipeError:
+    pass
+  finally:
+    if output:
+      out.close()
+
+
+def select_columns(indices, data, chunk):
+  """
+  Returns the *indices* columns of the rows in *data* as CSV bytes.
+  """
+
+  out = io.StringIO()
+  writer = csv.writer(out)
+  for row in decode_rows(data):
+    if not row: continue
+    writer.writerow([row[i] for i in indices])
+  return out.getvalue().encode('utf8')
 
 
 @main.command()
 @click.argument('file')
 @click.argument('columns')
+@click.option('--workers', type=int, default=os.cpu_count() or 1,
+  help='Number of processes. Defaults to the number of CPUs.')
+@click.option('--chunk-size', default='64M',
+  help='The size of the parts of the file that are processed at a time.')
 @click.pass_context
-def column(ctx, file, columns):
+def column(ctx, file, columns, workers, chunk_size):
+  """
+  Extract columns from an uncompressed CSV file.
+
+  COLUMNS is a comma-separated list of column names (then the first row of
+  FILE is the header) or of column indices.
+  """
+
   columns = columns.split(',')
   header = True
   try:
@@ -74,20 +223,217 @@ def column(ctx, file, columns):
     header = False
   except ValueError:
     pass
+  try:
+    chunk_size = parse_size(chunk_size)
+  except ValueError as exc:
+    ctx.fail(str(exc))
+
+  if header:
+    header_names = {c: i for i, c in enumerate(read_header(file)[0])}
+    missing = [n for n in columns if n not in header_names]
+    if missing:
+      ctx.fail('unknown columns: {}'.format(', '.join(missing)))
+    columns = [header_names[n] for n in columns]
+
+  out = sys.stdout.buffer
+  try:
+    for data in map_chunks(file, partial(select_columns, columns), workers, chunk_size,
+        skip_header=header):
+      out.write(data)
+    out.flush()
+  except BrokenPipeError:
+    pass
+  except ChunkError as exc:
+    ctx.fail(str(exc))
+
+
+def _literal_type(values):
+  """
+  Returns the type that a CSV column is converted to for comparisons with
+  the *values* of a predicate.
+  """
+
+  if values and all(isinstance(v, bool) for v in values):
+    return 'bool'
+  if not values or any(isinstance(v, str) for v in values):
+    return 'str'
+  if all(isinstance(v, int) for v in values):
+    return 'int64'
+  return 'float64'
+
+
+def filter_rows(node, fields, output_indices, data, chunk):
+  """
+  Returns the rows in *data* that match the #predicate *node* as CSV bytes.
+  *fields* maps the names of the columns in the predicate to a tuple of
+  their index and the values they are compared with. Only the columns of
+  the predicate are converted (when they are needed), the *output_indices*
+  columns only for the matching rows.
+  """
+
+  rows = [row for row in decode_rows(data) if row]
+  cache = {}
 
-  writer = csv.writer(sys.stdout)
-  with open(file) as fp:
-    reader = csv.reader(fp)
-    if header:
-      header_names = {c: i for i, c in enumerate(next(reader))}
-    for row in reader:
-      if not row: continue
-      if header:
-        new_row = [row[header_names[n]] for n in columns]
+  def get_column(name):
+    if name not in cache:
+      index, values = fields[name]
+      strings = [row[index] for row in rows]
+      type = _literal_type(values)
+      if type == 'str':
+        array = columnar.numpy.array(strings, dtype=str)
+        cache[name] = (array, columnar.numpy.isin(array, columnar.NULL_VALUES))
       else:
-        new_row = [row[i] for i in columns]
-      writer.writerow(new_row)
+        try:
+          cache[name] = columnar.convert_values(name, type, strings)
+        except ValueError:
+          if type != 'int64':
+            raise
+          cache[name] = columnar.convert_values(name, 'float64', strings)
+    return cache[name]
 
+  out = io.StringIO()
+  writer = csv.writer(out)
+  if rows:
+    for index in columnar.numpy.flatnonzero(predicate.evaluate(node, get_column)):
+      row = rows[index]
+      writer.writerow(row if output_indices is None else [row[i] for i in output_indices])
+  return out.getvalue().encode('utf8')
+
+
+def _format_value(value):
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  return value
+
+
+def format_block(block):
+  """
+  Returns the values of a block of #columnar.filter_blocks() as CSV bytes.
+  Null values are written as empty fields.
+  """
+
+  out = io.StringIO()
+  writer = csv.writer(out)
+  columns = []
+  for values, nulls in block:
+    values = [_format_value(v) for v in values]
+    if nulls is not None:
+      values = ['' if null else v for v, null in zip(values, nulls)]
+    columns.append(values)
+  writer.writerows(zip(*columns))
+  return out.getvalue().encode('utf8')
+
+
+@main.command('filter')
+@click.argument('source')
+@click.argument('expression')
+@click.option('-c', '--columns', help='Comma-separated names of the columns to output. '
+  'Defaults to all columns.')
+@click.option('--workers', type=int, default=os.cpu_count() or 1,
+  help='Number of processes for CSV files. Defaults to the number of CPUs.')
+@click.option('--chunk-size', default='64M',
+  help='The size of the parts of a CSV file that are processed at a time.')
+@click.pass_context
+def filter_(ctx, source, expression, columns, workers, chunk_size):
+  """
+  Output the rows that match an expression.
+
+  SOURCE is an uncompressed CSV file with a header or a directory written
+  by the convert command. EXPRESSION compares columns with values, for
+  example `ra between 10 and 20 and phot_g_mean_mag < 15`, and supports
+  `<`, `<=`, `>`, `>=`, `=`, `!=`, `between`, `is null`, `is not null`,
+  `and`, `or`, `not` and parentheses. The matching rows are written to
+  stdout as CSV with a header. Requires numpy.
+
+  For converted directories, blocks of rows that can not match according
+  to the minimum and maximum values of their columns are skipped.
+  """
+
+  try:
+    columnar.require_numpy()
+    node = predicate.parse(expression)
+    chunk_size = parse_size(chunk_size)
+  except (RuntimeError, ValueError) as exc:
+    ctx.fail(str(exc))
+  names = columns.split(',') if columns else None
+
+  out = sys.stdout.buffer
+  try:
+    if os.path.isdir(source):
+      schema = columnar.read_schema(source)
+      names = names or [entry['name'] for entry in schema['columns']]
+      blocks = map(format_block, columnar.filter_blocks(source, node, names, schema))
+    else:
+      header = read_header(source)[0]
+      header_names = {c: i for i, c in enumerate(header)}
+      used = predicate.column_values(node)
+      missing = [n for n in list(names or []) + list(used) if n not in header_names]
+      if missing:
+        ctx.fail('unknown columns: {}'.format(', '.join(sorted(set(missing)))))
+      fields = {n: (header_names[n], values) for n, values in used.items()}
+      indices = [header_names[n] for n in names] if names else None
+      names = names or header
+      function = partial(filter_rows, node, fields, indices)
+      blocks = map_chunks(source, function, workers, chunk_size)
+    out.write(format_block([([name], None) for name in names]))
+    for data in blocks:
+      out.write(data)
+    out.flush()
+  except BrokenPipeError:
+    pass
+  except (ChunkError, ValueError, OSError) as exc:
+    ctx.fail(str(exc))
+
+
+def _parse_types(ctx, param, value):
+  types = {}
+  for item in value:
+    name, sep, type = item.partition('=')
+    if not sep:
+      raise click.BadParameter('expected NAME=TYPE, got {!r}'.format(item))
+    types[name] = type
+  return types
+
+
+@main.command()
+@click.argument('directory')
+@click.argument('suffix')
+@click.argument('output')
+@click.option('--type', 'types', multiple=True, callback=_parse_types, metavar='NAME=TYPE',
+  help='The type of a column (int64, float64, bool, str or another numpy '
+       'dtype). Can be specified multiple times. The types of the other '
+       'columns are inferred.')
+@click.option('--sample-rows', type=click.IntRange(1), default=10000,
+  help='The number of rows of the first file to infer the column types from.')
+@click.option('--workers', type=int, default=os.cpu_count() or 1,
+  help='Number of processes that parse files. Defaults to the number of CPUs.')
+@click.pass_context
+def convert(ctx, directory, suffix, output, types, sample_rows, workers):
+  """
+  Convert CSV tables into memory-mappable columns.
+
+  The files in DIRECTORY that end with SUFFIX (which must all have the same
+  header) are converted in the order of their names. Every column is
+  written to OUTPUT as a `.npy` file that can be loaded with
+  `numpy.load(filename, mmap_mode='r')`, together with a bitmap of the
+  rows that are null and a `schema.json` file. Requires numpy.
+  """
+
+  files = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+    if name.endswith(suffix))
+  if not files:
+    ctx.fail('no input files')
+  if workers < 1:
+    ctx.fail('--workers must be at least 1')
+
+  def progress(filename, rows):
+    click.echo('{}: {} rows'.format(os.path.basename(filename), rows), err=True)
+
+  try:
+    schema = columnar.convert(files, output, types, sample_rows, workers, progress)
+  except (RuntimeError, ValueError) as exc:
+    ctx.fail(str(exc))
+  click.echo('{} rows, {} columns'.format(schema['rows'], len(schema['columns'])), err=True)
 
 
 if require.main == module:
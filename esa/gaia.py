@@ -19,30 +19,170 @@
 # THE SOFTWARE.
 
 from functools import partial
-from itertools import islice
 
 import argparse
-import bs4
+import collections
 import logging
 import gzip
 import os
 import posixpath
 import requests
 import shutil
+import threading
+import time
 import urllib.parse
 
+import {AsyncBatchDownloader} from '../utils/asyncdownloader'
 import {BatchDownloader} from '../utils/batchdownloader'
+import {AdaptiveConcurrency, parse_parallel} from '../utils/concurrency'
+import {DiskBudget, gzip_size} from '../utils/diskbudget'
+import {fetch_links} from '../utils/listing'
+import {PartIndex, overlaps, parse_region, source_id_ranges} from './gaiaindex'
+import {Manifest} from '../utils/manifest'
+import {Metrics} from '../utils/metrics'
+import {STRATEGIES, ShardReport, parse_shard, select} from '../utils/sharding'
+import {SCHEDULES, fetch_sizes, format_plan, largest, measure_throughput, schedule} from '../utils/planner'
+import {ProcessPool} from '../utils/procpool'
+import {RateLimiter, parse_rate, parse_schedule} from '../utils/ratelimit'
+import {RetryPolicy} from '../utils/retry'
+import {format_size, parse_size} from '../utils/units'
 
 logger = logging.getLogger(__name__)
 
+Job = collections.namedtuple('Job', 'url outfile basename stream_unpack unpack_later validators checksum')
+
 
 def scrape_urls(directory):
-  response = requests.get(directory)
+  for href in fetch_links(directory):
+    if '..' not in href:
+      yield urllib.parse.urljoin(directory + '/', href)
+
+
+def fetch_checksums(directory):
+  """
+  Retrieves the `MD5SUM.txt` file of the archive *directory* and returns a
+  dictionary that maps file names to MD5 hex digests. Returns an empty
+  dictionary if the directory has no checksum file.
+  """
+
+  response = requests.get(directory + '/MD5SUM.txt')
+  if response.status_code == 404:
+    return {}
   response.raise_for_status()
-  doc = bs4.BeautifulSoup(response.text, 'lxml')
-  for link in doc.find_all('a'):
-    if '..' not in link['href']:
-      yield urllib.parse.urljoin(directory + '/', link['href'])
+  checksums = {}
+  for line in response.text.splitlines():
+    parts = line.split()
+    if len(parts) == 2:
+      checksums[parts[1].lstrip('*')] = parts[0].lower()
+  return checksums
+
+
+def unpack(filename):
+  """
+  Decompresses the gzip archive *filename* next to it and removes the
+  archive. Returns the compressed and uncompressed size and the time it
+  took. Runs in an unpack worker process.
+  """
+
+  tstart = time.perf_counter()
+  output_file = filename[:-3]
+  with gzip.open(filename) as src:
+    with open(output_file + '.part', 'wb') as dst:
+      shutil.copyfileobj(src, dst, 1024 * 1024)
+  size = os.path.getsize(filename)
+  os.replace(output_file + '.part', output_file)
+  os.remove(filename)
+  return size, os.path.getsize(output_file), time.perf_counter() - tstart
+
+
+class UnpackStats(object):
+  """
+  Collects the throughput of the unpack stage and releases the space
+  reserved for unpacking a file in the *disk_budget*.
+  """
+
+  def __init__(self, disk_budget=None):
+    self.disk_budget = disk_budget
+    self.lock = threading.Lock()
+    self.tstart = time.perf_counter()
+    self.files = 0
+    self.failed = 0
+    self.bytes_in = 0
+    self.bytes_out = 0
+
+  def __call__(self, filename, result, error):
+    if self.disk_budget:
+      self.disk_budget.release(filename[:-3] + '.part')
+    name = os.path.basename(filename)
+    if error:
+      logger.error('Unpacking "%s" failed: %s', name, error)
+      with self.lock:
+        self.failed += 1
+      return
+    bytes_in, bytes_out, duration = result
+    logger.info('Unpacked "%s" (%s in %.1fs, %s/s)', name, format_size(bytes_out),
+      duration, format_size(int(bytes_out / max(duration, 1e-3))))
+    with self.lock:
+      self.files += 1
+      self.bytes_in += bytes_in
+      self.bytes_out += bytes_out
+
+  def log_summary(self):
+    elapsed = time.perf_counter() - self.tstart
+    logger.info('Unpacked %d files (%d failed), %s to %s in %.1fs (%s/s).',
+      self.files, self.failed, format_size(self.bytes_in), format_size(self.bytes_out),
+      elapsed, format_size(int(self.bytes_out / max(elapsed, 1e-3))))
+
+
+def reserve_unpack(disk_budget, filename, size):
+  """
+  Reserves *size* bytes in the *disk_budget* for the gzip archive *filename*
+  and unpacking it. The reservation is released by #UnpackStats.
+  """
+
+  output_file = filename[:-3]
+  disk_budget.reserve(output_file + '.part', size, (filename + '.part', filename, output_file))
+
+
+def queue_unpack(unpacker, disk_budget, filename):
+  """
+  Puts *filename* into the *unpacker* queue after reserving the space for
+  the unpacked file in the *disk_budget*.
+  """
+
+  if disk_budget:
+    reserve_unpack(disk_budget, filename, gzip_size(filename))
+  unpacker.put(filename)
+
+
+def unpack_downloaded(unpacker, disk_budget, filename):
+  """
+  Called when the download of the archive *filename* finished. The space
+  for the archive and unpacking it was reserved before the download (see
+  #reserve_unpack()), thus this never waits for the *disk_budget*: the
+  reservation is corrected to the actual sizes and the archive is queued,
+  or the reservation is dropped if the download failed.
+  """
+
+  key = filename[:-3] + '.part'
+  if not os.path.isfile(filename):
+    if disk_budget:
+      disk_budget.release(key)
+    return
+  if disk_budget:
+    disk_budget.update(key, os.path.getsize(filename) + gzip_size(filename))
+  unpacker.put(filename)
+
+
+def on_disk(outfile, unpack_later):
+  """
+  Returns #True if *outfile* was downloaded, or if it was unpacked already
+  when *unpack_later* is enabled.
+  """
+
+  if unpack_later and os.path.isfile(outfile[:-3]):
+    return True
+  return os.path.isfile(outfile)
 
 
 def get_argument_parser(prog=None):
@@ -50,13 +190,44 @@ def get_argument_parser(prog=None):
     Download table parts from the ESA GAIA Data Archive.
   ''')
   parser.add_argument('path', help='The path to the folder to download from, for example Gaia/gdr2/gaia_source/csv')
+  parser.add_argument('--server', default='http://cdn.gea.esac.esa.int/', help='The archive server or a mirror of it. Default is http://cdn.gea.esac.esa.int/.')
   parser.add_argument('--begin', type=int, help='Slice begin from the download list.')
   parser.add_argument('--end', type=int, help='Slice end from the download list.')
-  parser.add_argument('--parallel', type=int, default=1, help='Enable parallel downloads.')
+  parser.add_argument('--region', type=parse_region, action='append', help='Download only the parts that contain sources in a region of the sky, either a cone "cone:RA,DEC,RADIUS" (in degrees) or nested HEALPix pixels "healpix:ORDER:PIXELS", for example "healpix:5:100,120-127". Can be specified multiple times. The source_id range of every part is determined from its name or its first row, which is cached.')
+  parser.add_argument('--parallel', type=parse_parallel, default=1, help='Enable parallel downloads. Specify "auto" to adjust the number of parallel downloads to the throughput and the responsiveness of the server.')
+  parser.add_argument('--parallel-min', type=int, default=1, help='The minimum number of parallel downloads with --parallel=auto. Default is 1.')
+  parser.add_argument('--parallel-max', type=int, default=16, help='The maximum number of parallel downloads with --parallel=auto. Default is 16.')
+  parser.add_argument('--engine', choices=['thread', 'async'], default='thread', help='The download engine. "async" runs all downloads on a single event loop, which scales better to many concurrent small downloads. Default is "thread".')
+  parser.add_argument('--segments', type=int, default=4, help='Download large files in this many parallel segments if the server supports it. Default is 4.')
+  parser.add_argument('--segment-threshold', type=parse_size, default='64M', help='Minimum file size for segmented downloads. Default is 64M.')
+  parser.add_argument('--buffer-size', type=parse_size, default='256K', help='The number of bytes that are read from a response at a time. Default is 256K.')
+  parser.add_argument('--no-preallocate', action='store_true', help='Do not reserve the disk space for a file before it is downloaded.')
+  parser.add_argument('--fsync', action='store_true', help='Flush every file to the disk before it is renamed to its final name. Slower, but a file that exists after a power failure is complete.')
+  parser.add_argument('--retries', type=int, default=5, help='How often a download that failed with a temporary error is attempted again. Default is 5.')
+  parser.add_argument('--connect-timeout', type=float, default=30.0, help='Seconds to wait for a connection to the server. Default is 30.')
+  parser.add_argument('--read-timeout', type=float, default=60.0, help='Seconds to wait for data from the server before the download is attempted again. Default is 60.')
+  parser.add_argument('--max-rate', type=parse_rate, help='Limit the combined download rate, for example 200M (per second).')
+  parser.add_argument('--rate-schedule', type=parse_schedule, help='Limit the download rate depending on the time of day, for example "08:00-18:00=50M,18:00-08:00=unlimited". --max-rate applies outside of the schedule.')
+  parser.add_argument('--rate-control', help='A file that contains the download rate. It can be created or changed while the download is running and overrides --max-rate and --rate-schedule.')
+  parser.add_argument('--schedule', choices=sorted(SCHEDULES), default='listed', help='The order in which the files are downloaded. All policies except "listed" retrieve the size of every file before the download starts. Default is "listed".')
+  parser.add_argument('--plan', action='store_true', help='Print the number and size of the files that would be downloaded, the required disk space and the estimated duration, then exit.')
+  parser.add_argument('--shard', type=parse_shard, help='Download only the files of shard i of N, for example 2/8, to split the download across multiple machines.')
+  parser.add_argument('--shard-by', choices=STRATEGIES, default='hash', help='How files are assigned to shards: by the hash of their URL or by their size so that all shards are about the same size. Default is "hash".')
+  parser.add_argument('--shard-report', help='The file to which the outcome of every file of the shard is written. Default is shard-i-of-N.json in the destination folder.')
+  parser.add_argument('--metrics', help='Append a JSON line with the time to first byte, duration, size, throughput, retries and status of every download to this file.')
+  parser.add_argument('--metrics-textfile', help='Periodically write aggregate download metrics in the Prometheus text format to this file, for example into the directory of the node_exporter textfile collector.')
+  parser.add_argument('--metrics-interval', type=float, default=15.0, help='Seconds between updates of the --metrics-textfile. Default is 15.')
   parser.add_argument('--print-urls', action='store_true', help='Print the download list.')
   parser.add_argument('--to', help='Destination download folder. Default is the current working directory.')
   parser.add_argument('--unpack', action='store_true', help='Automatically unpack downloaded archives.')
+  parser.add_argument('--unpack-workers', type=int, help='The number of processes that unpack downloaded archives. Defaults to the number of CPUs.')
+  parser.add_argument('--stream-unpack', action='store_true', help='Unpack archives while they are downloaded. The archives are never written to disk, but interrupted downloads can not be resumed.')
+  parser.add_argument('--unpack-ratio', type=float, default=3.0, help='The expected ratio of the unpacked to the compressed size of an archive, used to reserve disk space with --disk-budget before the archive is downloaded or, with --stream-unpack, unpacked while it is downloaded. Default is 3.')
+  parser.add_argument('--disk-budget', type=parse_size, help='Limit the disk space used in the destination folder, for example 500G. Downloads and unpacking wait while the next file would exceed it, for example until finished files are moved elsewhere.')
   parser.add_argument('--overwrite-existing', action='store_true', help='Overwrite existing files.')
+  parser.add_argument('--no-verify', action='store_true', help='Do not verify downloads against the MD5SUM.txt of the archive folder.')
+  parser.add_argument('--revalidate', action='store_true', help='Ask the server whether completed files changed and download them again if they did.')
+  parser.add_argument('--no-manifest', action='store_true', help='Do not record downloads in a manifest in the destination folder. Existing files are considered complete.')
   return parser
 
 
@@ -65,40 +236,188 @@ def main(argv=None, prog=None):
   args = parser.parse_args(argv)
   logging.basicConfig(level=logging.INFO, format='[%(levelname)s - %(asctime)s]: %(message)s')
 
+  directory = args.server.rstrip('/') + '/' + args.path
   logger.info('Retrieving URL list ...')
-  urls = scrape_urls('http://cdn.gea.esac.esa.int/' + args.path)
-  urls = islice(urls, args.begin, args.end)
+  urls = list(scrape_urls(directory))
+  part_ranges = {}
+  if args.region:
+    index = PartIndex(directory)
+    index.update(urls)
+    part_ranges = dict(zip(urls, index.ranges(urls)))
+  urls = urls[args.begin:args.end]
+  if args.region:
+    ranges = source_id_ranges(args.region)
+    count = len(urls)
+    urls = [url for url in urls if part_ranges[url] is None or overlaps(part_ranges[url], ranges)]
+    logger.info('The region is covered by %d of %d files.', len(urls), count)
+
+  sizes = {}
+  report = None
+  if args.shard:
+    if args.shard_by == 'size':
+      logger.info('Retrieving the size of %d files ...', len(urls))
+      sizes = dict(zip(urls, fetch_sizes(urls)))
+    urls = select(urls, args.shard, args.shard_by, [sizes.get(url) for url in urls])
+    logger.info('Shard %d/%d contains %d files.', args.shard.index, args.shard.count, len(urls))
+    report_file = args.shard_report or os.path.join(args.to or '.',
+      'shard-{}-of-{}.json'.format(*args.shard))
+    report = ShardReport(report_file, args.shard, args.shard_by)
 
   if args.print_urls:
     for url in urls:
       print(url)
     return
 
+  checksums = {}
+  if not args.no_verify:
+    logger.info('Retrieving checksums ...')
+    checksums = fetch_checksums(directory)
+    if not checksums:
+      logger.warning('No MD5SUM.txt found, downloads will not be verified.')
+
   if args.to and not os.path.isdir(args.to):
     logger.info('Creating directory "{}"'.format(args.to))
     os.makedirs(args.to)
 
+  manifest = None if args.no_manifest else Manifest(args.to or '.')
+
+  # Files that were downloaded but not yet unpacked.
+  unpack_now = []
+  jobs = []
+  for url in urls:
+    basename = posixpath.basename(urllib.parse.urlparse(url).path)
+    outfile = os.path.join(args.to, basename) if args.to else basename
+    stream_unpack = args.stream_unpack and outfile.endswith('.gz')
+    if stream_unpack:
+      outfile = outfile[:-3]
+    unpack_later = args.unpack and outfile.endswith('.gz')
+
+    validators = None
+    if not args.overwrite_existing:
+      if manifest:
+        entry = manifest.get(outfile)
+        if entry is None and on_disk(outfile, unpack_later):
+          # Downloaded before the manifest was used.
+          manifest.update(outfile, url, 'complete')
+          entry = manifest.get(outfile)
+        complete = entry is not None and entry['state'] == 'complete'
+      else:
+        entry = None
+        complete = on_disk(outfile, unpack_later)
+      if complete and unpack_later and os.path.isfile(outfile):
+        unpack_now.append(outfile)
+        if report:
+          report.add(url, outfile, 'skipped')
+        continue
+      if complete and args.revalidate and entry and (entry['etag'] or entry['last_modified']):
+        validators = entry
+      elif complete:
+        logger.info('Skipping "%s"', basename)
+        if report:
+          report.add(url, outfile, 'skipped')
+        continue
+
+    jobs.append(Job(url, outfile, basename, stream_unpack, unpack_later, validators,
+      checksums.get(basename)))
+
+  concurrency = None
+  num_workers = args.parallel
+  if args.parallel == 'auto':
+    concurrency = AdaptiveConcurrency(args.parallel_min, args.parallel_max, logger=logger)
+    num_workers = args.parallel_max
+
+  if args.plan or args.schedule != 'listed' or args.disk_budget:
+    missing = [job.url for job in jobs if job.url not in sizes]
+    if missing:
+      logger.info('Retrieving the size of %d files ...', len(missing))
+      sizes.update(zip(missing, fetch_sizes(missing)))
+    job_sizes = [sizes[job.url] for job in jobs]
+    if args.plan:
+      throughput = None
+      if jobs:
+        logger.info('Measuring the throughput ...')
+        throughput = measure_throughput(largest(jobs, job_sizes).url)
+      for line in format_plan(job_sizes, args.to or '.', throughput, num_workers, args.max_rate):
+        print(line)
+      if args.unpack or args.stream_unpack:
+        print('Unpacking the files requires additional disk space.')
+      if manifest:
+        manifest.close()
+      return
+    jobs = schedule(jobs, job_sizes, args.schedule)
+
+  rate_limiter = None
+  if args.max_rate or args.rate_schedule or args.rate_control:
+    rate_limiter = RateLimiter(args.max_rate, args.rate_schedule, args.rate_control, logger=logger)
+
+  disk_budget = None
+  if args.disk_budget:
+    disk_budget = DiskBudget(args.disk_budget, args.to or '.', logger=logger)
+
+  # Create the unpack workers before the download threads are started.
+  unpacker = None
+  if args.unpack:
+    unpack_stats = UnpackStats(disk_budget)
+    # The queue holds every archive so that the download workers never wait
+    # for the unpack workers.
+    unpacker = ProcessPool(unpack, args.unpack_workers, queue_size=len(jobs) + len(unpack_now),
+      callback=unpack_stats)
+
+  metrics = None
+  if args.metrics or args.metrics_textfile:
+    metrics = Metrics(args.metrics, args.metrics_textfile, args.metrics_interval)
+
+  futures = []
   try:
-    with BatchDownloader(args.parallel, logger) as downloader:
-      def download_finished(output_file):
-        if output_file.endswith('.gz') and args.unpack:
-          logger.info('Unpacking "%s" ...', os.path.basename(output_file))
-          with gzip.open(output_file) as src:
-            with open(output_file[:-3], 'wb') as dst:
-              shutil.copyfileobj(src, dst)
-          os.remove(output_file)
-
-      for url in urls:
-        basename = posixpath.basename(urllib.parse.urlparse(url).path)
-        outfile = os.path.join(args.to, basename) if args.to else basename
-        if os.path.isfile(outfile) and not args.overwrite_existing:
-          logger.info('Skipping "%s"', basename)
-          continue
-
-        downloader.submit(url, outfile,
-          done_callback=partial(download_finished, outfile))
+    for outfile in unpack_now:
+      queue_unpack(unpacker, disk_budget, outfile)
+    engine = AsyncBatchDownloader if args.engine == 'async' else BatchDownloader
+    with engine(num_workers, logger, segments=args.segments,
+        segment_threshold=args.segment_threshold,
+        checksum='md5' if manifest or checksums else None, manifest=manifest,
+        retry=RetryPolicy(args.retries), concurrency=concurrency,
+        rate_limiter=rate_limiter, buffer_size=args.buffer_size,
+        preallocate=not args.no_preallocate, fsync=args.fsync,
+        disk_budget=disk_budget, metrics=metrics, unpack_ratio=args.unpack_ratio,
+        connect_timeout=args.connect_timeout, read_timeout=args.read_timeout) as downloader:
+      for job in jobs:
+        size = sizes.get(job.url)
+        if job.unpack_later and disk_budget:
+          # Reserve the space for the archive and unpacking it before the
+          # download is admitted, otherwise finished archives could fill the
+          # budget so that none of them can be unpacked anymore.
+          reserve_unpack(disk_budget, job.outfile, int((size or 0) * (1 + args.unpack_ratio)))
+        if job.stream_unpack:
+          future = downloader.submit(job.url, job.outfile, desc=job.basename, unpack=True,
+            validators=job.validators, checksum=job.checksum, size=size)
+        elif job.unpack_later:
+          future = downloader.submit(job.url, job.outfile, validators=job.validators,
+            checksum=job.checksum, size=size, reserve=False,
+            done_callback=partial(unpack_downloaded, unpacker, disk_budget, job.outfile))
+        else:
+          future = downloader.submit(job.url, job.outfile, validators=job.validators,
+            checksum=job.checksum, size=size)
+        futures.append((job, future))
   except KeyboardInterrupt:
+    if unpacker:
+      unpacker.terminate()
+      unpacker = None
     logger.info('Aborted.')
+  finally:
+    if unpacker:
+      unpacker.close()
+      unpack_stats.log_summary()
+    if manifest:
+      manifest.close()
+    if metrics:
+      metrics.close()
+    if report:
+      for job, future in futures:
+        report.add_download(job.url, job.outfile, future)
+      for job in jobs[len(futures):]:
+        report.add(job.url, job.outfile, 'aborted')
+      report.write()
+      logger.info('Wrote shard report to "%s"', report.filename)
 
 if require.main == module:
   main()
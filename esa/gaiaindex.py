@@ -0,0 +1,278 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Maps sky regions to the Gaia source table parts that contain them. The
+Gaia `source_id` divided by 2^35 is the nested HEALPix pixel of the source
+at order 12, and the parts of the source table are ordered by `source_id`.
+Thus every part covers a range of pixels, which is determined from its
+file name (Gaia DR2 and later name the parts after their first and last
+`source_id` or HEALPix pixel) or from the first row of every part.
+"""
+
+import bisect
+import collections
+import concurrent.futures
+import csv
+import hashlib
+import json
+import logging
+import math
+import os
+import posixpath
+import re
+import requests
+import threading
+import urllib.parse
+import zlib
+
+import healpix from '../utils/healpix'
+import {get_cache_dir} from '../utils/listing'
+
+logger = logging.getLogger(__name__)
+
+#: The HEALPix order that is encoded in the `source_id`.
+SOURCE_ID_ORDER = 12
+
+#: The bits of the `source_id` below the HEALPix pixel.
+SOURCE_ID_SHIFT = 35
+
+#: The end of the `source_id` range.
+MAX_SOURCE_ID = healpix.npix(SOURCE_ID_ORDER) << SOURCE_ID_SHIFT
+
+#: The number of bytes that are read from the start of a part to find its
+#: first `source_id`.
+HEAD_SIZE = 64 * 1024
+
+#: A cone around *ra* and *dec* with *radius* (in degrees).
+Cone = collections.namedtuple('Cone', 'ra dec radius')
+
+#: A list of nested HEALPix pixels at *order*.
+Pixels = collections.namedtuple('Pixels', 'order pixels')
+
+# Gaia DR2 parts are named after their first and last source_id, DR3 parts
+# after the first and last HEALPix pixel at order 8.
+_source_id_name = re.compile(r'_(\d{7,})_(\d{7,})\.csv')
+_healpix_name = re.compile(r'_(\d{6})-(\d{6})\.csv')
+_healpix_name_order = 8
+
+
+def parse_region(value):
+  """
+  Parses a region `cone:RA,DEC,RADIUS` (in degrees) or `healpix:ORDER:PIXELS`
+  where *PIXELS* is a comma-separated list of nested pixels or inclusive
+  ranges of pixels, for example `healpix:5:100,120-127`.
+  """
+
+  kind, sep, spec = value.partition(':')
+  try:
+    if kind == 'cone':
+      ra, dec, radius = (float(x) for x in spec.split(','))
+      if not -90 <= dec <= 90 or radius <= 0:
+        raise ValueError
+      return Cone(ra % 360, dec, min(radius, 180.0))
+    if kind == 'healpix':
+      order, sep, spec = spec.partition(':')
+      order = int(order)
+      if not 0 <= order <= SOURCE_ID_ORDER:
+        raise ValueError
+      pixels = []
+      for item in spec.split(','):
+        start, sep, end = item.partition('-')
+        pixels.extend(range(int(start), int(end or start) + 1))
+      if not pixels or not all(0 <= p < healpix.npix(order) for p in pixels):
+        raise ValueError
+      return Pixels(order, pixels)
+  except ValueError:
+    pass
+  raise ValueError('invalid region: {!r} (expected cone:RA,DEC,RADIUS or '
+    'healpix:ORDER:PIXELS with ORDER up to {})'.format(value, SOURCE_ID_ORDER))
+
+
+def cone_order(radius):
+  """
+  Returns the HEALPix order for a disc query with *radius* (in degrees):
+  the lowest order at which the pixels are smaller than half the radius,
+  but at most #SOURCE_ID_ORDER.
+  """
+
+  order = 0
+  radius = math.radians(radius)
+  while order < SOURCE_ID_ORDER and healpix.max_pixrad(order) > radius / 2:
+    order += 1
+  return order
+
+
+def source_id_ranges(regions):
+  """
+  Returns the sorted list of half-open `source_id` ranges that cover the
+  *regions* (#Cone or #Pixels).
+  """
+
+  ranges = []
+  for region in regions:
+    if isinstance(region, Cone):
+      order = cone_order(region.radius)
+      pixels = healpix.query_disc(order, region.ra, region.dec, region.radius)
+    else:
+      order, pixels = region
+    ranges.extend(healpix.pixel_ranges(order, pixels, SOURCE_ID_ORDER))
+  merged = []
+  for start, end in sorted(ranges):
+    if merged and merged[-1][1] >= start:
+      merged[-1][1] = max(merged[-1][1], end)
+    else:
+      merged.append([start, end])
+  return [(start << SOURCE_ID_SHIFT, end << SOURCE_ID_SHIFT) for start, end in merged]
+
+
+def name_range(basename):
+  """
+  Returns the half-open `source_id` range of a part from its *basename*, or
+  #None if the name does not tell.
+  """
+
+  match = _source_id_name.search(basename)
+  if match:
+    return int(match.group(1)), int(match.group(2)) + 1
+  match = _healpix_name.search(basename)
+  if match:
+    shift = 2 * (SOURCE_ID_ORDER - _healpix_name_order) + SOURCE_ID_SHIFT
+    return int(match.group(1)) << shift, (int(match.group(2)) + 1) << shift
+  return None
+
+
+def is_part(basename):
+  return basename.endswith(('.csv', '.csv.gz'))
+
+
+def fetch_first_source_id(url, session=None, timeout=30):
+  """
+  Reads the first #HEAD_SIZE bytes of the part at *url* and returns the
+  `source_id` of its first row, or #None if it has no such column.
+  """
+
+  session = session or requests
+  headers = {'Range': 'bytes=0-{}'.format(HEAD_SIZE - 1)}
+  with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+    response.raise_for_status()
+    data = response.raw.read(HEAD_SIZE, decode_content=True)
+  if urllib.parse.urlparse(url).path.endswith('.gz'):
+    data = zlib.decompressobj(31).decompress(data)
+  lines = data.decode('utf8', 'replace').split('\n')
+  if len(lines) < 3:
+    return None
+  header, row = csv.reader(lines[:2])
+  if 'source_id' not in header:
+    return None
+  return int(row[header.index('source_id')])
+
+
+class PartIndex(object):
+  """
+  The `source_id` ranges of the parts in the archive *directory*. The first
+  `source_id` of parts whose names do not tell their range is read from the
+  server once and cached in *cache_dir* (defaults to `gaia-index` in
+  #get_cache_dir()).
+  """
+
+  def __init__(self, directory, cache_dir=None):
+    if cache_dir is None:
+      cache_dir = os.path.join(get_cache_dir(), 'gaia-index')
+    self.directory = directory
+    self.filename = os.path.join(cache_dir,
+      hashlib.sha1(directory.encode('utf8')).hexdigest() + '.json')
+    self.first = {}
+    try:
+      with open(self.filename) as fp:
+        self.first = json.load(fp)['first']
+    except (OSError, ValueError, KeyError):
+      pass
+
+  def save(self):
+    os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+    with open(self.filename + '.tmp', 'w') as fp:
+      json.dump({'directory': self.directory, 'first': self.first}, fp)
+    os.replace(self.filename + '.tmp', self.filename)
+
+  def update(self, urls, num_workers=16, timeout=30):
+    """
+    Reads the first `source_id` of the parts in *urls* that are not in the
+    index yet and saves the index. Parts that fail are tried again the next
+    time.
+    """
+
+    missing = []
+    for url in urls:
+      name = posixpath.basename(urllib.parse.urlparse(url).path)
+      if is_part(name) and name not in self.first and name_range(name) is None:
+        missing.append((name, url))
+    if not missing:
+      return
+    logger.info('Reading the first source_id of %d parts ...', len(missing))
+    local = threading.local()
+
+    def fetch(url):
+      session = getattr(local, 'session', None)
+      if session is None:
+        session = local.session = requests.Session()
+      try:
+        return fetch_first_source_id(url, session, timeout)
+      except (requests.RequestException, OSError, ValueError, zlib.error) as exc:
+        logger.warning('Could not read the first source_id of "%s": %s', url, exc)
+        return None
+
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+      for (name, url), first in zip(missing, executor.map(fetch, [u for n, u in missing])):
+        if first is not None:
+          self.first[name] = first
+    self.save()
+
+  def ranges(self, urls):
+    """
+    Returns the half-open `source_id` range of every URL in *urls*, which
+    must be in the order of the listing, or #None if it is unknown. A part
+    ends where the next part with a known first `source_id` begins.
+    """
+
+    names = [posixpath.basename(urllib.parse.urlparse(url).path) for url in urls]
+    result = [None] * len(names)
+    end = MAX_SOURCE_ID
+    for index in reversed(range(len(names))):
+      name = names[index]
+      result[index] = name_range(name)
+      first = self.first.get(name) if is_part(name) else None
+      if result[index] is None and first is not None:
+        result[index] = (first, max(end, first + 1))
+      if result[index] is not None:
+        end = result[index][0]
+    return result
+
+
+def overlaps(part_range, ranges):
+  """
+  Returns #True if the half-open *part_range* overlaps any of the sorted,
+  disjoint *ranges*.
+  """
+
+  start, end = part_range
+  index = bisect.bisect_right(ranges, (start, MAX_SOURCE_ID + 1))
+  if index > 0 and ranges[index - 1][1] > start:
+    return True
+  return index < len(ranges) and ranges[index][0] < end
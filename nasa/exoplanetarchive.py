@@ -18,8 +18,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+from functools import partial
 from urllib.parse import urlparse
-import argparse
 import click
 import collections
 import csv
@@ -27,24 +27,102 @@ import logging
 import os
 import posixpath
 import re
-import requests
 import shlex
 import sys
+import {AsyncBatchDownloader} from '../utils/asyncdownloader'
 import {BatchDownloader} from '../utils/batchdownloader'
-
-wget_parser = argparse.ArgumentParser()
-wget_parser.add_argument('-O')
-wget_parser.add_argument('-a')
-wget_parser.add_argument('url')
+import {AdaptiveConcurrency, parse_parallel} from '../utils/concurrency'
+import {DiskBudget} from '../utils/diskbudget'
+import {Manifest} from '../utils/manifest'
+import {Metrics} from '../utils/metrics'
+import {PackWriter} from '../utils/packfile'
+import {SCHEDULES, fetch_sizes, format_plan, largest, measure_throughput, schedule} from '../utils/planner'
+import {RateLimiter, parse_rate, parse_schedule} from '../utils/ratelimit'
+import {RetryPolicy} from '../utils/retry'
+import {STRATEGIES, ShardReport, parse_shard, select} from '../utils/sharding'
+import {parse_size} from '../utils/units'
 
 WgetCommand = collections.namedtuple('WgetCommand', 'url ofile logfile')
+Job = collections.namedtuple('Job', 'url ofile validators')
 logger = logging.getLogger(__name__)
 
+#: Matches the commands in the batch files of the NASA Exoplanet Archive.
+_wget_regex = re.compile(r"wget -O '([^']*)' '([^']*)'(?: -a (?:'([^']*)'|([^\s'\"\\]+)))?$")
+
+#: Matches a single-quoted or an unquoted word of a wget command.
+_token_regex = re.compile(r"'([^']*)'|([^\s'\"\\]+)")
+
+#: The wget options that are understood, mapped to #WgetCommand fields.
+_wget_options = {'-O': 'ofile', '--output-document': 'ofile',
+                 '-a': 'logfile', '--append-output': 'logfile'}
+
+
+def split_command(line):
+  """
+  Splits a shell command into words. Lines of the form that the NASA
+  Exoplanet Archive generates (single-quoted or plain words separated by
+  spaces) are split with a regular expression, everything else falls back
+  to #shlex.split(). Raises a #ValueError if the line can not be split.
+  """
+
+  words = []
+  end = 0
+  for match in _token_regex.finditer(line):
+    gap = line[end:match.start()]
+    if (words and not gap) or (gap and not gap.isspace()):
+      return shlex.split(line)
+    words.append(match.group(2) if match.group(1) is None else match.group(1))
+    end = match.end()
+  if line[end:] and not line[end:].isspace():
+    return shlex.split(line)
+  return words
+
+
+def parse_wget(line):
+  """
+  Parses a `wget [-O file] [-a logfile] url` command into a #WgetCommand.
+  Raises a #ValueError if the command is invalid or uses other options.
+  """
+
+  match = _wget_regex.match(line)
+  if match:
+    return WgetCommand(match.group(2), match.group(1), match.group(3) or match.group(4))
+  words = split_command(line)
+  if not words or words[0] != 'wget':
+    raise ValueError('not a wget command')
+  values = {'url': None, 'ofile': None, 'logfile': None}
+  words = iter(words[1:])
+  for word in words:
+    if word.startswith('-') and len(word) > 1:
+      name, sep, value = word.partition('=')
+      if name not in _wget_options and word[:2] in _wget_options:
+        name, sep, value = word[:2], True, word[2:]
+      if name not in _wget_options:
+        raise ValueError('unsupported option "{}"'.format(word))
+      if not sep:
+        value = next(words, None)
+        if value is None:
+          raise ValueError('option "{}" requires an argument'.format(name))
+      values[_wget_options[name]] = value
+    elif values['url'] is None:
+      values['url'] = word
+    else:
+      raise ValueError('unexpected argument "{}"'.format(word))
+  if not values['url']:
+    raise ValueError('missing URL')
+  return WgetCommand(**values)
+
 
 def parse_batch_file(filename):
+  """
+  Yields a #WgetCommand for every wget command in the batch file
+  *filename*. Lines that can not be parsed are logged with their line
+  number and skipped.
+  """
+
   printed_warning = False
   with open(filename) as fp:
-    for line in fp:
+    for lineno, line in enumerate(fp, 1):
       line = line.strip()
       if not line or line.startswith('#'): continue
       if not line.startswith('wget'):
@@ -52,9 +130,83 @@ def parse_batch_file(filename):
           logger.warn('file "%s" contains commands that are not "wget".', filename)
           printed_warning = True
         continue
-      # TODO: Catch exception on parse error.
-      args = wget_parser.parse_args(shlex.split(line)[1:])
-      yield WgetCommand(args.url, args.O, args.a)
+      try:
+        yield parse_wget(line)
+      except ValueError as exc:
+        logger.error('%s:%d: %s', filename, lineno, exc)
+
+
+def parse_batch_files(filenames):
+  """
+  Yields the #WgetCommand of all batch files in *filenames* while they are
+  parsed. Commands for a URL that was listed before are skipped.
+  """
+
+  seen = set()
+  duplicates = 0
+  for filename in filenames:
+    for wget in parse_batch_file(filename):
+      if wget.url in seen:
+        duplicates += 1
+        continue
+      seen.add(wget.url)
+      yield wget
+  if duplicates:
+    logger.info('Skipped %d duplicate URLs.', duplicates)
+
+
+def iter_jobs(wgets, to, manifest, overwrite_existing, revalidate, report=None, pack=None):
+  """
+  Yields a #Job for every #WgetCommand in *wgets* that needs to be
+  downloaded into the directory *to*. Skipped files are added to the
+  *report*. If a #PackWriter is specified as *pack*, files are complete
+  if they were added to it.
+  """
+
+  for wget in wgets:
+    output_file = wget.ofile
+    if not output_file:
+      output_file = posixpath.basename(urlparse(wget.url).path)
+    if to:
+      output_file = os.path.join(to, output_file)
+
+    validators = None
+    if not overwrite_existing:
+      if manifest:
+        entry = manifest.get(output_file)
+        if entry is None and os.path.isfile(output_file):
+          # Downloaded before the manifest was used.
+          manifest.update(output_file, wget.url, 'complete')
+          entry = manifest.get(output_file)
+        complete = entry is not None and entry['state'] == 'complete'
+      else:
+        entry = None
+        complete = os.path.isfile(output_file)
+      if pack:
+        complete = pack_name(output_file, to) in pack
+      if complete and revalidate and entry and (entry['etag'] or entry['last_modified']):
+        validators = entry
+      elif complete:
+        logger.info('Skipping "%s"', os.path.basename(output_file))
+        if report:
+          report.add(wget.url, output_file, 'skipped')
+        continue
+
+    yield Job(wget.url, output_file, validators)
+
+
+def pack_name(output_file, to):
+  return os.path.relpath(output_file, to or '.').replace(os.sep, '/')
+
+
+def pack_file(pack, output_file, to):
+  """
+  Moves the downloaded *output_file* into the *pack*.
+  """
+
+  if os.path.isfile(output_file):
+    pack.add_file(pack_name(output_file, to), output_file)
+    os.remove(output_file)
 
 
 @click.group()
@@ -85,65 +237,213 @@ def extract_urls(ctx, files, format):
   if format == 'csv':
     writer = csv.writer(sys.stdout)
 
-  for filename in files:
-    for wget in parse_batch_file(filename):
-      if format == 'csv':
-        writer.writerow(wget)
-      else:
-        print(wget.url)
+  for wget in parse_batch_files(files):
+    if format == 'csv':
+      writer.writerow(wget)
+    else:
+      print(wget.url)
 
 
 @main.command('bulk-download')
 @click.argument('files', nargs=-1)
 @click.option('--to', help='The output directory.')
 @click.option('--overwrite-existing', is_flag=True, help='Overwrite existing files.')
-@click.option('--parallel', type=int, help='Number of parallel downloads.', default=1)
+@click.option('--revalidate', is_flag=True,
+  help='Ask the server whether completed files changed and download them '
+       'again if they did.')
+@click.option('--no-manifest', is_flag=True,
+  help='Do not record downloads in a manifest in the output directory. '
+       'Existing files are considered complete.')
+@click.option('--parallel', default='1',
+  help='Number of parallel downloads, or "auto" to adjust it to the '
+       'throughput and the responsiveness of the server.')
+@click.option('--parallel-min', type=int, default=1,
+  help='The minimum number of parallel downloads with --parallel=auto.')
+@click.option('--parallel-max', type=int, default=16,
+  help='The maximum number of parallel downloads with --parallel=auto.')
+@click.option('--engine', type=click.Choice(['thread', 'async']), default='thread',
+  help='The download engine. "async" runs all downloads on a single event '
+       'loop, which scales better to many concurrent small downloads.')
+@click.option('--segments', type=int, default=4,
+  help='Download large files in this many parallel segments if the server '
+       'supports it.')
+@click.option('--segment-threshold', default='64M',
+  help='Minimum file size for segmented downloads.')
+@click.option('--buffer-size', default='256K',
+  help='The number of bytes that are read from a response at a time.')
+@click.option('--no-preallocate', is_flag=True,
+  help='Do not reserve the disk space for a file before it is downloaded.')
+@click.option('--fsync', is_flag=True,
+  help='Flush every file to the disk before it is renamed to its final name. '
+       'Slower, but a file that exists after a power failure is complete.')
+@click.option('--retries', type=int, default=5,
+  help='How often a download that failed with a temporary error is '
+       'attempted again.')
+@click.option('--connect-timeout', type=float, default=30.0,
+  help='Seconds to wait for a connection to the server.')
+@click.option('--read-timeout', type=float, default=60.0,
+  help='Seconds to wait for data from the server before the download is '
+       'attempted again.')
+@click.option('--max-rate',
+  help='Limit the combined download rate, for example 200M (per second).')
+@click.option('--rate-schedule',
+  help='Limit the download rate depending on the time of day, for example '
+       '"08:00-18:00=50M,18:00-08:00=unlimited". --max-rate applies outside '
+       'of the schedule.')
+@click.option('--rate-control',
+  help='A file that contains the download rate. It can be created or changed '
+       'while the download is running and overrides --max-rate and '
+       '--rate-schedule.')
+@click.option('--schedule', 'schedule_policy', type=click.Choice(sorted(SCHEDULES)), default='listed',
+  help='The order in which the files are downloaded. All policies except '
+       '"listed" retrieve the size of every file before the download starts.')
+@click.option('--plan', is_flag=True,
+  help='Print the number and size of the files that would be downloaded, the '
+       'required disk space and the estimated duration, then exit.')
+@click.option('--shard',
+  help='Download only the files of shard i of N, for example 2/8, to split '
+       'the download across multiple machines.')
+@click.option('--shard-by', type=click.Choice(STRATEGIES), default='hash',
+  help='How files are assigned to shards: by the hash of their URL or by '
+       'their size so that all shards are about the same size.')
+@click.option('--shard-report',
+  help='The file to which the outcome of every file of the shard is written. '
+       'Defaults to shard-i-of-N.json in the output directory.')
+@click.option('--disk-budget',
+  help='Limit the disk space used in the output directory, for example 500G. '
+       'Downloads wait while the next file would exceed it.')
+@click.option('--metrics',
+  help='Append a JSON line with the time to first byte, duration, size, '
+       'throughput, retries and status of every download to this file.')
+@click.option('--metrics-textfile',
+  help='Periodically write aggregate download metrics in the Prometheus text '
+       'format to this file, for example into the directory of the '
+       'node_exporter textfile collector.')
+@click.option('--metrics-interval', type=float, default=15.0,
+  help='Seconds between updates of the --metrics-textfile.')
+@click.option('--pack', is_flag=True,
+  help='Store the downloaded files in a few large tar archives in the output '
+       'directory instead of one file each. Use utils/packfile.PackReader '
+       'to read them.')
+@click.option('--pack-size', default='1G',
+  help='The maximum size of an archive with --pack.')
+@click.option('--pack-compress', is_flag=True,
+  help='Compress every file in the archives with gzip.')
 @click.pass_context
-def bulk_download(ctx, files, to, overwrite_existing, parallel):
+def bulk_download(ctx, files, to, overwrite_existing, revalidate, no_manifest, parallel,
+                  parallel_min, parallel_max, engine, segments, segment_threshold,
+                  buffer_size, no_preallocate, fsync, retries, connect_timeout,
+                  read_timeout, max_rate, rate_schedule, rate_control, schedule_policy, plan,
+                  shard, shard_by, shard_report, disk_budget, metrics, metrics_textfile,
+                  metrics_interval, pack, pack_size, pack_compress):
   """
   Execute the bulk download from NASA-ExAr .bat files without using 'wget'.
   """
 
   if not files:
     ctx.fail('no input files')
+  try:
+    segment_threshold = parse_size(segment_threshold)
+    buffer_size = parse_size(buffer_size)
+    parallel = parse_parallel(parallel)
+    max_rate = parse_rate(max_rate) if max_rate else None
+    rate_schedule = parse_schedule(rate_schedule) if rate_schedule else None
+    shard = parse_shard(shard) if shard else None
+    disk_budget = parse_size(disk_budget) if disk_budget else None
+    pack_size = parse_size(pack_size)
+  except ValueError as exc:
+    ctx.fail(str(exc))
+
+  concurrency = None
+  if parallel == 'auto':
+    try:
+      concurrency = AdaptiveConcurrency(parallel_min, parallel_max, logger=logger)
+    except ValueError as exc:
+      ctx.fail(str(exc))
+    parallel = parallel_max
+
+  rate_limiter = None
+  if max_rate or rate_schedule or rate_control:
+    rate_limiter = RateLimiter(max_rate, rate_schedule, rate_control, logger=logger)
 
   if to and not os.path.isdir(to):
     os.makedirs(to)
 
-  def process(pool, output_file, url):
-    logger.info('Downloading "%s" ...', os.path.basename(output_file))
-    response = requests.get(wget.url)
-    try:
-      response.raise_for_status()
-    except Exception as exc:
-      logger.error(exc)
-      return
-    try:
-      with open(output_file, 'wb') as fp:
-        for chunk in response.iter_content(chunk_size=1024):
-          if not pool.running:
-            raise KeyboardInterrupt()
-          fp.write(chunk)
-    except KeyboardInterrupt:
-      # Do not keep half-completed files.
-      if os.path.isfile(output_file):
-        logger.warn('Removing incomplete download: "%s"', output_file)
-        os.remove(output_file)
-      raise
-
-  with BatchDownloader(parallel, logger) as downloader:
-    for filename in files:
-      for wget in parse_batch_file(filename):
-        output_file = wget.ofile
-        if not output_file:
-          output_file = posixpath.basename(urlparse(wget.url).path)
-        if to:
-          output_file = os.path.join(to, output_file)
-        if not overwrite_existing and os.path.isfile(output_file):
-          logger.info('Skipping "%s"', os.path.basename(output_file))
-          continue
-
-        downloader.submit(wget.url, output_file)
+  # Without options that need to know all files in advance, the downloads
+  # start while the batch files are still being parsed.
+  wgets = parse_batch_files(files)
+  sizes = {}
+  report = None
+  if shard:
+    wgets = list(wgets)
+    urls = [wget.url for wget in wgets]
+    if shard_by == 'size':
+      logger.info('Retrieving the size of %d files ...', len(urls))
+      sizes = dict(zip(urls, fetch_sizes(urls)))
+    selected = set(select(urls, shard, shard_by, [sizes.get(url) for url in urls]))
+    wgets = [wget for wget in wgets if wget.url in selected]
+    logger.info('Shard %d/%d contains %d files.', shard.index, shard.count, len(wgets))
+    report = ShardReport(shard_report or os.path.join(to or '.',
+      'shard-{}-of-{}.json'.format(*shard)), shard, shard_by)
+
+  manifest = None if no_manifest else Manifest(to or '.')
+  if metrics or metrics_textfile:
+    metrics = Metrics(metrics, metrics_textfile, metrics_interval)
+  pack = PackWriter(to or '.', pack_size, pack_compress) if pack else None
+  jobs = []
+  futures = []
+  try:
+    need_sizes = plan or schedule_policy != 'listed' or disk_budget
+    pending = iter_jobs(wgets, to, manifest, overwrite_existing, revalidate, report, pack)
+    jobs = list(pending) if report or need_sizes else pending
+
+    if need_sizes:
+      missing = [job.url for job in jobs if job.url not in sizes]
+      if missing:
+        logger.info('Retrieving the size of %d files ...', len(missing))
+        sizes.update(zip(missing, fetch_sizes(missing)))
+      job_sizes = [sizes[job.url] for job in jobs]
+      if plan:
+        throughput = None
+        if jobs:
+          logger.info('Measuring the throughput ...')
+          throughput = measure_throughput(largest(jobs, job_sizes).url)
+        for line in format_plan(job_sizes, to or '.', throughput, parallel, max_rate):
+          print(line)
+        report = None
+        return
+      jobs = schedule(jobs, job_sizes, schedule_policy)
+
+    if disk_budget:
+      disk_budget = DiskBudget(disk_budget, to or '.', logger=logger)
+
+    engine = AsyncBatchDownloader if engine == 'async' else BatchDownloader
+    with engine(parallel, logger, segments=segments, segment_threshold=segment_threshold,
+        checksum='md5' if manifest else None, manifest=manifest,
+        retry=RetryPolicy(retries), concurrency=concurrency,
+        rate_limiter=rate_limiter, buffer_size=buffer_size,
+        preallocate=not no_preallocate, fsync=fsync,
+        disk_budget=disk_budget, metrics=metrics, connect_timeout=connect_timeout,
+        read_timeout=read_timeout) as downloader:
+      for job in jobs:
+        done_callback = partial(pack_file, pack, job.ofile, to) if pack else None
+        future = downloader.submit(job.url, job.ofile, validators=job.validators,
+          size=sizes.get(job.url), done_callback=done_callback)
+        futures.append((job, future))
+  finally:
+    if manifest:
+      manifest.close()
+    if pack:
+      pack.close()
+    if metrics:
+      metrics.close()
+    if report:
+      for job, future in futures:
+        report.add_download(job.url, job.ofile, future)
+      for job in jobs[len(futures):]:
+        report.add(job.url, job.ofile, 'aborted')
+      report.write()
+      logger.info('Wrote shard report to "%s"', report.filename)
 
 
 if require.main == module:
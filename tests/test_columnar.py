@@ -0,0 +1,105 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Tests for #utils.columnar. Run with `nodepy tests/test_columnar.py`.
+"""
+
+import csv
+import os
+import shutil
+import tempfile
+from click.testing import CliRunner
+
+import csvtools from '../csvtools'
+import columnar from '../utils/columnar'
+
+
+def write_csv(filename, rows):
+  with open(filename, 'w', newline='') as fp:
+    csv.writer(fp).writerows(rows)
+
+
+def test_convert_values_all_null_float():
+  data, nulls = columnar.convert_values('radial_velocity', 'float64', ['', '', 'null'])
+  assert nulls.all()
+  assert all(v != v for v in data.tolist())
+
+
+def test_convert_values_one_character():
+  data, nulls = columnar.convert_values('n', 'float64', ['1', '', '2'])
+  assert nulls.tolist() == [False, True, False]
+  assert data[0] == 1.0 and data[2] == 2.0 and data[1] != data[1]
+  data, nulls = columnar.convert_values('n', 'int64', ['7', '', '8'])
+  assert data.tolist() == [7, 0, 8]
+  assert nulls.tolist() == [False, True, False]
+
+
+def test_convert_all_null_column():
+  directory = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(directory, 'part.csv')
+    write_csv(filename, [['source_id', 'radial_velocity', 'n']] +
+      [[str(i), '', str(i % 10) if i % 3 else ''] for i in range(100)])
+    output = os.path.join(directory, 'out')
+    schema = columnar.convert([filename], output, {'radial_velocity': 'float64'},
+      num_workers=1)
+    assert schema['rows'] == 100
+    column = columnar.load_column(output, 'radial_velocity')
+    assert column.nulls.all()
+    column = columnar.load_column(output, 'n')
+    assert column.type == 'int64'
+    assert column.values[4] == 4 and column.nulls[3]
+  finally:
+    shutil.rmtree(directory)
+
+
+def test_convert_str_nulls():
+  directory = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(directory, 'part.csv')
+    names = ['a', '', 'b', 'null', 'NULL', 'c']
+    write_csv(filename, [['source_id', 'name']] + [[str(i), n] for i, n in enumerate(names)])
+    output = os.path.join(directory, 'out')
+    columnar.convert([filename], output, {'name': 'str'}, num_workers=1)
+    column = columnar.load_column(output, 'name')
+    assert column.nulls.tolist() == [False, True, False, True, True, False]
+    assert list(column.values) == ['a', '', 'b', '', '', 'c']
+
+    # Filtering the CSV and the converted columns gives the same rows.
+    for source in (filename, output):
+      result = CliRunner().invoke(csvtools.main, ['filter', source, 'name is null'])
+      assert result.exit_code == 0, result.output
+      rows = list(csv.reader(result.output.splitlines()))[1:]
+      assert [row[0] for row in rows] == ['1', '3', '4'], (source, rows)
+    # Nulls are written back as empty fields.
+    assert [row[1] for row in rows] == ['', '', '']
+  finally:
+    shutil.rmtree(directory)
+
+
+def main():
+  for name, value in sorted(globals().items()):
+    if name.startswith('test_') and callable(value):
+      value()
+      print('{} ok'.format(name))
+
+
+if require.main == module:
+  main()
@@ -0,0 +1,62 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Tests for the `csvtools` commands. Run with `nodepy tests/test_csvtools.py`.
+"""
+
+import csvtools from '../csvtools'
+import predicate from '../utils/predicate'
+
+
+def test_filter_rows_all_null_chunk():
+  node = predicate.parse('radial_velocity > 10.5')
+  fields = {'radial_velocity': (1, [10.5])}
+  data = b'1,,a\n2,,b\n3,,c\n'
+  assert csvtools.filter_rows(node, fields, None, memoryview(data), None) == b''
+  node = predicate.parse('radial_velocity is null and source_id < 3')
+  fields = {'radial_velocity': (1, []), 'source_id': (0, [3])}
+  assert csvtools.filter_rows(node, fields, [2], memoryview(data), None) == b'a\r\nb\r\n'
+
+
+def test_filter_rows_mixed_chunk():
+  node = predicate.parse('radial_velocity > 10.5')
+  fields = {'radial_velocity': (1, [10.5])}
+  data = b'1,,a\n2,11,b\n3,9.5,c\n'
+  assert csvtools.filter_rows(node, fields, [0], memoryview(data), None) == b'2\r\n'
+
+
+def test_filter_rows_str_nulls():
+  data = b'1,,a\n2,foo,b\n3,null,c\n4,bar,d\n'
+  node = predicate.parse("name is null or name = 'foo'")
+  fields = {'name': (1, ['foo'])}
+  assert csvtools.filter_rows(node, fields, [0], memoryview(data), None) == b'1\r\n2\r\n3\r\n'
+  node = predicate.parse("name != 'foo'")
+  assert csvtools.filter_rows(node, fields, [0], memoryview(data), None) == b'4\r\n'
+
+
+def main():
+  for name, value in sorted(globals().items()):
+    if name.startswith('test_') and callable(value):
+      value()
+      print('{} ok'.format(name))
+
+
+if require.main == module:
+  main()
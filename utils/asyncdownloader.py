@@ -0,0 +1,473 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+An alternative to the thread based #BatchDownloader that runs all transfers
+on a single asyncio event loop.
+"""
+
+import aiohttp
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import logging
+import os
+import posixpath
+import threading
+import time
+import urllib.parse
+
+import {BatchDownloader, ChecksumError, DownloadResult, NotModified, PartWriter, commit_file, conditional_headers, log_summary, remove_file, resume_accepted, resume_headers, resume_state, save_state, verify_checksum} from './batchdownloader'
+import {Transfer} from './metrics'
+import {CircuitBreaker, RetryPolicy} from './retry'
+
+
+class AsyncBatchDownloader(object):
+  """
+  Drop-in replacement for #BatchDownloader that downloads files with
+  #aiohttp on an asyncio event loop running in a background thread. At
+  most *num_workers* transfers are active at the same time, which makes
+  hundreds of concurrent small-file downloads feasible without spawning
+  hundreds of threads.
+
+  Partial downloads are kept and resumed the same way as with the
+  #BatchDownloader, but files are never split into segments (the
+  *segments* and *segment_threshold* parameters are accepted for
+  compatibility and ignored). The *done_callback* of a download is run in
+  the default executor of the event loop so that it does not block other
+  transfers, and file writes as well as manifest updates are run in a
+  separate pool of I/O threads. Files submitted with *unpack* enabled are
+  decompressed while they are downloaded, and the *checksum*, *manifest*,
+  *validators*, *retry*, *breaker*, *concurrency*, *rate_limiter*,
+  *preallocate*, *fsync*, *disk_budget*, *unpack_ratio*, *connect_timeout*,
+  *read_timeout* and *metrics* options work the same as with the
+  #BatchDownloader. Up to *buffer_size* bytes are read from a response at a
+  time.
+  """
+
+  partial_suffix = BatchDownloader.partial_suffix
+  state_suffix = BatchDownloader.state_suffix
+
+  def __init__(self, num_workers=1, logger=None, resume=True, segments=1,
+               segment_threshold=None, checksum=None, manifest=None,
+               retry=None, breaker=None, concurrency=None, rate_limiter=None,
+               buffer_size=256 * 1024, preallocate=True, fsync=False, disk_budget=None,
+               metrics=None, unpack_ratio=3.0, connect_timeout=30.0, read_timeout=60.0):
+    self.num_workers = num_workers
+    self.logger = logger or logging
+    self.resume = resume
+    self.checksum = checksum
+    self.retry = retry or RetryPolicy()
+    self.breaker = breaker or CircuitBreaker(logger=self.logger)
+    self.manifest = manifest
+    self.concurrency = concurrency
+    self.rate_limiter = rate_limiter
+    self.buffer_size = buffer_size
+    self.preallocate = preallocate
+    self.fsync = fsync
+    self.disk_budget = disk_budget
+    self.unpack_ratio = unpack_ratio
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.metrics = metrics
+    self.stats = collections.Counter()
+    self._start_time = time.perf_counter()
+    self.loop = asyncio.new_event_loop()
+    self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+    self._thread.start()
+    self._tasks = set()
+    self._cancelled = False
+    self._io = concurrent.futures.ThreadPoolExecutor(max(1, min(num_workers, 32)))
+    self._cleanups = set()
+    asyncio.run_coroutine_threadsafe(self.__start(), self.loop).result()
+    self._dispatcher = asyncio.run_coroutine_threadsafe(self.__dispatch(), self.loop)
+
+  async def __start(self):
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(self.__on_request_start)
+    trace.on_connection_create_end.append(self.__on_connection_create_end)
+    self._queue = asyncio.Queue()
+    self._session = aiohttp.ClientSession(
+      connector=aiohttp.TCPConnector(limit=self.num_workers),
+      timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout,
+        sock_read=self.read_timeout),
+      trace_configs=[trace])
+
+  def __progress(self, transfer, num_bytes):
+    self.stats['bytes'] += num_bytes
+    transfer.bytes += num_bytes
+    if self.metrics:
+      self.metrics.add_bytes(num_bytes)
+    if self.concurrency:
+      self.concurrency.record_bytes(num_bytes)
+
+  async def __on_request_start(self, session, context, params):
+    self.stats['requests'] += 1
+
+  async def __on_connection_create_end(self, session, context, params):
+    self.stats['connections'] += 1
+
+  async def __dispatch(self):
+    """
+    Takes downloads from the queue and starts them as soon as one of the
+    *num_workers* slots (or of the slots granted by the #AdaptiveConcurrency
+    controller) is free. Returns when the `None` sentinel is received and
+    all transfers are complete.
+    """
+
+    semaphore = asyncio.BoundedSemaphore(self.num_workers)
+    slot_freed = asyncio.Event()
+
+    def task_done(task):
+      self._tasks.discard(task)
+      semaphore.release()
+      if self.concurrency:
+        self.concurrency.release()
+        slot_freed.set()
+
+    try:
+      while True:
+        item = await self._queue.get()
+        if item is None:
+          break
+        if not self._cancelled:
+          await semaphore.acquire()
+          # The limit may also be raised without a transfer completing,
+          # thus we check again at least once per second.
+          while self.concurrency and not self._cancelled and not self.concurrency.try_acquire():
+            slot_freed.clear()
+            try:
+              await asyncio.wait_for(slot_freed.wait(), 1)
+            except asyncio.TimeoutError:
+              pass
+        if self._cancelled:
+          item[-1].cancel()
+          continue
+        task = self.loop.create_task(self.__download(*item))
+        self._tasks.add(task)
+        task.add_done_callback(task_done)
+      if self._tasks:
+        await asyncio.wait(set(self._tasks))
+    finally:
+      await self._session.close()
+
+  def __cancel(self):
+    self._cancelled = True
+    for task in self._tasks:
+      task.cancel()
+
+  def __run(self, function, *args):
+    """
+    Runs the blocking *function* in the I/O threads. Returns an awaitable.
+    """
+
+    return asyncio.wrap_future(self._io.submit(function, *args), loop=self.loop)
+
+  def __discard(self, partfile, statefile):
+    for filename in (partfile, statefile):
+      try:
+        remove_file(filename)
+      except OSError as exc:
+        self.logger.error('Could not remove incomplete file "%s": %s', filename, exc)
+
+  async def __get(self, url, headers=None):
+    tstart = time.perf_counter()
+    response = await self._session.get(url, headers=headers)
+    if self.concurrency:
+      self.concurrency.record_response(response.status, time.perf_counter() - tstart)
+    try:
+      response.raise_for_status()
+    except:
+      response.release()
+      raise
+    return response
+
+  async def __transfer(self, url, partfile, statefile, desc, unpack, validators, transfer):
+    state = await self.__run(resume_state, url, partfile, statefile) \
+      if self.resume and not unpack else None
+    if state and state.get('segments'):
+      # Segmented downloads can only be continued by the BatchDownloader.
+      state = None
+
+    if state:
+      headers = resume_headers(state)
+    elif validators:
+      headers = conditional_headers(validators)
+    else:
+      headers = None
+    try:
+      response = await self.__get(url, headers)
+    except aiohttp.ClientResponseError as exc:
+      if not state or exc.status != 416:
+        raise
+      response = await self.__get(url)
+    transfer.responded()
+
+    offset = 0
+    try:
+      if response.status == 304:
+        raise NotModified(url)
+      etag = response.headers.get('ETag')
+      last_modified = response.headers.get('Last-Modified')
+      if state:
+        if resume_accepted(state, response.status, response.headers):
+          offset = state['bytes']
+          self.logger.info('Resuming "%s" at byte %d ...', desc, offset)
+        else:
+          self.logger.info('Server did not resume "%s", downloading from the start ...', desc)
+      else:
+        self.logger.info('Downloading "%s" ...', desc)
+
+      state = {'url': url, 'bytes': offset, 'etag': etag, 'last_modified': last_modified}
+      resumable = self.resume and not unpack and bool(etag or last_modified)
+      if resumable:
+        await self.__run(save_state, statefile, state)
+      else:
+        await self.__run(remove_file, statefile)
+
+      if self.disk_budget and response.content_length:
+        self.disk_budget.update(partfile, int(response.content_length * self.unpack_ratio)
+          if unpack else response.content_length + offset)
+      size = None
+      if self.preallocate and response.content_length and \
+          response.headers.get('Content-Encoding', 'identity') == 'identity':
+        size = response.content_length + offset
+      # The writer runs in the I/O threads, its progress is reported back to
+      # the event loop.
+      progress = functools.partial(self.loop.call_soon_threadsafe, self.__progress, transfer)
+      writer = await self.__run(PartWriter, partfile, statefile, state, resumable, unpack,
+        self.checksum, progress, size)
+      await self.__run(writer.__enter__)
+      pending = None
+      try:
+        async for chunk in response.content.iter_chunked(self.buffer_size):
+          pending = self._io.submit(writer.write, chunk)
+          await asyncio.wrap_future(pending, loop=self.loop)
+          if self.rate_limiter:
+            delay = self.rate_limiter.reserve(len(chunk))
+            if delay:
+              await asyncio.sleep(delay)
+      except BaseException as exc:
+        # A write that is still running when the task is cancelled must be
+        # complete before the file is closed.
+        if pending is not None:
+          await asyncio.wait([asyncio.wrap_future(pending, loop=self.loop)])
+        await self.__run(writer.__exit__, type(exc), exc, exc.__traceback__)
+        raise
+      await self.__run(writer.__exit__, None, None, None)
+    finally:
+      response.release()
+    return {'size': writer.bytes_read, 'etag': etag, 'last_modified': last_modified,
+      'checksum': writer.checksum}
+
+  def __classify(self, exc):
+    """
+    Returns a tuple `(transient, responded, retry_after)` for an exception
+    raised by a transfer.
+    """
+
+    if isinstance(exc, aiohttp.ClientResponseError):
+      return (self.retry.is_transient_status(exc.status), exc.status < 500,
+        (exc.headers or {}).get('Retry-After'))
+    if isinstance(exc, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                        asyncio.TimeoutError)):
+      return True, False, None
+    return False, True, None
+
+  async def __attempt(self, url, partfile, statefile, desc, unpack, validators,
+                      expected_checksum, transfer):
+    transfer.attempt()
+    info = await self.__transfer(url, partfile, statefile, desc, unpack, validators,
+      transfer)
+    try:
+      verify_checksum(info, expected_checksum)
+    except ChecksumError:
+      self.stats['checksum_mismatches'] += 1
+      await self.__run(self.__discard, partfile, statefile)
+      raise
+    return info
+
+  async def __download(self, url, ofile, desc, done_callback, unpack, validators,
+                       expected_checksum, size, reserve, future):
+    if not future.set_running_or_notify_cancel():
+      return
+    partfile = ofile + self.partial_suffix
+    statefile = ofile + self.state_suffix
+    host = urllib.parse.urlparse(url).netloc
+    reserved = False
+    transfer = self.metrics.begin(url, ofile) if self.metrics else Transfer(url, ofile)
+    result = DownloadResult('aborted', None, None)
+    try:
+      if self.disk_budget and reserve:
+        # Poll instead of blocking the event loop.
+        if unpack and size:
+          size = int(size * self.unpack_ratio)
+        while not self.disk_budget.try_reserve(partfile, size or 0, (partfile, ofile)):
+          await asyncio.sleep(1)
+        reserved = True
+        transfer.restart()
+      attempt = 0
+      while True:
+        await asyncio.sleep(self.breaker.wait_time(host))
+        try:
+          info = await self.__attempt(url, partfile, statefile, desc, unpack, validators,
+            expected_checksum, transfer)
+          self.breaker.success(host)
+          break
+        except ChecksumError as exc:
+          self.breaker.success(host)
+          if attempt >= self.retry.retries:
+            raise
+          error, retry_after = exc, None
+        except NotModified:
+          self.breaker.success(host)
+          raise
+        except Exception as exc:
+          transient, responded, retry_after = self.__classify(exc)
+          if responded and not retry_after:
+            self.breaker.success(host)
+          else:
+            self.breaker.failure(host, retry_after)
+          if not transient or attempt >= self.retry.retries:
+            raise
+          error = exc
+        delay = self.retry.delay(attempt, retry_after)
+        attempt += 1
+        transfer.retries += 1
+        self.stats['retries'] += 1
+        self.logger.warning('Downloading "%s" again in %.1fs (retry %d of %d): %s',
+          desc, delay, attempt, self.retry.retries, error)
+        await asyncio.sleep(delay)
+      await self.__run(commit_file, partfile, ofile, self.fsync)
+      await self.__run(remove_file, statefile)
+      self.stats['completed'] += 1
+      if self.manifest:
+        await self.__run(functools.partial(self.manifest.update, ofile, url, 'complete', **info))
+      result = DownloadResult('complete', info['size'], None)
+    except NotModified:
+      self.stats['unchanged'] += 1
+      self.logger.info('Unchanged "%s"', desc)
+      result = DownloadResult('unchanged', None, None)
+    except asyncio.CancelledError:
+      self.stats['aborted'] += 1
+      self.logger.info('Aborting download "%s"', desc)
+      # The task is cancelled, thus the cleanup runs in the I/O threads and
+      # #__exit__() waits for it.
+      cleanup = self._io.submit(self.__aborted, url, ofile, partfile, statefile,
+        done_callback, future, result)
+      self._cleanups.add(cleanup)
+      raise
+    except Exception as exc:
+      self.stats['failed'] += 1
+      self.logger.error(exc)
+      result = DownloadResult('failed', None, str(exc))
+    finally:
+      if reserved:
+        self.disk_budget.release(partfile)
+      if self.metrics:
+        self.metrics.finish(transfer, result)
+    # The download is finished even if the task is cancelled from here on.
+    try:
+      if result.status == 'failed':
+        await self.__run(self.__failed, url, ofile, partfile, statefile)
+      if done_callback:
+        try:
+          await self.loop.run_in_executor(None, done_callback)
+        except Exception as exc:
+          self.logger.exception(exc)
+    finally:
+      future.set_result(result)
+
+  def __failed(self, url, ofile, partfile, statefile):
+    if self.manifest:
+      self.manifest.update(ofile, url, 'failed')
+    if not os.path.isfile(statefile):
+      self.__discard(partfile, statefile)
+
+  def __aborted(self, url, ofile, partfile, statefile, done_callback, future, result):
+    try:
+      if self.manifest:
+        self.manifest.update(ofile, url, 'incomplete')
+      if os.path.isfile(statefile):
+        self.logger.info('Keeping incomplete file "%s" to resume later', partfile)
+      else:
+        self.__discard(partfile, statefile)
+      if done_callback:
+        done_callback()
+    except Exception as exc:
+      self.logger.exception(exc)
+    finally:
+      future.set_result(result)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, exc_tb):
+    if exc_value is not None:
+      self.cancel()
+    self.loop.call_soon_threadsafe(self._queue.put_nowait, None)
+    # Wait with a timeout so that we can catch keyboard interrupts and
+    # cancel the downloads.
+    try:
+      while True:
+        try:
+          self._dispatcher.result(1)
+          break
+        except concurrent.futures.TimeoutError:
+          pass
+    except:
+      self.cancel()
+      self._dispatcher.result()
+      raise
+    finally:
+      self.loop.call_soon_threadsafe(self.loop.stop)
+      self._thread.join()
+      self.loop.close()
+      concurrent.futures.wait(self._cleanups)
+      self._io.shutdown()
+      log_summary(self.logger, self.stats, time.perf_counter() - self._start_time)
+
+  def cancel(self):
+    """
+    Cancel all queued and running downloads.
+    """
+
+    self.loop.call_soon_threadsafe(self.__cancel)
+
+  def stop(self):
+    self.cancel()
+    self.loop.call_soon_threadsafe(self._queue.put_nowait, None)
+    self._dispatcher.result()
+
+  def submit(self, url, ofile, desc=None, done_callback=None, unpack=False,
+             validators=None, checksum=None, size=None, reserve=True):
+    """
+    Queue the download of *url* into *ofile*. See #BatchDownloader.submit().
+    """
+
+    if checksum and not self.checksum:
+      raise ValueError('no checksum algorithm configured')
+    if not desc:
+      desc = posixpath.basename(urllib.parse.urlparse(url).path)
+    future = concurrent.futures.Future()
+    item = (url, ofile, desc, done_callback, unpack, validators, checksum, size, reserve,
+      future)
+    self.loop.call_soon_threadsafe(self._queue.put_nowait, item)
+    return future
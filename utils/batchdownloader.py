@@ -18,60 +18,862 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import collections
+import errno
+import functools
+import hashlib
+import json
 import os
 import logging
 import posixpath
 import nr.futures
+import re
 import requests
+import threading
+import time
 import urllib.parse
+import urllib3
+import zlib
+
+import {Transfer} from './metrics'
+import {CircuitBreaker, RetryPolicy} from './retry'
+import {format_size} from './units'
+
+
+def load_state(filename):
+  """
+  Loads the resume information from a `.part.json` sidecar file. Returns
+  #None if the file does not exist or can not be parsed.
+  """
+
+  try:
+    with open(filename) as fp:
+      return json.load(fp)
+  except (OSError, ValueError):
+    return None
+
+
+def save_state(filename, state):
+  with open(filename, 'w') as fp:
+    json.dump(state, fp)
+
+
+def remove_file(filename):
+  try:
+    os.remove(filename)
+  except FileNotFoundError:
+    pass
+
+
+def content_range_start(headers):
+  match = re.match(r'bytes\s+(\d+)-', headers.get('Content-Range', ''))
+  return int(match.group(1)) if match else None
+
+
+def resume_state(url, partfile, statefile):
+  """
+  Returns the resume information for *partfile* if it can be used to
+  continue the download of *url*, otherwise #None.
+  """
+
+  state = load_state(statefile)
+  if not state or state.get('url') != url:
+    return None
+  if not (state.get('etag') or state.get('last_modified')):
+    return None
+  try:
+    size = os.path.getsize(partfile)
+  except OSError:
+    return None
+  if state.get('segments'):
+    # Segmented downloads are preallocated to their full size.
+    return state if size == state.get('size') else None
+  # The sidecar is only updated periodically, thus the partial file may
+  # contain more data. The data beyond what was recorded is discarded.
+  state['bytes'] = min(state.get('bytes', 0), size)
+  if state['bytes'] <= 0:
+    return None
+  return state
+
+
+def resume_headers(state):
+  """
+  Returns the headers to request the remainder of a partial download.
+  """
+
+  return {
+    'Range': 'bytes={}-'.format(state['bytes']),
+    'If-Range': state['etag'] or state['last_modified']
+  }
+
+
+def resume_accepted(state, status, headers):
+  """
+  Returns #True if a response with the specified *status* and *headers*
+  continues the partial download described by *state*.
+  """
+
+  validator = headers.get('ETag') or headers.get('Last-Modified')
+  return status == 206 and content_range_start(headers) == state['bytes'] \
+    and validator in (state['etag'] or state['last_modified'], None)
+
+
+class GunzipWriter(object):
+  """
+  Wraps a binary file object and decompresses the gzip data that is
+  written to it incrementally. Concatenated gzip members are supported.
+  """
+
+  def __init__(self, fp):
+    self.fp = fp
+    self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+  def write(self, data):
+    while data:
+      self.fp.write(self._decompressor.decompress(data))
+      data = self._decompressor.unused_data
+      if data:
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+  def close(self):
+    """
+    Flushes the remaining decompressed data. Raises an #IOError if the
+    gzip stream is incomplete. Does not close the wrapped file object.
+    """
+
+    self.fp.write(self._decompressor.flush())
+    if not self._decompressor.eof:
+      raise IOError('incomplete gzip stream')
+
+
+def file_hash(filename, algorithm, size=None):
+  """
+  Returns a #hashlib object of the *algorithm* updated with the first
+  *size* bytes (or all bytes) of *filename*.
+  """
+
+  hasher = hashlib.new(algorithm)
+  with open(filename, 'rb') as fp:
+    while size is None or size > 0:
+      data = fp.read(1024 * 1024 if size is None else min(size, 1024 * 1024))
+      if not data:
+        break
+      hasher.update(data)
+      if size is not None:
+        size -= len(data)
+  return hasher
+
+
+def preallocate(fp, size):
+  """
+  Reserves *size* bytes for the open file *fp* if the platform supports
+  it. This lets the file system place the file contiguously and reports a
+  full disk before the download starts. The file size is extended to
+  *size* as well.
+  """
+
+  if not size or not hasattr(os, 'posix_fallocate'):
+    return
+  try:
+    os.posix_fallocate(fp.fileno(), 0, size)
+  except OSError as exc:
+    if exc.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+      raise
+
+
+def commit_file(partfile, filename, fsync=False):
+  """
+  Renames the complete *partfile* to *filename*, which is atomic: the file
+  either exists under its final name with all its data or not at all. With
+  *fsync*, the data is flushed to the disk before the rename and the rename
+  is flushed afterwards, which makes this hold after a power failure, too.
+  """
+
+  if fsync:
+    with open(partfile, 'r+b') as fp:
+      os.fsync(fp.fileno())
+  os.replace(partfile, filename)
+  if fsync and hasattr(os, 'O_DIRECTORY'):
+    fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+
+def iter_response(response, buffer):
+  """
+  Reads the body of a #requests.Response into the bytearray *buffer* and
+  yields a #memoryview of the data for every read. The view is only valid
+  until the next iteration. Unlike #requests.Response.iter_content(), no
+  new bytes object is created for every chunk, which makes a difference
+  at high rates with large buffers. Errors are raised as the same
+  #requests exceptions as with #requests.Response.iter_content().
+  """
+
+  if response.headers.get('Content-Encoding', 'identity') != 'identity':
+    # Let requests take care of decoding the body.
+    yield from response.iter_content(chunk_size=len(buffer))
+    return
+
+  view = memoryview(buffer)
+  try:
+    while True:
+      num_bytes = response.raw.readinto(buffer)
+      if not num_bytes:
+        break
+      yield view[:num_bytes]
+  except urllib3.exceptions.ProtocolError as exc:
+    raise requests.exceptions.ChunkedEncodingError(exc)
+  except urllib3.exceptions.ReadTimeoutError as exc:
+    raise requests.exceptions.ConnectionError(exc)
+  except urllib3.exceptions.SSLError as exc:
+    raise requests.exceptions.SSLError(exc)
+
+
+class PartWriter(object):
+  """
+  Writes the body of a response to the `.part` file of a download,
+  starting at `state['bytes']`. If the download is *resumable*, the
+  *state* is saved to the *statefile* periodically and when the writer is
+  exited with an exception. If *unpack* is enabled, the gzip-compressed
+  data is decompressed before it is written. If *checksum* is the name of
+  a #hashlib algorithm, the digest of the received data (including the
+  data that was already present in the partial file) is computed while it
+  is written. The *progress* function is called with the number of bytes
+  received since its last call every *progress_interval* bytes and when
+  the writer is exited. If the final *size* of the file is known, the file
+  is preallocated with #preallocate().
+  """
+
+  #: Number of bytes after which the resume information is updated.
+  state_interval = 4 * 1024 * 1024
+
+  #: Number of bytes after which the *progress* function is called.
+  progress_interval = 1024 * 1024
+
+  def __init__(self, partfile, statefile, state, resumable, unpack=False, checksum=None,
+               progress=None, size=None):
+    self.partfile = partfile
+    self.statefile = statefile
+    self.state = state
+    self.resumable = resumable
+    self.unpack = unpack
+    self.offset = state['bytes']
+    self.bytes_read = self.offset
+    self.hash = None
+    if checksum:
+      if self.offset:
+        self.hash = file_hash(partfile, checksum, self.offset)
+      else:
+        self.hash = hashlib.new(checksum)
+    self._next_state_update = self.offset + self.state_interval
+    self.progress = progress
+    self.size = None if unpack else size
+    self._reported = self.offset
+    self._next_progress = self.offset + self.progress_interval
+
+  def __enter__(self):
+    self.fp = open(self.partfile, 'r+b' if self.offset else 'wb')
+    self.fp.seek(self.offset)
+    self.fp.truncate()
+    preallocate(self.fp, self.size)
+    self._writer = GunzipWriter(self.fp) if self.unpack else self.fp
+    return self
+
+  def __exit__(self, exc_type, exc_value, exc_tb):
+    try:
+      if exc_type is None:
+        if self.unpack:
+          self._writer.close()
+        elif self.size:
+          # In case the response was shorter than announced.
+          self.fp.truncate()
+      elif self.resumable:
+        self.__save_state()
+    finally:
+      self.fp.close()
+      self.__report_progress()
+
+  def __report_progress(self):
+    if self.progress and self.bytes_read > self._reported:
+      self.progress(self.bytes_read - self._reported)
+    self._reported = self.bytes_read
+    self._next_progress = self.bytes_read + self.progress_interval
+
+  def __save_state(self):
+    self.fp.flush()
+    self.state['bytes'] = self.bytes_read
+    save_state(self.statefile, self.state)
+    self._next_state_update = self.bytes_read + self.state_interval
+
+  def write(self, chunk):
+    self._writer.write(chunk)
+    if self.hash:
+      self.hash.update(chunk)
+    self.bytes_read += len(chunk)
+    if self.resumable and self.bytes_read >= self._next_state_update:
+      self.__save_state()
+    if self.bytes_read >= self._next_progress:
+      self.__report_progress()
+
+  @property
+  def checksum(self):
+    return self.hash.hexdigest() if self.hash else None
+
+
+def log_summary(logger, stats, elapsed):
+  """
+  Logs the statistics collected by a downloader at the end of a run that
+  took *elapsed* seconds.
+  """
+
+  logger.info('%d files downloaded, %d unchanged, %d failed, %d aborted, %d checksum mismatches, %d retries.',
+    stats['completed'], stats['unchanged'], stats['failed'], stats['aborted'],
+    stats['checksum_mismatches'], stats['retries'])
+  logger.info('Received %s in %.1fs (%s/s).', format_size(stats['bytes']),
+    elapsed, format_size(int(stats['bytes'] / max(elapsed, 1e-3))))
+  logger.info('%d requests, %d new connections, %d reused connections.',
+    stats['requests'], stats['connections'],
+    max(0, stats['requests'] - stats['connections']))
+
+
+def conditional_headers(validators):
+  """
+  Returns the headers for a conditional request that is answered with
+  `304 Not Modified` if the file still matches the *validators* (a
+  dictionary with the keys `etag` and `last_modified`).
+  """
+
+  headers = {}
+  if validators.get('etag'):
+    headers['If-None-Match'] = validators['etag']
+  if validators.get('last_modified'):
+    headers['If-Modified-Since'] = validators['last_modified']
+  return headers
+
+
+#: The result of the future returned by #BatchDownloader.submit(). The
+#: *status* is one of `complete`, `unchanged`, `failed` or `aborted`.
+DownloadResult = collections.namedtuple('DownloadResult', 'status size error')
+
+
+class NotModified(Exception):
+  """
+  Raised by a transfer when the server reports that the file did not
+  change since it was last downloaded.
+  """
+
+
+class ChecksumError(Exception):
+  """
+  Raised when the checksum of a downloaded file does not match the
+  expected checksum.
+  """
+
+
+def verify_checksum(info, expected):
+  """
+  Raises a #ChecksumError if the checksum in the *info* returned for a
+  transfer does not match the *expected* hex digest.
+  """
+
+  if expected and info['checksum'] != expected.lower():
+    raise ChecksumError('checksum mismatch: expected {}, got {}'.format(expected, info['checksum']))
+
+
+class _RangeNotHonored(Exception):
+  pass
+
+
+class _CountingAdapter(requests.adapters.HTTPAdapter):
+  """
+  A #requests.adapters.HTTPAdapter that counts the number of connections
+  opened by its connection pools in the *counter* under the key
+  `connections`.
+  """
+
+  def __init__(self, counter, lock, **kwargs):
+    self.counter = counter
+    self.lock = lock
+    requests.adapters.HTTPAdapter.__init__(self, **kwargs)
+
+  def init_poolmanager(self, *args, **kwargs):
+    requests.adapters.HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+    classes = self.poolmanager.pool_classes_by_scheme
+    self.poolmanager.pool_classes_by_scheme = {
+      k: self.__counting_pool(v) for k, v in classes.items()}
+
+  def __counting_pool(self, base):
+    counter, lock = self.counter, self.lock
+    class CountingPool(base):
+      def _new_conn(self):
+        with lock:
+          counter['connections'] += 1
+        return base._new_conn(self)
+    return CountingPool
+
 
 class BatchDownloader(object):
+  """
+  Downloads files in parallel using a thread pool. Files are downloaded to
+  a temporary `.part` file first and renamed to the final output filename
+  once they are complete. If *resume* is enabled, the partial file is kept
+  when a download fails or is interrupted, together with a `.part.json`
+  sidecar that records the number of bytes received and the ETag and
+  Last-Modified headers of the response. The next attempt continues the
+  download with a `Range` request if the server confirms that the file
+  has not changed.
+
+  If *segments* is larger than one, files of at least *segment_threshold*
+  bytes are split into that many byte ranges which are downloaded at the
+  same time into the preallocated `.part` file (only if the server
+  reports `Accept-Ranges: bytes`).
+
+  Files submitted with *unpack* enabled are gzip-decompressed while they
+  are downloaded. Such downloads can not be resumed or segmented.
+
+  Every worker thread uses its own #requests.Session so that connections
+  to the same host are kept alive and reused between files. The number of
+  requests and newly opened connections is reported when the downloader
+  exits.
+
+  Downloads that fail with a transient error (a connection problem or a
+  status code listed in #RetryPolicy.transient_status) are attempted again
+  as described by the *retry* policy, continuing the partial file where
+  possible. The *breaker* (a #CircuitBreaker) pauses all workers while a
+  host keeps failing.
+
+  If *checksum* is the name of a #hashlib algorithm, the digest of every
+  downloaded file is computed while it is written. Files submitted with an
+  expected checksum are downloaded again according to the *retry* policy
+  if the digest does not match. If a #Manifest is specified, every download
+  is recorded in it along with its size, validators and checksum.
+
+  If an #AdaptiveConcurrency object is specified as *concurrency*, it
+  limits the number of active transfers (and *num_workers* should be its
+  maximum) and is informed about the responses and received bytes. A
+  #RateLimiter specified as *rate_limiter* is shared by all transfers.
 
-  def __init__(self, num_workers=1, logger=None):
+  Every worker reads responses into a reusable buffer of *buffer_size*
+  bytes. Files of known size are preallocated unless *preallocate* is
+  disabled, and complete files are moved to their final name with
+  #commit_file() (see there for *fsync*).
+
+  If a #DiskBudget is specified as *disk_budget*, every download waits
+  until the size of the file fits into the budget before it starts. For
+  files that are unpacked while they are downloaded, *unpack_ratio* times
+  the compressed size is reserved.
+
+  A request fails with a #requests.Timeout (which is retried like other
+  connection problems) if the connection is not established within
+  *connect_timeout* seconds or no data is received for *read_timeout*
+  seconds, so that a stalled connection does not hang a worker.
+
+  Every finished download is recorded in *metrics* (a #Metrics object).
+  """
+
+  #: Suffix for files that are currently being downloaded.
+  partial_suffix = '.part'
+
+  #: Suffix for the sidecar file that contains the resume information.
+  state_suffix = '.part.json'
+
+  #: Number of bytes after which the resume information is updated.
+  state_interval = PartWriter.state_interval
+
+  def __init__(self, num_workers=1, logger=None, resume=True, segments=1,
+               segment_threshold=64 * 1024 * 1024, checksum=None, manifest=None,
+               retry=None, breaker=None, concurrency=None, rate_limiter=None,
+               buffer_size=256 * 1024, preallocate=True, fsync=False, disk_budget=None,
+               metrics=None, unpack_ratio=3.0, connect_timeout=30.0, read_timeout=60.0):
     self.pool = nr.futures.ThreadPool(num_workers)
     self.logger = logger or logging
+    self.resume = resume
+    self.segments = segments
+    self.segment_threshold = segment_threshold
+    self.checksum = checksum
+    self.retry = retry or RetryPolicy()
+    self.breaker = breaker or CircuitBreaker(logger=self.logger)
+    self.manifest = manifest
+    self.concurrency = concurrency
+    self.rate_limiter = rate_limiter
+    self.buffer_size = buffer_size
+    self.preallocate = preallocate
+    self.fsync = fsync
+    self.disk_budget = disk_budget
+    self.unpack_ratio = unpack_ratio
+    self.timeout = (connect_timeout, read_timeout)
+    self.metrics = metrics
+    self.stats = collections.Counter()
+    self._start_time = time.perf_counter()
+    self._lock = threading.Lock()
+    self._local = threading.local()
+
+  def __count(self, key, n=1):
+    with self._lock:
+      self.stats[key] += n
+
+  def __progress(self, transfer, num_bytes):
+    with self._lock:
+      self.stats['bytes'] += num_bytes
+      transfer.bytes += num_bytes
+    if self.metrics:
+      self.metrics.add_bytes(num_bytes)
+    if self.concurrency:
+      self.concurrency.record_bytes(num_bytes)
 
-  def __download(self, url, ofile, desc, done_callback, future):
+  def __buffer(self):
+    buffer = getattr(self._local, 'buffer', None)
+    if buffer is None:
+      buffer = self._local.buffer = bytearray(self.buffer_size)
+    return buffer
+
+  def __session(self):
+    """
+    Returns the #requests.Session for the current worker thread. Segmented
+    downloads share the session of the worker, thus every session pools
+    up to *segments* connections per host.
+    """
+
+    session = getattr(self._local, 'session', None)
+    if session is None:
+      adapter = _CountingAdapter(self.stats, self._lock, pool_maxsize=max(1, self.segments))
+      session = requests.Session()
+      session.mount('http://', adapter)
+      session.mount('https://', adapter)
+      self._local.session = session
+    return session
+
+  def __get(self, session, url, headers=None):
+    self.__count('requests')
+    tstart = time.perf_counter()
+    response = session.get(url, stream=True, headers=headers, timeout=self.timeout)
+    if self.concurrency:
+      self.concurrency.record_response(response.status_code, time.perf_counter() - tstart)
     try:
-      response = requests.get(url, stream=True)
       response.raise_for_status()
-    except Exception as exc:
-      self.logger.error(exc)
-      if done_callback:
-        done_callback()
-      return
+    except:
+      response.close()
+      raise
+    return response
+
+  def __request(self, session, url, state, validators):
+    if state:
+      headers = resume_headers(state)
+    elif validators:
+      headers = conditional_headers(validators)
+    else:
+      headers = None
+    try:
+      return self.__get(session, url, headers)
+    except requests.HTTPError as exc:
+      # If the range is not satisfiable, the file on the server must have
+      # changed. Start over.
+      if not state or exc.response.status_code != 416:
+        raise
+    return self.__get(session, url)
+
+  def __discard(self, partfile, statefile):
+    for filename in (partfile, statefile):
+      try:
+        remove_file(filename)
+      except OSError as exc:
+        self.logger.error('Could not remove incomplete file "%s": %s', filename, exc)
+
+  def __split(self, size):
+    step = -(-size // self.segments)
+    return [[start, min(start + step, size), 0] for start in range(0, size, step)]
+
+  def __fetch_segments(self, session, url, partfile, statefile, state, resumable, future,
+                       transfer, response=None):
+    """
+    Downloads the byte ranges listed in `state['segments']` concurrently
+    into *partfile*, which must already have its final size. Each segment
+    is a list of `[start, end, received]`. If *response* is specified, it
+    is used for the first segment instead of issuing a new request.
+    """
+
+    lock = threading.Lock()
+    errors = []
+    validator = state['etag'] or state['last_modified']
+
+    def fetch(segment, response):
+      start, end, received = segment
+      ranged = response is None
+      try:
+        if response is None:
+          headers = {'Range': 'bytes={}-{}'.format(start + received, end - 1)}
+          if validator:
+            headers['If-Range'] = validator
+          response = self.__get(session, url, headers)
+          transfer.responded()
+          if response.status_code != 206 or content_range_start(response.headers) != start + received:
+            raise _RangeNotHonored(url)
+        try:
+          with open(partfile, 'r+b') as fp:
+            fp.seek(start + received)
+            next_state_update = received + self.state_interval
+            reported = received
+            try:
+              for chunk in iter_response(response, bytearray(self.buffer_size)):
+                if future.cancelled() or errors:
+                  return
+                chunk = chunk[:end - start - received]
+                fp.write(chunk)
+                received += len(chunk)
+                if self.rate_limiter:
+                  self.rate_limiter.consume(len(chunk))
+                if start + received >= end and not ranged:
+                  # The response is shared with the following segments.
+                  break
+                if resumable and received >= next_state_update:
+                  fp.flush()
+                  with lock:
+                    segment[2] = received
+                    save_state(statefile, state)
+                  next_state_update = received + self.state_interval
+                if received - reported >= PartWriter.progress_interval:
+                  self.__progress(transfer, received - reported)
+                  reported = received
+            finally:
+              fp.flush()
+              self.__progress(transfer, received - reported)
+              segment[2] = received
+        finally:
+          response.close()
+        if start + received < end:
+          # Same as a truncated body of a single stream, so that it is retried.
+          raise requests.exceptions.ChunkedEncodingError(
+            'connection closed after {} of {} bytes'.format(received, end - start))
+      except BaseException as exc:
+        errors.append(exc)
 
-    self.logger.info('Downloading "%s" ...', desc)
-    content_length = response.headers.get('Content-length')
-    if content_length is not None:
-      content_length = int(content_length)
+    threads = []
+    for segment in state['segments']:
+      if segment[0] + segment[2] < segment[1]:
+        thread = threading.Thread(target=fetch, args=(segment, response))
+        thread.start()
+        threads.append(thread)
+      elif response is not None:
+        response.close()
+      response = None
+    for thread in threads:
+      thread.join()
 
-    bytes_read = 0
+    if resumable:
+      save_state(statefile, state)
+    if future.cancelled():
+      raise KeyboardInterrupt
+    if errors:
+      raise errors[0]
+
+  def __transfer(self, url, partfile, statefile, desc, future, unpack, validators, transfer):
+    """
+    Downloads *url* into *partfile*. Keeps *statefile* up to date if the
+    download can be resumed and removes it otherwise. Returns a dictionary
+    with the `size`, `etag`, `last_modified` and `checksum` of the file.
+    """
+
+    session = self.__session()
+    state = resume_state(url, partfile, statefile) if self.resume and not unpack else None
+    if state and state.get('segments'):
+      self.logger.info('Resuming "%s" in %d segments ...', desc, len(state['segments']))
+      try:
+        self.__fetch_segments(session, url, partfile, statefile, state, True, future, transfer)
+        return self.__segments_info(partfile, state)
+      except _RangeNotHonored:
+        self.logger.info('Server did not resume "%s", downloading from the start ...', desc)
+        state = None
+
+    response = self.__request(session, url, state, validators)
+    transfer.responded()
+    if response.status_code == 304:
+      response.close()
+      raise NotModified(url)
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    offset = 0
+    if state:
+      if resume_accepted(state, response.status_code, response.headers):
+        offset = state['bytes']
+        self.logger.info('Resuming "%s" at byte %d ...', desc, offset)
+      else:
+        self.logger.info('Server did not resume "%s", downloading from the start ...', desc)
+
+    state = {'url': url, 'bytes': offset, 'etag': etag, 'last_modified': last_modified}
+    resumable = self.resume and not unpack and bool(etag or last_modified)
+    if resumable:
+      save_state(statefile, state)
+    else:
+      remove_file(statefile)
+
+    size = int(response.headers.get('Content-Length', 0))
+    if self.disk_budget and size:
+      self.disk_budget.update(partfile, int(size * self.unpack_ratio) if unpack else size + offset)
+    if not offset and not unpack and self.segments > 1 and size >= self.segment_threshold \
+        and response.headers.get('Accept-Ranges') == 'bytes':
+      self.logger.info('Downloading "%s" in %d segments ...', desc, self.segments)
+      with open(partfile, 'wb') as fp:
+        fp.truncate(size)
+        if self.preallocate:
+          preallocate(fp, size)
+      state['size'] = size
+      state['segments'] = self.__split(size)
+      self.__fetch_segments(session, url, partfile, statefile, state, resumable, future,
+        transfer, response)
+      return self.__segments_info(partfile, state)
+
+    if not offset:
+      self.logger.info('Downloading "%s" ...', desc)
+    writer = PartWriter(partfile, statefile, state, resumable, unpack, self.checksum,
+      functools.partial(self.__progress, transfer),
+      size + offset if size and self.preallocate else None)
     try:
-      exc = None
-      with open(ofile, 'wb') as fp:
-        for chunk in response.iter_content(chunk_size=1024):
+      with writer:
+        for chunk in iter_response(response, self.__buffer()):
           if future.cancelled():
             self.logger.info('Aborting download "%s"', desc)
             raise KeyboardInterrupt
-          fp.write(chunk)
-          bytes_read += len(chunk)
-    except KeyboardInterrupt:
-      # TODO: Delete ofile
-      if os.path.isfile(ofile):
+          writer.write(chunk)
+          if self.rate_limiter:
+            self.rate_limiter.consume(len(chunk))
+    finally:
+      response.close()
+    return {'size': writer.bytes_read, 'etag': etag, 'last_modified': last_modified,
+      'checksum': writer.checksum}
+
+  def __segments_info(self, partfile, state):
+    # The segments arrive out of order, thus the checksum can only be
+    # computed once the file is complete.
+    checksum = file_hash(partfile, self.checksum).hexdigest() if self.checksum else None
+    return {'size': state['size'], 'etag': state['etag'],
+      'last_modified': state['last_modified'], 'checksum': checksum}
+
+  def __classify(self, exc):
+    """
+    Returns a tuple `(transient, responded, retry_after)` for an exception
+    raised by a transfer.
+    """
+
+    if isinstance(exc, requests.HTTPError):
+      status = exc.response.status_code
+      return (self.retry.is_transient_status(status), status < 500,
+        exc.response.headers.get('Retry-After'))
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout,
+                        requests.exceptions.ChunkedEncodingError)):
+      return True, False, None
+    return False, True, None
+
+  def __sleep(self, seconds, future):
+    deadline = time.monotonic() + seconds
+    while not future.cancelled():
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return
+      time.sleep(min(remaining, 0.5))
+    raise KeyboardInterrupt
+
+  def __attempt(self, url, partfile, statefile, desc, future, unpack, validators,
+                expected_checksum, transfer):
+    transfer.attempt()
+    if self.concurrency:
+      with self.concurrency:
+        info = self.__transfer(url, partfile, statefile, desc, future, unpack, validators,
+          transfer)
+    else:
+      info = self.__transfer(url, partfile, statefile, desc, future, unpack, validators,
+          transfer)
+    try:
+      verify_checksum(info, expected_checksum)
+    except ChecksumError:
+      self.__count('checksum_mismatches')
+      self.__discard(partfile, statefile)
+      raise
+    return info
+
+  def __download(self, url, ofile, desc, done_callback, future, unpack, validators,
+                 expected_checksum, size, reserve):
+    partfile = ofile + self.partial_suffix
+    statefile = ofile + self.state_suffix
+    host = urllib.parse.urlparse(url).netloc
+    reserved = False
+    transfer = self.metrics.begin(url, ofile) if self.metrics else Transfer(url, ofile)
+    result = DownloadResult('aborted', None, None)
+    try:
+      if self.disk_budget and reserve:
+        if unpack and size:
+          size = int(size * self.unpack_ratio)
+        reserved = self.disk_budget.reserve(partfile, size or 0, (partfile, ofile), future.cancelled)
+        if not reserved:
+          raise KeyboardInterrupt
+        transfer.restart()
+      attempt = 0
+      while True:
+        self.__sleep(self.breaker.wait_time(host), future)
         try:
-          os.remove(ofile)
-        except OSError as exc:
-          self.logger.error('Could not remove incomplete file "%s": %s', ofile, exc)
-        else:
-          self.logger.info('Removed incomplete file "%s"', ofile)
-      return
-    except Exception as _exc:
-      exc = _exc
+          info = self.__attempt(url, partfile, statefile, desc, future, unpack, validators,
+            expected_checksum, transfer)
+          self.breaker.success(host)
+          break
+        except ChecksumError as exc:
+          self.breaker.success(host)
+          if attempt >= self.retry.retries:
+            raise
+          error, retry_after = exc, None
+        except NotModified:
+          self.breaker.success(host)
+          raise
+        except Exception as exc:
+          transient, responded, retry_after = self.__classify(exc)
+          if responded and not retry_after:
+            self.breaker.success(host)
+          else:
+            self.breaker.failure(host, retry_after)
+          if not transient or attempt >= self.retry.retries:
+            raise
+          error = exc
+        delay = self.retry.delay(attempt, retry_after)
+        attempt += 1
+        transfer.retries += 1
+        self.__count('retries')
+        self.logger.warning('Downloading "%s" again in %.1fs (retry %d of %d): %s',
+          desc, delay, attempt, self.retry.retries, error)
+        self.__sleep(delay, future)
+      commit_file(partfile, ofile, self.fsync)
+      remove_file(statefile)
+      self.__count('completed')
+      if self.manifest:
+        self.manifest.update(ofile, url, 'complete', **info)
+      result = DownloadResult('complete', info['size'], None)
+    except NotModified:
+      self.__count('unchanged')
+      self.logger.info('Unchanged "%s"', desc)
+      result = DownloadResult('unchanged', None, None)
+    except KeyboardInterrupt:
+      self.__count('aborted')
+      if self.manifest:
+        self.manifest.update(ofile, url, 'incomplete')
+      if os.path.isfile(statefile):
+        self.logger.info('Keeping incomplete file "%s" to resume later', partfile)
+      else:
+        self.__discard(partfile, statefile)
+    except Exception as exc:
+      self.__count('failed')
       self.logger.error(exc)
+      if self.manifest:
+        self.manifest.update(ofile, url, 'failed')
+      if not os.path.isfile(statefile):
+        self.__discard(partfile, statefile)
+      result = DownloadResult('failed', None, str(exc))
     finally:
+      if reserved:
+        self.disk_budget.release(partfile)
+      if self.metrics:
+        self.metrics.finish(transfer, result)
       if done_callback:
         done_callback()
+    return result
 
   def __enter__(self):
     return self
@@ -89,15 +891,46 @@ class BatchDownloader(object):
       self.pool.cancel()
       self.pool.wait()
       raise
+    finally:
+      log_summary(self.logger, self.stats, time.perf_counter() - self._start_time)
 
   def stop(self):
     self.pool.cancel()
     self.pool.shutdown()
 
-  def submit(self, url, ofile, desc=None, done_callback=None):
+  def submit(self, url, ofile, desc=None, done_callback=None, unpack=False,
+             validators=None, checksum=None, size=None, reserve=True):
+    """
+    Queue the download of *url* into *ofile*. The *done_callback* is
+    called without arguments when the download is finished, failed or was
+    aborted. If *unpack* is #True, the gzip-compressed response is
+    decompressed while it is downloaded and only the decompressed data is
+    written to *ofile*.
+
+    If *validators* is a dictionary with the `etag` and `last_modified` of
+    a previous download of the file, a conditional request is sent and the
+    file is left untouched if the server reports that it did not change.
+
+    If *checksum* is specified, it is the expected hex digest of the file
+    (of the compressed data if *unpack* is enabled) computed with the
+    checksum algorithm of the downloader.
+
+    If the *size* of the file is known in advance, it is reserved in the
+    *disk_budget* before the download starts. Otherwise the download waits
+    until the budget is not exceeded and reserves the size announced by the
+    server. If *reserve* is #False, the caller has reserved the space for
+    the download in the *disk_budget* already.
+
+    Returns a future whose result is a #DownloadResult. The future is
+    cancelled if the download was aborted before it started.
+    """
+
+    if checksum and not self.checksum:
+      raise ValueError('no checksum algorithm configured')
     if not desc:
       desc = posixpath.basename(urllib.parse.urlparse(url).path)
     future = nr.futures.Future()
-    future.bind(self.__download, url, ofile, desc, done_callback, future)
+    future.bind(self.__download, url, ofile, desc, done_callback, future, unpack,
+      validators, checksum, size, reserve)
     self.pool.enqueue(future)
     return future
@@ -0,0 +1,626 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Converts CSV parts into a columnar format that can be memory-mapped. Every
+column is stored in its own `.npy` file, thus reading a column needs no
+parsing and touches only the bytes of that column. Null values are stored
+as `0` (or `NaN`, `False` and empty strings) and flagged in a separate bitmap. String
+columns are stored as the concatenated UTF-8 bytes and an array of
+offsets. The `schema.json` file lists the columns and their files.
+
+Requires #numpy.
+"""
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+import collections
+import csv
+import functools
+import gzip
+import json
+import os
+import re
+import struct
+
+import predicate from './predicate'
+import {OrderedResults, ProcessPool, map_ordered} from './procpool'
+
+#: The name of the schema file in a converted directory.
+SCHEMA_FILENAME = 'schema.json'
+
+#: The names of the column types. Other numeric #numpy dtypes can be
+#: specified explicitly.
+TYPES = ('int64', 'float64', 'bool', 'str')
+
+#: Field values that are null.
+NULL_VALUES = ('', 'null', 'NULL')
+
+TRUE_VALUES = ('true', 't', '1')
+FALSE_VALUES = ('false', 'f', '0')
+
+#: The size of the header of the `.npy` files that are written. It is
+#: fixed so that the shape can be updated when the file is complete.
+NPY_HEADER_SIZE = 128
+
+#: The number of rows for which the minimum and maximum value of numeric
+#: columns is recorded.
+BLOCK_ROWS = 64 * 1024
+
+#: A loaded column. *values* is a #numpy.memmap or a #StringColumn, and
+#: *nulls* is a boolean array or #None if the column has no null values.
+#: *stats* is the memory-mapped array of the `min`, `max` and `count` of
+#: every block (see #StatsWriter) or #None.
+Column = collections.namedtuple('Column', 'name type values nulls stats')
+
+
+def require_numpy():
+  """
+  Raises a #RuntimeError if #numpy is not installed.
+  """
+
+  if numpy is None:
+    raise RuntimeError('numpy is required to convert CSV files to columns')
+
+
+def check_type(type):
+  """
+  Raises a #ValueError if *type* is not a valid column type.
+  """
+
+  if type == 'str':
+    return
+  try:
+    dtype = numpy.dtype(type)
+  except TypeError:
+    dtype = None
+  if dtype is None or dtype.kind not in 'biuf':
+    raise ValueError('invalid column type: {!r}'.format(type))
+
+
+def infer_type(values):
+  """
+  Returns the narrowest of the #TYPES that all *values* (strings) can be
+  converted to. Null values are ignored, a column without values is a
+  `float64` column.
+  """
+
+  values = [v for v in values if v not in NULL_VALUES]
+  if not values:
+    return 'float64'
+  try:
+    if all(-2**63 <= int(v) < 2**63 for v in values):
+      return 'int64'
+  except ValueError:
+    pass
+  try:
+    for v in values:
+      float(v)
+    return 'float64'
+  except ValueError:
+    pass
+  if all(v.lower() in TRUE_VALUES + FALSE_VALUES for v in values):
+    return 'bool'
+  return 'str'
+
+
+def open_text(filename):
+  """
+  Opens the CSV file *filename* for reading, decompressing it if it ends
+  with `.gz`.
+  """
+
+  if filename.endswith('.gz'):
+    return gzip.open(filename, 'rt', encoding='utf8', newline='')
+  return open(filename, 'r', encoding='utf8', newline='')
+
+
+def sample_part(filename, num_rows):
+  """
+  Returns the header and the first *num_rows* rows of *filename*.
+  """
+
+  with open_text(filename) as fp:
+    reader = csv.reader(fp)
+    header = next(reader, [])
+    rows = []
+    for row in reader:
+      if len(rows) >= num_rows:
+        break
+      rows.append(row)
+  return header, rows
+
+
+def convert_values(name, type, values):
+  """
+  Converts the strings *values* of the column *name* to *type*. Returns
+  the values as a #numpy array and the null flags (or #None if there are
+  none). The values of `str` columns are returned as an array of the
+  lengths of their UTF-8 encoding and the encoded values joined, null
+  values as empty strings.
+  """
+
+  if type == 'str':
+    nulls = numpy.fromiter((v in NULL_VALUES for v in values), bool, len(values))
+    encoded = [b'' if null else v.encode('utf8') for v, null in zip(values, nulls)]
+    lengths = numpy.fromiter(map(len, encoded), numpy.int64, len(encoded))
+    return (lengths, b''.join(encoded)), (nulls if nulls.any() else None)
+  array = numpy.array(values, dtype=str)
+  nulls = numpy.isin(array, NULL_VALUES)
+  has_nulls = bool(nulls.any())
+  if type == 'bool':
+    array = numpy.char.lower(array)
+    data = numpy.isin(array, TRUE_VALUES)
+    if not (data | nulls | numpy.isin(array, FALSE_VALUES)).all():
+      raise ValueError('column {!r}: not a boolean value'.format(name))
+  else:
+    # Only the values that are not null are parsed; writing a placeholder
+    # into the array would be truncated to the width of its strings.
+    dtype = numpy.dtype(type)
+    data = numpy.full(len(array), numpy.nan if dtype.kind == 'f' else 0, dtype)
+    try:
+      data[~nulls] = array[~nulls].astype(dtype)
+    except (ValueError, OverflowError) as exc:
+      raise ValueError('column {!r}: {}'.format(name, exc))
+  return data, (nulls if has_nulls else None)
+
+
+def parse_part(columns, filename):
+  """
+  Parses the CSV file *filename* whose header must match the names of the
+  *columns*, a list of `(name, type)` tuples. Returns the number of rows
+  and a list with the values and null flags of every column.
+  """
+
+  with open_text(filename) as fp:
+    rows = list(csv.reader(fp))
+  header = rows.pop(0) if rows else []
+  if header != [name for name, type in columns]:
+    raise ValueError('header does not match the first part')
+  for index, row in enumerate(rows):
+    if len(row) != len(header):
+      raise ValueError('line {}: expected {} fields, got {}'.format(
+        index + 2, len(header), len(row)))
+  values = zip(*rows) if rows else [()] * len(columns)
+  result = []
+  for (name, type), column_values in zip(columns, values):
+    try:
+      result.append(convert_values(name, type, column_values))
+    except ValueError as exc:
+      raise ValueError('{} (use --type {}=TYPE)'.format(exc, name))
+  return len(rows), result
+
+
+def _npy_header(dtype, length):
+  header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+    numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)), length)
+  header = header.ljust(NPY_HEADER_SIZE - 11).encode('latin1') + b'\n'
+  return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+
+
+class ArrayWriter(object):
+  """
+  Writes a one-dimensional `.npy` file of *dtype* whose length is not known
+  in advance.
+  """
+
+  def __init__(self, filename, dtype):
+    self.filename = filename
+    self.dtype = numpy.dtype(dtype)
+    self.length = 0
+    self.fp = open(filename, 'wb')
+    self.fp.write(_npy_header(self.dtype, 0))
+
+  def write(self, array):
+    array = numpy.ascontiguousarray(array, self.dtype)
+    self.fp.write(memoryview(array).cast('B'))
+    self.length += len(array)
+
+  def close(self):
+    self.fp.seek(0)
+    self.fp.write(_npy_header(self.dtype, self.length))
+    self.fp.close()
+
+
+class BitmapWriter(object):
+  """
+  Writes a bitmap (with the least significant bit first) of boolean arrays
+  to a `.npy` file of bytes.
+  """
+
+  def __init__(self, filename):
+    self.array = ArrayWriter(filename, numpy.uint8)
+    self.pending = numpy.zeros(0, bool)
+    self.any = False
+
+  def write(self, flags):
+    self.any = self.any or bool(flags.any())
+    flags = numpy.concatenate([self.pending, flags])
+    full = len(flags) // 8 * 8
+    self.array.write(numpy.packbits(flags[:full], bitorder='little'))
+    self.pending = flags[full:]
+
+  def close(self):
+    if len(self.pending):
+      self.array.write(numpy.packbits(self.pending, bitorder='little'))
+    self.array.close()
+
+
+def stats_dtype(dtype):
+  """
+  Returns the structured dtype of the block statistics of a column.
+  """
+
+  return numpy.dtype([('min', dtype), ('max', dtype), ('count', numpy.int64)])
+
+
+def _extremes(dtype):
+  if dtype.kind == 'f':
+    return numpy.inf, -numpy.inf
+  if dtype.kind == 'b':
+    return True, False
+  info = numpy.iinfo(dtype)
+  return info.max, info.min
+
+
+class StatsWriter(object):
+  """
+  Writes the minimum and maximum value and the number of values that are
+  not null or `NaN` (the *count*) of every *block_rows* rows of a numeric
+  column. Blocks without such values have a minimum and maximum of zero.
+  """
+
+  def __init__(self, filename, dtype, block_rows):
+    self.dtype = numpy.dtype(dtype)
+    self.array = ArrayWriter(filename, stats_dtype(self.dtype))
+    self.block_rows = block_rows
+    self.pending = numpy.zeros(0, self.dtype)
+    self.pending_valid = numpy.zeros(0, bool)
+
+  def write(self, values, valid):
+    values = numpy.concatenate([self.pending, values])
+    valid = numpy.concatenate([self.pending_valid, valid])
+    full = len(values) // self.block_rows * self.block_rows
+    self._write_blocks(values[:full], valid[:full])
+    self.pending, self.pending_valid = values[full:], valid[full:]
+
+  def _write_blocks(self, values, valid):
+    if not len(values):
+      return
+    shape = (-1, min(self.block_rows, len(values)))
+    values, valid = values.reshape(shape), valid.reshape(shape)
+    high, low = _extremes(self.dtype)
+    stats = numpy.zeros(len(values), self.array.dtype)
+    stats['count'] = valid.sum(axis=1)
+    empty = stats['count'] == 0
+    stats['min'] = numpy.where(valid, values, high).min(axis=1)
+    stats['max'] = numpy.where(valid, values, low).max(axis=1)
+    stats['min'][empty] = stats['max'][empty] = 0
+    self.array.write(stats)
+
+  def close(self):
+    self._write_blocks(self.pending, self.pending_valid)
+    self.array.close()
+
+
+class ColumnWriter(object):
+  """
+  Writes the files of a column to *directory*, see #parse_part() for the
+  values that are passed to #write().
+  """
+
+  def __init__(self, directory, filename, name, type, block_rows=BLOCK_ROWS):
+    self.directory = directory
+    self.name = name
+    self.type = type
+    self.files = {}
+    path = functools.partial(os.path.join, directory)
+    if type == 'str':
+      self.files['values'] = filename + '.bytes.npy'
+      self.files['offsets'] = filename + '.offsets.npy'
+      self.values = ArrayWriter(path(self.files['values']), numpy.uint8)
+      self.offsets = ArrayWriter(path(self.files['offsets']), numpy.int64)
+      self.offsets.write([0])
+      self.stats = None
+    else:
+      self.files['values'] = filename + '.npy'
+      self.files['stats'] = filename + '.stats.npy'
+      self.values = ArrayWriter(path(self.files['values']), type)
+      self.stats = StatsWriter(path(self.files['stats']), type, block_rows)
+    self.files['nulls'] = filename + '.nulls.npy'
+    self.nulls = BitmapWriter(path(self.files['nulls']))
+
+  def write(self, rows, data, nulls):
+    nulls = numpy.zeros(rows, bool) if nulls is None else nulls
+    self.nulls.write(nulls)
+    if self.type == 'str':
+      lengths, data = data
+      self.offsets.write(numpy.cumsum(lengths) + self.values.length)
+      self.values.write(numpy.frombuffer(data, numpy.uint8))
+    else:
+      self.values.write(data)
+      valid = ~nulls
+      if self.values.dtype.kind == 'f':
+        valid &= ~numpy.isnan(data)
+      self.stats.write(data, valid)
+
+  def close(self):
+    """
+    Completes the files and returns the entry of the column in the schema.
+    """
+
+    self.values.close()
+    self.nulls.close()
+    if self.type == 'str':
+      self.offsets.close()
+    else:
+      self.stats.close()
+    if not self.nulls.any:
+      os.remove(os.path.join(self.directory, self.files.pop('nulls')))
+    entry = {'name': self.name, 'type': self.type}
+    entry.update(self.files)
+    return entry
+
+
+def column_filenames(names):
+  """
+  Returns file names (without suffix) for the column *names*. Names that
+  are not safe to use as file names are replaced by their index.
+  """
+
+  result = []
+  used = set()
+  for index, name in enumerate(names):
+    filename = name
+    if not re.match(r'^[A-Za-z0-9_][A-Za-z0-9_\-]*$', name) or name.lower() in used:
+      filename = 'column_{}'.format(index)
+    used.add(filename.lower())
+    result.append(filename)
+  return result
+
+
+def convert(filenames, directory, types=None, sample_rows=10000, num_workers=None,
+            callback=None, block_rows=BLOCK_ROWS):
+  """
+  Converts the CSV files *filenames* (that all start with the same header)
+  into columns in *directory*. The column types are inferred from the
+  first *sample_rows* rows of the first file unless they are specified in
+  the *types* dictionary. The files are parsed by *num_workers* processes.
+  *callback* is called with the file name and number of rows of every
+  file that has been converted. The minimum and maximum value of every
+  *block_rows* rows of numeric columns are recorded. Returns the schema.
+
+  The schema file is written last, thus an incomplete conversion has none.
+  """
+
+  require_numpy()
+  if block_rows % 8:
+    raise ValueError('block_rows must be a multiple of 8')
+  header, rows = sample_part(filenames[0], sample_rows)
+  if not header:
+    raise ValueError('{}: no header'.format(filenames[0]))
+  types = dict(types or {})
+  unknown = set(types) - set(header)
+  if unknown:
+    raise ValueError('unknown columns: {}'.format(', '.join(sorted(unknown))))
+  for type in types.values():
+    check_type(type)
+  columns = []
+  for index, name in enumerate(header):
+    type = types.get(name) or infer_type(row[index] for row in rows if len(row) == len(header))
+    columns.append((name, type))
+  del rows
+
+  os.makedirs(directory, exist_ok=True)
+  schema_file = os.path.join(directory, SCHEMA_FILENAME)
+  if os.path.exists(schema_file):
+    os.remove(schema_file)
+  writers = [ColumnWriter(directory, filename, name, type, block_rows)
+    for filename, (name, type) in zip(column_filenames(header), columns)]
+
+  total = [0]
+
+  def write(filename, result):
+    length, values = result
+    total[0] += length
+    for writer, (data, nulls) in zip(writers, values):
+      writer.write(length, data, nulls)
+    if callback:
+      callback(filename, length)
+
+  function = functools.partial(parse_part, columns)
+  num_workers = min(num_workers or os.cpu_count() or 1, len(filenames))
+  if num_workers == 1:
+    for filename in filenames:
+      try:
+        result = function(filename)
+      except ValueError as exc:
+        raise ValueError('{}: {}'.format(filename, exc))
+      write(filename, result)
+  else:
+    # Parsed parts are large, thus only a few are kept in memory.
+    results = OrderedResults(str, ValueError)
+    with ProcessPool(function, num_workers, callback=results) as pool:
+      for filename, result in zip(filenames, map_ordered(pool, results, filenames, num_workers + 1)):
+        write(filename, result)
+
+  schema = {
+    'rows': total[0],
+    'block_rows': block_rows,
+    'files': [os.path.basename(f) for f in filenames],
+    'columns': [writer.close() for writer in writers]
+  }
+  with open(schema_file + '.tmp', 'w') as fp:
+    json.dump(schema, fp, indent=2)
+  os.replace(schema_file + '.tmp', schema_file)
+  return schema
+
+
+def read_schema(directory):
+  """
+  Reads the schema of a directory that was written by #convert().
+  """
+
+  with open(os.path.join(directory, SCHEMA_FILENAME)) as fp:
+    return json.load(fp)
+
+
+class StringColumn(object):
+  """
+  The values of a string column, backed by memory-mapped arrays.
+  """
+
+  def __init__(self, offsets, data):
+    self.offsets = offsets
+    self.data = data
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, index):
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError(index)
+    start, end = self.offsets[index:index + 2]
+    return self.data[start:end].tobytes().decode('utf8')
+
+  def __iter__(self):
+    for index in range(len(self)):
+      yield self[index]
+
+  def take(self, indices):
+    """
+    Returns a list of the values at the *indices*.
+    """
+
+    data = self.data
+    offsets = self.offsets
+    return [data[offsets[i]:offsets[i + 1]].tobytes().decode('utf8') for i in indices]
+
+
+def load_column(directory, name, schema=None, unpack_nulls=True):
+  """
+  Loads the column *name* from *directory* as a #Column. The values are
+  memory-mapped, only the null bitmap is read into memory. If *unpack_nulls*
+  is #False, the *nulls* of the column are the memory-mapped bitmap (see
+  #unpack_nulls()).
+  """
+
+  require_numpy()
+  schema = schema or read_schema(directory)
+  for entry in schema['columns']:
+    if entry['name'] == name:
+      break
+  else:
+    raise KeyError(name)
+  load = lambda key: numpy.load(os.path.join(directory, entry[key]), mmap_mode='r')
+  if entry['type'] == 'str':
+    values = StringColumn(load('offsets'), load('values'))
+  else:
+    values = load('values')
+  nulls = entry.get('nulls') and load('nulls')
+  if nulls is not None and unpack_nulls:
+    nulls = unpack_bitmap(nulls, 0, schema['rows'])
+  stats = entry.get('stats') and load('stats')
+  return Column(name, entry['type'], values, nulls, stats)
+
+
+def unpack_bitmap(bitmap, start, end):
+  """
+  Returns the flags of the rows *start* to *end* in *bitmap* as a boolean
+  array. *start* must be a multiple of 8.
+  """
+
+  assert start % 8 == 0, start
+  bits = bitmap[start // 8:(end + 7) // 8]
+  return numpy.unpackbits(bits, count=end - start, bitorder='little').view(bool)
+
+
+def filter_blocks(directory, node, names, schema=None):
+  """
+  Finds the rows in *directory* that match the #predicate *node* and yields
+  the values of the columns *names* for them, block by block. For every
+  block with matches, a list of `(values, nulls)` tuples is yielded where
+  *values* is a list and *nulls* a boolean array or #None.
+
+  Blocks that can not contain matches according to the minimum and maximum
+  values of the columns are skipped without reading them. Otherwise, the
+  columns of the predicate are read as needed, and the columns *names*
+  only for the rows that match.
+  """
+
+  require_numpy()
+  schema = schema or read_schema(directory)
+  known = set(entry['name'] for entry in schema['columns'])
+  unknown = [n for n in list(names) + list(predicate.column_values(node)) if n not in known]
+  if unknown:
+    raise ValueError('unknown columns: {}'.format(', '.join(sorted(set(unknown)))))
+  block_rows = schema.get('block_rows', BLOCK_ROWS)
+  columns = {}
+
+  def column(name):
+    if name not in columns:
+      columns[name] = load_column(directory, name, schema, unpack_nulls=False)
+    return columns[name]
+
+  def nulls(col, start, end, rows=None):
+    if col.nulls is None:
+      return None
+    flags = unpack_bitmap(col.nulls, start, end)
+    return flags if rows is None else flags[rows]
+
+  for index, start in enumerate(range(0, schema['rows'], block_rows)):
+    end = min(start + block_rows, schema['rows'])
+
+    def get_stats(name):
+      stats = column(name).stats
+      if stats is None or index >= len(stats):
+        return None
+      return stats['min'][index], stats['max'][index], stats['count'][index]
+
+    if not predicate.may_match(node, get_stats):
+      continue
+
+    cache = {}
+    def get_column(name):
+      if name not in cache:
+        col = column(name)
+        if col.type == 'str':
+          values = numpy.array(col.values.take(range(start, end)), dtype=str)
+        else:
+          values = col.values[start:end]
+        cache[name] = (values, nulls(col, start, end))
+      return cache[name]
+
+    rows = numpy.flatnonzero(predicate.evaluate(node, get_column))
+    if not len(rows):
+      continue
+    result = []
+    for name in names:
+      col = column(name)
+      if col.type == 'str':
+        values = col.values.take(rows + start)
+      else:
+        values = col.values[start:end][rows].tolist()
+      result.append((values, nulls(col, start, end, rows)))
+    yield result
@@ -0,0 +1,177 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Adaptive control of the number of concurrent downloads.
+"""
+
+import logging
+import threading
+import time
+
+import {format_size} from './units'
+
+
+def parse_parallel(value):
+  """
+  Parses the value of a `--parallel` option, which is either a number or
+  `auto`.
+  """
+
+  if value == 'auto':
+    return value
+  value = int(value)
+  if value < 1:
+    raise ValueError('expected a positive number or "auto"')
+  return value
+
+
+class AdaptiveConcurrency(object):
+  """
+  Limits the number of concurrent transfers to #limit, which is adjusted
+  between *minimum* and *maximum* every *interval* seconds with an AIMD
+  policy based on the observations reported by the downloader:
+
+  * If the server throttled us (HTTP 429 or 5xx) or the average time to
+    first byte exceeds *latency_tolerance* times the lowest average seen
+    so far, the limit is multiplied by *decrease_factor*.
+  * If the previous increase made the throughput drop by more than 10%,
+    the increase is undone.
+  * Otherwise, if all slots were in use, the limit is increased by one.
+
+  Use the object as a context manager (or #acquire() and #release()) around
+  every transfer.
+  """
+
+  def __init__(self, minimum, maximum, interval=5.0, decrease_factor=0.5,
+               latency_tolerance=3.0, logger=None):
+    if minimum < 1 or maximum < minimum:
+      raise ValueError('invalid concurrency range: {}..{}'.format(minimum, maximum))
+    self.minimum = minimum
+    self.maximum = maximum
+    self.interval = interval
+    self.decrease_factor = decrease_factor
+    self.latency_tolerance = latency_tolerance
+    self.logger = logger or logging
+    self.limit = minimum
+    self.active = 0
+    self._cond = threading.Condition()
+    self._base_latency = None
+    self._last_throughput = None
+    self._last_change = 0
+    self.__reset_window(time.perf_counter())
+
+  def __reset_window(self, now):
+    self._window_start = now
+    self._bytes = 0
+    self._responses = 0
+    self._latency = 0.0
+    self._throttled = 0
+    self._saturated = self.active >= self.limit
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, *args):
+    self.release()
+
+  def acquire(self):
+    with self._cond:
+      while self.active >= self.limit:
+        self._saturated = True
+        self._cond.wait()
+      self.active += 1
+      if self.active >= self.limit:
+        self._saturated = True
+
+  def try_acquire(self):
+    """
+    Like #acquire() but returns #False instead of blocking.
+    """
+
+    with self._cond:
+      if self.active >= self.limit:
+        self._saturated = True
+        return False
+      self.active += 1
+      if self.active >= self.limit:
+        self._saturated = True
+      return True
+
+  def release(self):
+    with self._cond:
+      self.active -= 1
+      self._cond.notify()
+
+  def record_response(self, status, latency):
+    """
+    Report the HTTP *status* of a response and the *latency* in seconds
+    until its headers were received.
+    """
+
+    with self._cond:
+      self._responses += 1
+      self._latency += latency
+      if status == 429 or status >= 500:
+        self._throttled += 1
+      self.__maybe_update()
+
+  def record_bytes(self, num_bytes):
+    with self._cond:
+      self._bytes += num_bytes
+      self.__maybe_update()
+
+  def __maybe_update(self):
+    now = time.perf_counter()
+    elapsed = now - self._window_start
+    if elapsed < self.interval:
+      return
+
+    throughput = self._bytes / elapsed
+    latency = self._latency / self._responses if self._responses else None
+    if latency is not None and (self._base_latency is None or latency < self._base_latency):
+      self._base_latency = latency
+
+    limit = self.limit
+    if self._throttled:
+      limit = int(limit * self.decrease_factor)
+      reason = 'server throttled {} requests'.format(self._throttled)
+    elif latency is not None and latency > self._base_latency * self.latency_tolerance:
+      limit = int(limit * self.decrease_factor)
+      reason = 'latency increased'
+    elif self._last_change > 0 and self._last_throughput and throughput < self._last_throughput * 0.9:
+      limit -= 1
+      reason = 'throughput decreased'
+    elif self._saturated:
+      limit += 1
+      reason = 'all slots in use'
+    limit = max(self.minimum, min(self.maximum, limit))
+
+    if limit != self.limit:
+      self.logger.info('Adjusting concurrency from %d to %d (%s, %s/s, %s)',
+        self.limit, limit, reason, format_size(int(throughput)),
+        'latency {:.0f}ms'.format(latency * 1000) if latency is not None else 'no responses')
+      self._last_change = limit - self.limit
+      self.limit = limit
+      self._cond.notify_all()
+    else:
+      self._last_change = 0
+    self._last_throughput = throughput
+    self.__reset_window(now)
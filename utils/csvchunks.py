@@ -0,0 +1,190 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Processes large uncompressed CSV files in parallel. The file is mapped into
+memory, split into chunks that start at the beginning of a row, and the
+chunks are processed by a #ProcessPool. The results are returned in the
+order of the chunks.
+"""
+
+import collections
+import csv
+import functools
+import io
+import mmap
+import os
+
+import {OrderedResults, ProcessPool, WorkerError, map_ordered} from './procpool'
+
+#: A byte range of a file that contains whole rows.
+Chunk = collections.namedtuple('Chunk', 'index start end')
+
+#: The default size of a chunk in bytes.
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class ChunkError(WorkerError):
+  """
+  Raised by #map_chunks() if processing a chunk failed.
+  """
+
+
+def open_map(filename):
+  """
+  Returns a read-only #mmap.mmap of *filename*, or #None if it is empty.
+  """
+
+  with open(filename, 'rb') as fp:
+    try:
+      return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+      return None
+
+
+def read_header(filename):
+  """
+  Returns the fields of the first row of the CSV file *filename* and the
+  offset of the second row.
+  """
+
+  with open(filename, 'rb') as fp:
+    line = fp.readline()
+    return next(csv.reader([line.decode('utf8')]), []), fp.tell()
+
+
+def decode_rows(data):
+  """
+  Returns a #csv.reader for the rows in the bytes-like *data*.
+  """
+
+  return csv.reader(io.StringIO(str(data, 'utf8'), newline=''))
+
+
+def row_start(data, pos, in_quotes):
+  """
+  Returns the offset of the first row that starts at or after *pos* in
+  *data*. *in_quotes* tells whether *pos* is inside a quoted field; if it
+  is #None, quotes are ignored.
+  """
+
+  while True:
+    newline = data.find(b'\n', pos)
+    if newline < 0:
+      return len(data)
+    if in_quotes is not None:
+      in_quotes ^= data[pos:newline].count(b'"') % 2 == 1
+    if not in_quotes:
+      return newline + 1
+    pos = newline + 1
+
+
+def split_chunks(data, begin, chunk_size, quote_counts=None):
+  """
+  Splits *data* from *begin* to its end into chunks of about *chunk_size*
+  bytes that start at the beginning of a row. If *quote_counts* contains
+  the number of `"` characters in every *chunk_size* block from *begin*,
+  newlines in quoted fields are not mistaken for the end of a row.
+  """
+
+  size = len(data)
+  bounds = [begin]
+  quotes = 0
+  for index, target in enumerate(range(begin + chunk_size, size, chunk_size)):
+    in_quotes = None
+    if quote_counts is not None:
+      quotes += quote_counts[index]
+      in_quotes = quotes % 2 == 1
+    start = row_start(data, target, in_quotes)
+    if bounds[-1] < start < size:
+      bounds.append(start)
+  bounds.append(size)
+  return [Chunk(i, bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+_maps = {}
+
+def _worker(filename, function, item):
+  data = _maps.get(filename)
+  if data is None:
+    data = _maps[filename] = open_map(filename)
+  # Classes defined in Node.py modules can not be pickled, thus the items
+  # are plain tuples.
+  kind, chunk = item[0], Chunk(*item[1:])
+  if kind == 'quotes':
+    return data[chunk.start:chunk.end].count(b'"')
+  with memoryview(data) as view:
+    return function(view[chunk.start:chunk.end], chunk)
+
+
+def _describe(item):
+  return 'chunk {} (bytes {}-{})'.format(*item[1:])
+
+
+def map_chunks(filename, function, num_workers=None, chunk_size=DEFAULT_CHUNK_SIZE,
+               skip_header=True, quoted_newlines=True):
+  """
+  Calls `function(data, chunk)` for every #Chunk of the CSV file *filename*
+  in a pool of *num_workers* processes and yields the results in the order
+  of the chunks. *data* is a #memoryview of the rows of the chunk (see
+  #decode_rows()). The *function* is not pickled, but the results must be.
+
+  The first row is not part of any chunk if *skip_header* is #True. Unless
+  *quoted_newlines* is disabled, the number of quotes in the whole file is
+  counted first (in parallel) so that quoted fields may contain newlines.
+  Raises a #ChunkError if the *function* raised an exception.
+  """
+
+  begin = read_header(filename)[1] if skip_header else 0
+  data = open_map(filename)
+  if data is None:
+    return
+  try:
+    if num_workers == 1 or len(data) - begin <= chunk_size:
+      counts = None
+      if quoted_newlines:
+        counts = [data[start:start + chunk_size].count(b'"')
+          for start in range(begin, len(data), chunk_size)]
+      for chunk in split_chunks(data, begin, chunk_size, counts):
+        with memoryview(data) as view:
+          yield function(view[chunk.start:chunk.end], chunk)
+      return
+
+    num_workers = num_workers or os.cpu_count() or 1
+    results = OrderedResults(_describe, ChunkError)
+    pool = ProcessPool(functools.partial(_worker, filename, function), num_workers,
+      callback=results)
+    try:
+      max_pending = 2 * num_workers
+      counts = None
+      if quoted_newlines:
+        blocks = [('quotes', i, start, min(start + chunk_size, len(data)))
+          for i, start in enumerate(range(begin, len(data), chunk_size))]
+        counts = list(map_ordered(pool, results, blocks, max_pending))
+      chunks = [('chunk',) + tuple(chunk) for chunk in split_chunks(data, begin, chunk_size, counts)]
+      for result in map_ordered(pool, results, chunks, max_pending):
+        yield result
+    except BaseException:
+      pool.terminate()
+      raise
+    else:
+      pool.close()
+  finally:
+    data.close()
@@ -0,0 +1,179 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Limiting the disk space that a download job uses.
+"""
+
+import logging
+import os
+import struct
+import threading
+import time
+
+import {format_size} from './units'
+
+
+def _file_size(path):
+  try:
+    return os.path.getsize(path)
+  except OSError:
+    return 0
+
+
+def directory_size(directory):
+  """
+  Returns a dictionary that maps the path of every file below *directory*
+  to its size.
+  """
+
+  sizes = {}
+  for root, dirs, files in os.walk(directory):
+    for name in files:
+      path = os.path.join(root, name)
+      try:
+        sizes[path] = os.path.getsize(path)
+      except OSError:
+        pass
+  return sizes
+
+
+def gzip_size(filename):
+  """
+  Returns the uncompressed size of a gzip file from its trailer. The size
+  is stored modulo 4 GiB, thus it is only a lower bound for larger files.
+  """
+
+  with open(filename, 'rb') as fp:
+    fp.seek(-4, os.SEEK_END)
+    return struct.unpack('<I', fp.read(4))[0]
+
+
+class DiskBudget(object):
+  """
+  Keeps the files below *directory* and the files that are being written
+  there under *budget* bytes. Before a file is written, its expected size
+  is reserved with #reserve(), which blocks until the reservation fits into
+  the budget. When the file is complete, #release() drops the reservation
+  and accounts for the change in size of the files passed to #reserve().
+
+  The files on disk are counted when the budget is created and every
+  *rescan_interval* seconds while a reservation is waiting, so that space
+  freed by other processes (for example a hook that moves finished files
+  elsewhere) is noticed. A file that is larger than the whole budget is
+  admitted when nothing else is reserved, otherwise it could never be
+  written.
+  """
+
+  def __init__(self, budget, directory, rescan_interval=5.0, logger=None):
+    self.budget = budget
+    self.directory = directory
+    self.rescan_interval = rescan_interval
+    self.logger = logger or logging
+    self.reserved = {}
+    self._files = {}
+    self._cond = threading.Condition()
+    self.__rescan()
+
+  def __rescan(self):
+    # The files of a reservation are counted with the size they had when it
+    # was made, #release() accounts for the change.
+    snapshot = {}
+    for files in self._files.values():
+      for path, size in files.items():
+        snapshot[os.path.abspath(path)] = size
+    keys = set(map(os.path.abspath, self.reserved))
+    sizes = directory_size(self.directory)
+    self.on_disk = sum(snapshot.values()) + sum(size for path, size in sizes.items()
+      if os.path.abspath(path) not in keys and os.path.abspath(path) not in snapshot)
+    self._last_scan = time.monotonic()
+
+  @property
+  def used(self):
+    return self.on_disk + sum(self.reserved.values())
+
+  def __fits(self, size):
+    if self.used + size <= self.budget:
+      return True
+    return not self.reserved and size > self.budget
+
+  def try_reserve(self, key, size, files=None):
+    """
+    Reserves *size* bytes for the file *key* if they fit into the budget
+    and returns #True, otherwise returns #False. The *files* (by default
+    only *key*) are the files that are created, changed or deleted by the
+    operation for which the space is reserved.
+    """
+
+    with self._cond:
+      if not self.__fits(size) and time.monotonic() - self._last_scan >= self.rescan_interval:
+        self.__rescan()
+      if not self.__fits(size):
+        return False
+      self.reserved[key] = size
+      self._files[key] = {path: _file_size(path) for path in (files or [key])}
+      return True
+
+  def reserve(self, key, size, files=None, cancelled=None):
+    """
+    Blocks until *size* bytes for the file *key* fit into the budget and
+    reserves them (see #try_reserve()). Returns #False without reserving
+    anything if the function *cancelled* returns #True while waiting.
+    """
+
+    with self._cond:
+      logged = False
+      while not self.try_reserve(key, size, files):
+        if cancelled and cancelled():
+          return False
+        if not logged:
+          self.logger.info('Waiting for %s of disk space for "%s" (%s of %s used) ...',
+            format_size(size), os.path.basename(key), format_size(self.used),
+            format_size(self.budget))
+          logged = True
+        self._cond.wait(1)
+      return True
+
+  def update(self, key, size, files=None):
+    """
+    Changes the reservation for *key* to *size* bytes once the actual size
+    of the file is known. Does not block, even if the budget is exceeded.
+    If *files* are specified, their current size is the size from which the
+    change is computed by #release().
+    """
+
+    with self._cond:
+      if key in self.reserved:
+        self.reserved[key] = size
+        if files is not None:
+          self._files[key] = {path: _file_size(path) for path in files}
+      self._cond.notify_all()
+
+  def release(self, key):
+    """
+    Drops the reservation for *key* and adds the change in size of the
+    files of the reservation to the bytes on disk.
+    """
+
+    with self._cond:
+      self.reserved.pop(key, None)
+      for path, size in self._files.pop(key, {}).items():
+        self.on_disk += _file_size(path) - size
+      self.on_disk = max(0, self.on_disk)
+      self._cond.notify_all()
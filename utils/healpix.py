@@ -0,0 +1,165 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+A few functions for the HEALPix tessellation of the sphere in the nested
+scheme, as used by the Gaia `source_id`. #healpy is used if it is
+installed, otherwise the functions fall back to a pure Python
+implementation that is exact for the pixel centers and conservative for
+disc queries.
+"""
+
+try:
+  import healpy
+except ImportError:
+  healpy = None
+
+import math
+
+# The row and column of the twelve base pixels.
+_jrll = (2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4)
+_jpll = (1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7)
+
+#: The maximum angular distance of a pixel corner from the pixel center,
+#: in multiples of the square root of the mean pixel area. It approaches
+#: 1.0446 for large orders.
+MAX_PIXRAD_FACTOR = 1.1
+
+
+def npix(order):
+  """
+  Returns the number of pixels at *order*.
+  """
+
+  return 12 << (2 * order)
+
+
+def max_pixrad(order):
+  """
+  Returns an upper bound of the angular radius (in radians) of a pixel at
+  *order*.
+  """
+
+  nside = 1 << order
+  if healpy is not None:
+    return healpy.max_pixrad(nside)
+  return MAX_PIXRAD_FACTOR * math.sqrt(4 * math.pi / npix(order))
+
+
+def _compress_bits(value):
+  # Every second bit of value, starting with the lowest.
+  result = 0
+  bit = 0
+  while value:
+    result |= (value & 1) << bit
+    value >>= 2
+    bit += 1
+  return result
+
+
+def pix2vec(order, pix):
+  """
+  Returns the unit vector of the center of the nested pixel *pix* at
+  *order*.
+  """
+
+  nside = 1 << order
+  npface = nside * nside
+  face, ipf = divmod(pix, npface)
+  ix, iy = _compress_bits(ipf), _compress_bits(ipf >> 1)
+  jr = _jrll[face] * nside - ix - iy - 1
+  fact2 = 4.0 / npix(order)
+  if jr < nside:
+    nr, z, kshift = jr, 1 - jr * jr * fact2, 0
+  elif jr > 3 * nside:
+    nr = 4 * nside - jr
+    z, kshift = nr * nr * fact2 - 1, 0
+  else:
+    nr = nside
+    z, kshift = (2 * nside - jr) * 2.0 / (3 * nside), (jr - nside) & 1
+  jp = (_jpll[face] * nr + ix - iy + 1 + kshift) // 2
+  if jp > 4 * nside:
+    jp -= 4 * nside
+  if jp < 1:
+    jp += 4 * nside
+  phi = (jp - (kshift + 1) * 0.5) * (math.pi / 2 / nr)
+  sin_theta = math.sqrt(max(0.0, 1 - z * z))
+  return (sin_theta * math.cos(phi), sin_theta * math.sin(phi), z)
+
+
+def ang2vec(ra, dec):
+  """
+  Returns the unit vector of the right ascension *ra* and declination
+  *dec* (in degrees).
+  """
+
+  ra, dec = math.radians(ra), math.radians(dec)
+  return (math.cos(dec) * math.cos(ra), math.cos(dec) * math.sin(ra), math.sin(dec))
+
+
+def angle(a, b):
+  """
+  Returns the angle between the unit vectors *a* and *b* in radians.
+  """
+
+  dot = sum(x * y for x, y in zip(a, b))
+  return math.acos(max(-1.0, min(1.0, dot)))
+
+
+def query_disc(order, ra, dec, radius):
+  """
+  Returns the sorted list of the nested pixels at *order* that overlap the
+  disc around *ra* and *dec* with *radius* (all in degrees). The result may
+  contain a few pixels that are close to the disc but do not overlap it.
+  """
+
+  vec = ang2vec(ra, dec)
+  radius = math.radians(radius)
+  if healpy is not None:
+    return sorted(int(p) for p in healpy.query_disc(1 << order, vec, radius,
+      inclusive=True, nest=True))
+  # Descend from the base pixels into the children of the pixels that are
+  # close enough to overlap the disc.
+  pixels = range(12)
+  for level in range(order + 1):
+    limit = radius + max_pixrad(level)
+    pixels = [p for p in pixels if angle(pix2vec(level, p), vec) <= limit]
+    if level < order:
+      pixels = [(p << 2) + i for p in pixels for i in range(4)]
+  return sorted(pixels)
+
+
+def pixel_ranges(order, pixels, target_order):
+  """
+  Converts the nested *pixels* at *order* to a sorted list of half-open
+  ranges of pixels at the higher *target_order*. Adjacent ranges are
+  merged.
+  """
+
+  shift = 2 * (target_order - order)
+  if shift < 0:
+    raise ValueError('order {} is higher than {}'.format(order, target_order))
+  ranges = []
+  for pix in sorted(pixels):
+    start, end = pix << shift, (pix + 1) << shift
+    if ranges and ranges[-1][1] >= start:
+      ranges[-1][1] = max(ranges[-1][1], end)
+    else:
+      ranges.append([start, end])
+  return [tuple(r) for r in ranges]
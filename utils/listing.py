@@ -0,0 +1,108 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Retrieves the links of HTML directory listings and caches them on disk.
+"""
+
+import codecs
+import hashlib
+import html.parser
+import json
+import logging
+import os
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache_dir():
+  """
+  Returns the directory in which dtools caches data, usually
+  `~/.cache/dtools`.
+  """
+
+  base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(base, 'dtools')
+
+
+class HrefParser(html.parser.HTMLParser):
+  """
+  Collects the `href` attribute of all `<a>` tags of an HTML document that
+  is fed to the parser incrementally.
+  """
+
+  def __init__(self):
+    html.parser.HTMLParser.__init__(self)
+    self.hrefs = []
+
+  def handle_starttag(self, tag, attrs):
+    if tag == 'a':
+      for key, value in attrs:
+        if key == 'href' and value:
+          self.hrefs.append(value)
+
+
+def fetch_links(url, cache_dir=None, session=None):
+  """
+  Returns the `href` of every link in the HTML page at *url*. The links are
+  cached in *cache_dir* (defaults to a `listings` folder in #get_cache_dir())
+  together with the ETag and Last-Modified headers of the response. If a
+  cached listing exists, it is revalidated with a conditional request and
+  returned as is if the server responds with `304 Not Modified`.
+  """
+
+  if cache_dir is None:
+    cache_dir = os.path.join(get_cache_dir(), 'listings')
+  cache_file = os.path.join(cache_dir, hashlib.sha1(url.encode('utf8')).hexdigest() + '.json')
+  try:
+    with open(cache_file) as fp:
+      cached = json.load(fp)
+  except (OSError, ValueError):
+    cached = None
+
+  headers = {}
+  if cached and cached['etag']:
+    headers['If-None-Match'] = cached['etag']
+  if cached and cached['last_modified']:
+    headers['If-Modified-Since'] = cached['last_modified']
+
+  response = (session or requests).get(url, headers=headers, stream=True)
+  with response:
+    response.raise_for_status()
+    if cached and response.status_code == 304:
+      logger.debug('Using cached listing of "%s"', url)
+      return cached['hrefs']
+
+    parser = HrefParser()
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf8')(errors='replace')
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+      parser.feed(decoder.decode(chunk))
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+
+  etag = response.headers.get('ETag')
+  last_modified = response.headers.get('Last-Modified')
+  if etag or last_modified:
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_file + '.tmp', 'w') as fp:
+      json.dump({'url': url, 'etag': etag, 'last_modified': last_modified,
+        'hrefs': parser.hrefs}, fp)
+    os.replace(cache_file + '.tmp', cache_file)
+  return parser.hrefs
@@ -0,0 +1,112 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+A persistent record of the files downloaded into a directory.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+
+class Manifest(object):
+  """
+  An SQLite database in *directory* that records the URL, size, ETag,
+  Last-Modified date, checksum and state of every file that was downloaded
+  into that directory. The state is one of `complete`, `incomplete` or
+  `failed`. Files are identified by their path relative to *directory*.
+
+  All entries are loaded into memory when the manifest is opened, thus
+  checking whether a file is complete does not touch the filesystem.
+  Updates are committed at most every *commit_interval* seconds and when
+  the manifest is closed.
+  """
+
+  #: The name of the database file in the download directory.
+  filename = '.dtools-manifest.db'
+
+  columns = ('name', 'url', 'state', 'size', 'etag', 'last_modified', 'checksum')
+
+  def __init__(self, directory, commit_interval=1.0):
+    self.directory = directory
+    self.commit_interval = commit_interval
+    self._lock = threading.Lock()
+    self._last_commit = time.perf_counter()
+    self._db = sqlite3.connect(os.path.join(directory, self.filename), check_same_thread=False)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.execute('''
+      CREATE TABLE IF NOT EXISTS files (
+        name TEXT PRIMARY KEY,
+        url TEXT NOT NULL,
+        state TEXT NOT NULL,
+        size INTEGER,
+        etag TEXT,
+        last_modified TEXT,
+        checksum TEXT,
+        updated REAL NOT NULL
+      )''')
+    self._db.commit()
+    query = 'SELECT {} FROM files'.format(', '.join(self.columns))
+    self._entries = {row[0]: dict(zip(self.columns, row)) for row in self._db.execute(query)}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __name(self, filename):
+    return os.path.relpath(filename, self.directory)
+
+  def get(self, filename):
+    """
+    Returns the entry of *filename* as a dictionary or #None.
+    """
+
+    return self._entries.get(self.__name(filename))
+
+  def is_complete(self, filename):
+    entry = self.get(filename)
+    return entry is not None and entry['state'] == 'complete'
+
+  def update(self, filename, url, state, size=None, etag=None, last_modified=None, checksum=None):
+    """
+    Records the *state* of the download of *url* into *filename*.
+    """
+
+    entry = {'name': self.__name(filename), 'url': url, 'state': state, 'size': size,
+      'etag': etag, 'last_modified': last_modified, 'checksum': checksum}
+    with self._lock:
+      self._entries[entry['name']] = entry
+      self._db.execute(
+        'INSERT OR REPLACE INTO files ({}, updated) VALUES ({}?)'.format(
+          ', '.join(self.columns), '?, ' * len(self.columns)),
+        [entry[k] for k in self.columns] + [time.time()])
+      now = time.perf_counter()
+      if now - self._last_commit >= self.commit_interval:
+        self._db.commit()
+        self._last_commit = now
+
+  def close(self):
+    with self._lock:
+      self._db.commit()
+      self._db.close()
@@ -0,0 +1,226 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Per-transfer metrics of a download job as JSON Lines and aggregate
+counters in the Prometheus text format.
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+
+class Transfer(object):
+  """
+  The measurements of a single download. Created with #Metrics.begin() and
+  filled in by the download engine.
+  """
+
+  __slots__ = ('url', 'filename', 'started', 'start', 'attempt_start', 'first_byte',
+               'bytes', 'retries')
+
+  def __init__(self, url, filename):
+    self.url = url
+    self.filename = filename
+    self.started = time.time()
+    self.start = time.perf_counter()
+    self.attempt_start = self.start
+    self.first_byte = None
+    self.bytes = 0
+    self.retries = 0
+
+  def restart(self):
+    """
+    Resets the start time, for example after waiting for disk space.
+    """
+
+    self.started = time.time()
+    self.start = time.perf_counter()
+
+  def attempt(self):
+    """
+    Called when an attempt to download the file starts. The time to first
+    byte is measured for the last attempt.
+    """
+
+    self.attempt_start = time.perf_counter()
+    self.first_byte = None
+
+  def responded(self):
+    """
+    Called when the first response of the current attempt arrived.
+    """
+
+    if self.first_byte is None:
+      self.first_byte = time.perf_counter()
+
+
+class Metrics(object):
+  """
+  Writes one JSON object per finished download to *filename* with its time
+  to first byte, duration, number of received bytes, throughput, retries
+  and final status. If *textfile* is specified, aggregate counters are
+  written to it in the Prometheus text format every *interval* seconds and
+  when the metrics are closed, for example into the directory of the
+  node_exporter textfile collector.
+
+  The download engines report the received bytes with #add_bytes() at the
+  same granularity as their progress, not for every chunk.
+  """
+
+  #: Prefix of the names of the aggregate metrics.
+  prefix = 'bulk_download'
+
+  def __init__(self, filename=None, textfile=None, interval=15.0):
+    self.filename = filename
+    self.textfile = textfile
+    self.interval = interval
+    self.counts = collections.Counter()
+    self.bytes = 0
+    self.retries = 0
+    self.active = 0
+    self.duration = 0.0
+    self.ttfb = 0.0
+    self.ttfb_count = 0
+    self._lock = threading.Lock()
+    self._fp = open(filename, 'a') if filename else None
+    self._stop = threading.Event()
+    self._thread = None
+    if textfile:
+      self._thread = threading.Thread(target=self.__run, daemon=True)
+      self._thread.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __run(self):
+    while not self._stop.wait(self.interval):
+      self.write_textfile()
+
+  def begin(self, url, filename):
+    """
+    Returns a new #Transfer for the download of *url* into *filename*.
+    """
+
+    with self._lock:
+      self.active += 1
+    return Transfer(url, filename)
+
+  def add_bytes(self, num_bytes):
+    with self._lock:
+      self.bytes += num_bytes
+
+  def finish(self, transfer, result):
+    """
+    Records the *transfer* with its #DownloadResult.
+    """
+
+    duration = time.perf_counter() - transfer.start
+    ttfb = None
+    if transfer.first_byte is not None:
+      ttfb = transfer.first_byte - transfer.attempt_start
+    record = {
+      'time': transfer.started,
+      'url': transfer.url,
+      'file': transfer.filename,
+      'status': result.status,
+      'size': result.size,
+      'bytes': transfer.bytes,
+      'ttfb': None if ttfb is None else round(ttfb, 6),
+      'duration': round(duration, 6),
+      'throughput': round(transfer.bytes / duration) if duration > 0 else None,
+      'retries': transfer.retries,
+      'error': result.error,
+    }
+    with self._lock:
+      self.active -= 1
+      self.counts[result.status] += 1
+      self.retries += transfer.retries
+      self.duration += duration
+      if ttfb is not None:
+        self.ttfb += ttfb
+        self.ttfb_count += 1
+      if self._fp:
+        self._fp.write(json.dumps(record) + '\n')
+        self._fp.flush()
+
+  def format_textfile(self):
+    """
+    Returns the aggregate counters in the Prometheus text format.
+    """
+
+    p = self.prefix
+    with self._lock:
+      lines = [
+        '# HELP {}_transfers_total Finished downloads by status.'.format(p),
+        '# TYPE {}_transfers_total counter'.format(p),
+      ]
+      for status in sorted(self.counts):
+        lines.append('{}_transfers_total{{status="{}"}} {}'.format(p, status, self.counts[status]))
+      lines += [
+        '# HELP {}_active_transfers Downloads that are in progress.'.format(p),
+        '# TYPE {}_active_transfers gauge'.format(p),
+        '{}_active_transfers {}'.format(p, self.active),
+        '# HELP {}_received_bytes_total Bytes received from the server.'.format(p),
+        '# TYPE {}_received_bytes_total counter'.format(p),
+        '{}_received_bytes_total {}'.format(p, self.bytes),
+        '# HELP {}_retries_total Download attempts that were repeated.'.format(p),
+        '# TYPE {}_retries_total counter'.format(p),
+        '{}_retries_total {}'.format(p, self.retries),
+        '# HELP {}_duration_seconds Duration of finished downloads.'.format(p),
+        '# TYPE {}_duration_seconds summary'.format(p),
+        '{}_duration_seconds_sum {:.6f}'.format(p, self.duration),
+        '{}_duration_seconds_count {}'.format(p, sum(self.counts.values())),
+        '# HELP {}_ttfb_seconds Time until the first response of a download.'.format(p),
+        '# TYPE {}_ttfb_seconds summary'.format(p),
+        '{}_ttfb_seconds_sum {:.6f}'.format(p, self.ttfb),
+        '{}_ttfb_seconds_count {}'.format(p, self.ttfb_count),
+        '# HELP {}_last_update_timestamp_seconds Time of this snapshot.'.format(p),
+        '# TYPE {}_last_update_timestamp_seconds gauge'.format(p),
+        '{}_last_update_timestamp_seconds {:.3f}'.format(p, time.time()),
+      ]
+    return '\n'.join(lines) + '\n'
+
+  def write_textfile(self):
+    """
+    Replaces the *textfile* with the current counters. The file is renamed
+    into place so that a collector never reads a partial snapshot.
+    """
+
+    if not self.textfile:
+      return
+    with open(self.textfile + '.tmp', 'w') as fp:
+      fp.write(self.format_textfile())
+    os.replace(self.textfile + '.tmp', self.textfile)
+
+  def close(self):
+    if self._thread:
+      self._stop.set()
+      self._thread.join()
+    self.write_textfile()
+    if self._fp:
+      self._fp.close()
+      self._fp = None
@@ -0,0 +1,288 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Stores many small files in a few large tar archives with an index of the
+position of every member, and reads them back through #mmap.
+"""
+
+import gzip
+import io
+import mmap
+import os
+import shutil
+import sqlite3
+import tarfile
+import threading
+import time
+
+#: The name of the index database in the pack directory.
+INDEX_FILENAME = '.dtools-pack.db'
+
+#: The size of a tar block.
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+def _padded(size):
+  return -(-size // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def _open_index(directory):
+  db = sqlite3.connect(os.path.join(directory, INDEX_FILENAME), check_same_thread=False)
+  db.execute('PRAGMA journal_mode=WAL')
+  db.execute('PRAGMA synchronous=NORMAL')
+  db.execute('''
+    CREATE TABLE IF NOT EXISTS members (
+      name TEXT PRIMARY KEY,
+      archive TEXT NOT NULL,
+      offset INTEGER NOT NULL,
+      size INTEGER NOT NULL,
+      compression TEXT
+    )''')
+  db.commit()
+  return db
+
+
+class PackWriter(object):
+  """
+  Appends files to the tar archives `pack-000000.tar`, `pack-000001.tar`,
+  ... in *directory*. A new archive is started when the current one would
+  exceed *max_size* bytes. If *compress* is enabled, every member is
+  compressed with gzip on its own (and gets a `.gz` suffix in the archive)
+  so that it can still be read without decompressing the whole archive.
+
+  The name, archive and data offset of every member are recorded in an
+  SQLite index that is committed at most every *commit_interval* seconds
+  and when the writer is closed. When an archive is opened again, data
+  after the last indexed member (for example from an interrupted run) is
+  cut off. The archives are valid tar files, the end-of-archive marker is
+  written when the writer is closed.
+
+  All methods are thread-safe.
+  """
+
+  prefix = 'pack-'
+  suffix = '.tar'
+
+  def __init__(self, directory, max_size=1024 ** 3, compress=False, commit_interval=1.0):
+    self.directory = directory
+    self.max_size = max_size
+    self.compress = compress
+    self.commit_interval = commit_interval
+    self._lock = threading.Lock()
+    self._last_commit = time.perf_counter()
+    self._db = _open_index(directory)
+    self._fp = None
+    self._archive = None
+    row = self._db.execute('SELECT archive FROM members ORDER BY archive DESC LIMIT 1').fetchone()
+    self.__open(row[0] if row else self.__archive_name(0))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __archive_name(self, index):
+    return '{}{:06d}{}'.format(self.prefix, index, self.suffix)
+
+  def __open(self, archive):
+    if self._fp:
+      self.__finish()
+    row = self._db.execute('SELECT MAX(offset + size) FROM members WHERE archive = ?',
+      (archive,)).fetchone()
+    end = _padded(row[0]) if row and row[0] is not None else 0
+    path = os.path.join(self.directory, archive)
+    self._fp = open(path, 'r+b' if os.path.isfile(path) else 'w+b')
+    self._fp.truncate(end)
+    self._fp.seek(end)
+    self._archive = archive
+
+  def __finish(self):
+    # Two zero blocks mark the end of the archive. They are overwritten
+    # when the archive is appended to again.
+    self._fp.write(b'\0' * (2 * BLOCK_SIZE))
+    self._fp.truncate()
+    self._fp.close()
+    self._fp = None
+
+  def __contains__(self, name):
+    with self._lock:
+      return self._db.execute('SELECT 1 FROM members WHERE name = ?', (name,)).fetchone() is not None
+
+  def add(self, name, fp, size):
+    """
+    Adds *size* bytes read from the file object *fp* as the member *name*.
+    """
+
+    if self.compress:
+      fp = io.BytesIO(gzip.compress(fp.read(size)))
+      size = len(fp.getvalue())
+    info = tarfile.TarInfo(name + '.gz' if self.compress else name)
+    info.size = size
+    info.mtime = int(time.time())
+    header = info.tobuf(tarfile.PAX_FORMAT)
+
+    with self._lock:
+      position = self._fp.tell()
+      if position and position + len(header) + _padded(size) > self.max_size:
+        index = int(self._archive[len(self.prefix):-len(self.suffix)]) + 1
+        self.__open(self.__archive_name(index))
+        position = 0
+      self._fp.write(header)
+      shutil.copyfileobj(fp, self._fp)
+      self._fp.write(b'\0' * (_padded(size) - size))
+      self._fp.flush()
+      self._db.execute('INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?)',
+        (name, self._archive, position + len(header), size, 'gzip' if self.compress else None))
+      now = time.perf_counter()
+      if now - self._last_commit >= self.commit_interval:
+        self._db.commit()
+        self._last_commit = now
+
+  def add_file(self, name, filename):
+    """
+    Adds the file *filename* as the member *name*.
+    """
+
+    with open(filename, 'rb') as fp:
+      self.add(name, fp, os.fstat(fp.fileno()).st_size)
+
+  def close(self):
+    with self._lock:
+      if self._fp:
+        self.__finish()
+      self._db.commit()
+      self._db.close()
+
+
+class _MemberIO(io.RawIOBase):
+  """
+  A read-only file object for a slice of a #memoryview.
+  """
+
+  def __init__(self, view):
+    self._view = view
+    self._position = 0
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def readinto(self, buffer):
+    chunk = self._view[self._position:self._position + len(buffer)]
+    buffer[:len(chunk)] = chunk
+    self._position += len(chunk)
+    return len(chunk)
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_CUR:
+      offset += self._position
+    elif whence == io.SEEK_END:
+      offset += len(self._view)
+    self._position = max(0, offset)
+    return self._position
+
+  def tell(self):
+    return self._position
+
+
+class PackReader(object):
+  """
+  Reads the members written by a #PackWriter into *directory* without
+  extracting them. Every archive is mapped into memory once with #mmap,
+  thus reading a member does not copy it unless it is compressed.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    self._db = _open_index(directory)
+    self._maps = {}
+    self._lock = threading.Lock()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __contains__(self, name):
+    return self.__entry(name, False) is not None
+
+  def __len__(self):
+    return self._db.execute('SELECT COUNT(*) FROM members').fetchone()[0]
+
+  def __entry(self, name, do_raise=True):
+    row = self._db.execute('SELECT archive, offset, size, compression FROM members WHERE name = ?',
+      (name,)).fetchone()
+    if row is None and do_raise:
+      raise KeyError(name)
+    return row
+
+  def __map(self, archive):
+    with self._lock:
+      if archive not in self._maps:
+        with open(os.path.join(self.directory, archive), 'rb') as fp:
+          self._maps[archive] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+      return self._maps[archive]
+
+  def names(self):
+    """
+    Returns an iterator for the names of all members.
+    """
+
+    return (row[0] for row in self._db.execute('SELECT name FROM members ORDER BY name'))
+
+  def read(self, name):
+    """
+    Returns the content of the member *name* as a #memoryview of the
+    mapped archive, or as #bytes if the member is compressed. Raises a
+    #KeyError if there is no such member.
+    """
+
+    archive, offset, size, compression = self.__entry(name)
+    view = memoryview(self.__map(archive))[offset:offset + size]
+    if compression == 'gzip':
+      return gzip.decompress(view)
+    return view
+
+  def open(self, name):
+    """
+    Returns a binary file object for the member *name*. Compressed members
+    are decompressed while they are read.
+    """
+
+    archive, offset, size, compression = self.__entry(name)
+    fp = io.BufferedReader(_MemberIO(memoryview(self.__map(archive))[offset:offset + size]))
+    if compression == 'gzip':
+      return gzip.GzipFile(fileobj=fp)
+    return fp
+
+  def close(self):
+    # Views returned by read() keep their map open until they are released.
+    for map in self._maps.values():
+      try:
+        map.close()
+      except BufferError:
+        pass
+    self._maps.clear()
+    self._db.close()
@@ -0,0 +1,146 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Planning of batch downloads: prefetching the file sizes with HEAD requests,
+ordering the downloads by size and estimating the space and time that a
+download needs.
+"""
+
+import concurrent.futures
+import datetime
+import requests
+import shutil
+import threading
+import time
+
+import {format_size} from './units'
+
+
+def _largest_first(size):
+  # Files of unknown size might be large, thus they start first.
+  return -size if size is not None else float('-inf')
+
+
+def _smallest_first(size):
+  return size if size is not None else float('inf')
+
+
+#: Maps the names of the scheduling policies to a key function that is
+#: called with the size of a file (or #None if it is unknown). `listed`
+#: keeps the order in which the files were listed.
+SCHEDULES = {
+  'listed': None,
+  'largest-first': _largest_first,
+  'smallest-first': _smallest_first,
+}
+
+
+def fetch_sizes(urls, num_workers=16, timeout=30):
+  """
+  Sends a HEAD request for every URL in *urls* with *num_workers* threads
+  and returns a list with the `Content-Length` of every file, or #None if
+  it could not be determined.
+  """
+
+  local = threading.local()
+
+  def head(url):
+    session = getattr(local, 'session', None)
+    if session is None:
+      session = local.session = requests.Session()
+    try:
+      response = session.head(url, allow_redirects=True, timeout=timeout)
+      response.raise_for_status()
+      return int(response.headers['Content-Length'])
+    except (requests.RequestException, KeyError, ValueError):
+      return None
+
+  with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+    return list(executor.map(head, urls))
+
+
+def schedule(items, sizes, policy='largest-first'):
+  """
+  Returns the *items* ordered by the scheduling *policy*, which is either
+  the name of a policy in #SCHEDULES or a key function for the sizes.
+  *sizes* contains the size of every item in the same order.
+  """
+
+  key = SCHEDULES[policy] if isinstance(policy, str) else policy
+  if key is None:
+    return list(items)
+  pairs = sorted(zip(items, sizes), key=lambda pair: key(pair[1]))
+  return [item for item, size in pairs]
+
+
+def largest(items, sizes):
+  """
+  Returns the item with the largest known size, or the first item if no
+  size is known.
+  """
+
+  return max(zip(items, sizes), key=lambda pair: pair[1] or 0)[0]
+
+
+def measure_throughput(url, num_bytes=8 * 1024 * 1024, timeout=30):
+  """
+  Downloads up to *num_bytes* of *url* and returns the rate at which they
+  were received in bytes per second.
+  """
+
+  tstart = time.perf_counter()
+  headers = {'Range': 'bytes=0-{}'.format(num_bytes - 1)}
+  received = 0
+  with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+    response.raise_for_status()
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+      received += len(chunk)
+      if received >= num_bytes:
+        break
+  return received / max(time.perf_counter() - tstart, 1e-3)
+
+
+def format_plan(sizes, directory, throughput=None, num_workers=1, max_rate=None):
+  """
+  Returns a list of lines that describe a download of files with the
+  specified *sizes* into *directory*. If the *throughput* of a single
+  download is known, the duration of the download with *num_workers*
+  parallel downloads (limited to *max_rate*) is estimated. The estimate
+  is never shorter than the time it takes to download the largest file.
+  """
+
+  known = [size for size in sizes if size is not None]
+  total = sum(known)
+  free = shutil.disk_usage(directory).free
+  lines = []
+  lines.append('Files:               {} ({} of unknown size)'.format(len(sizes), len(sizes) - len(known)))
+  lines.append('Total size:          {}'.format(format_size(total)))
+  lines.append('Largest file:        {}'.format(format_size(max(known, default=0))))
+  lines.append('Required disk space: {} ({} free{})'.format(format_size(total),
+    format_size(free), ', NOT ENOUGH' if total > free else ''))
+  if throughput:
+    rate = throughput * max(1, min(num_workers, len(sizes)))
+    if max_rate:
+      rate = min(rate, max_rate)
+    seconds = max(total / rate, max(known, default=0) / min(throughput, rate))
+    lines.append('Throughput:          {}/s per download, {}/s total'.format(
+      format_size(int(throughput)), format_size(int(rate))))
+    lines.append('Estimated duration:  {}'.format(datetime.timedelta(seconds=int(seconds))))
+  return lines
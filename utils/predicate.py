@@ -0,0 +1,298 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Simple row predicates over named columns, for example
+
+    ra between 10 and 20 and phot_g_mean_mag < 15
+
+A predicate consists of comparisons (`<`, `<=`, `>`, `>=`, `=`, `==`,
+`!=`) of a column with a number, string (in quotes) or `true`/`false`,
+`between` ranges, `is null` and `is not null` tests combined with `and`,
+`or`, `not` and parentheses. Null values never satisfy a comparison.
+
+Predicates are evaluated for batches of rows with #numpy (see #evaluate())
+and can be checked against the minimum and maximum value of a column in a
+block of rows to skip blocks that contain no matches (see #may_match()).
+"""
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+import collections
+import operator
+import re
+
+Compare = collections.namedtuple('Compare', 'column op value')
+Between = collections.namedtuple('Between', 'column low high')
+IsNull = collections.namedtuple('IsNull', 'column')
+Not = collections.namedtuple('Not', 'item')
+And = collections.namedtuple('And', 'items')
+Or = collections.namedtuple('Or', 'items')
+
+OPERATORS = {
+  '<': operator.lt,
+  '<=': operator.le,
+  '>': operator.gt,
+  '>=': operator.ge,
+  '=': operator.eq,
+  '==': operator.eq,
+  '!=': operator.ne,
+  '<>': operator.ne,
+}
+
+KEYWORDS = ('and', 'or', 'not', 'between', 'is', 'null', 'true', 'false')
+
+_token_regex = re.compile(r'''\s*(?:
+  (?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)|
+  (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|
+  (?P<op><=|>=|==|!=|<>|<|>|=|\(|\))|
+  (?P<name>[A-Za-z_][A-Za-z0-9_.]*))''', re.X)
+
+
+class PredicateError(ValueError):
+  pass
+
+
+def tokenize(text):
+  """
+  Returns a list of `(kind, value)` tuples for the tokens in *text*. The
+  kind is `number`, `string`, `op`, `keyword` or `name`.
+  """
+
+  tokens = []
+  pos = 0
+  text = text.rstrip()
+  while pos < len(text):
+    match = _token_regex.match(text, pos)
+    if not match:
+      raise PredicateError('unexpected character at {}: {!r}'.format(pos, text[pos:pos + 10]))
+    pos = match.end()
+    kind = match.lastgroup
+    value = match.group(kind)
+    if kind == 'number':
+      value = float(value) if any(c in value for c in '.eE') else int(value)
+    elif kind == 'string':
+      value = re.sub(r'\\(.)', r'\1', value[1:-1])
+    elif kind == 'name' and value.lower() in KEYWORDS:
+      kind, value = 'keyword', value.lower()
+    tokens.append((kind, value))
+  return tokens
+
+
+class _Parser(object):
+
+  def __init__(self, tokens):
+    self.tokens = tokens
+    self.pos = 0
+
+  def peek(self):
+    if self.pos < len(self.tokens):
+      return self.tokens[self.pos]
+    return (None, None)
+
+  def accept(self, kind, value=None):
+    token = self.peek()
+    if token[0] == kind and (value is None or token[1] == value):
+      self.pos += 1
+      return token
+    return None
+
+  def expect(self, kind, value=None):
+    token = self.accept(kind, value)
+    if not token:
+      found = self.peek()[1]
+      raise PredicateError('expected {}, found {}'.format(
+        value or kind, 'end of input' if found is None else repr(found)))
+    return token[1]
+
+  def parse_or(self):
+    items = [self.parse_and()]
+    while self.accept('keyword', 'or'):
+      items.append(self.parse_and())
+    return items[0] if len(items) == 1 else Or(items)
+
+  def parse_and(self):
+    items = [self.parse_not()]
+    while self.accept('keyword', 'and'):
+      items.append(self.parse_not())
+    return items[0] if len(items) == 1 else And(items)
+
+  def parse_not(self):
+    if self.accept('keyword', 'not'):
+      return Not(self.parse_not())
+    if self.accept('op', '('):
+      node = self.parse_or()
+      self.expect('op', ')')
+      return node
+    return self.parse_test()
+
+  def parse_value(self):
+    token = self.accept('number') or self.accept('string')
+    if token:
+      return token[1]
+    if self.accept('keyword', 'true'):
+      return True
+    if self.accept('keyword', 'false'):
+      return False
+    found = self.peek()[1]
+    raise PredicateError('expected a value, found {}'.format(
+      'end of input' if found is None else repr(found)))
+
+  def parse_test(self):
+    column = self.expect('name')
+    if self.accept('keyword', 'between'):
+      low = self.parse_value()
+      self.expect('keyword', 'and')
+      return Between(column, low, self.parse_value())
+    if self.accept('keyword', 'is'):
+      negate = self.accept('keyword', 'not')
+      self.expect('keyword', 'null')
+      return Not(IsNull(column)) if negate else IsNull(column)
+    op = self.peek()[1]
+    if op not in OPERATORS:
+      raise PredicateError('expected an operator after {!r}'.format(column))
+    self.pos += 1
+    return Compare(column, op, self.parse_value())
+
+
+def parse(text):
+  """
+  Parses the predicate *text*. Raises a #PredicateError if it is invalid.
+  """
+
+  parser = _Parser(tokenize(text))
+  if not parser.tokens:
+    raise PredicateError('empty predicate')
+  node = parser.parse_or()
+  if parser.pos != len(parser.tokens):
+    raise PredicateError('unexpected {!r}'.format(parser.peek()[1]))
+  return node
+
+
+def walk(node):
+  """
+  Yields *node* and all nodes below it.
+  """
+
+  yield node
+  if isinstance(node, (And, Or)):
+    for item in node.items:
+      yield from walk(item)
+  elif isinstance(node, Not):
+    yield from walk(node.item)
+
+
+def column_values(node):
+  """
+  Returns a dictionary that maps the names of the columns used in *node*
+  to the list of values they are compared with.
+  """
+
+  result = collections.OrderedDict()
+  for item in walk(node):
+    if isinstance(item, Compare):
+      result.setdefault(item.column, []).append(item.value)
+    elif isinstance(item, Between):
+      result.setdefault(item.column, []).extend([item.low, item.high])
+    elif isinstance(item, IsNull):
+      result.setdefault(item.column, [])
+  return result
+
+
+def evaluate(node, get_column):
+  """
+  Evaluates *node* for a batch of rows. `get_column(name)` must return the
+  values of the column as a #numpy array and a boolean array of the rows
+  that are null (or #None). Columns are only requested when they are
+  needed, parts of an `and` or `or` are not evaluated if the result is
+  already known for all rows. Returns a boolean array.
+  """
+
+  if isinstance(node, (And, Or)):
+    is_and = isinstance(node, And)
+    mask = evaluate(node.items[0], get_column)
+    for item in node.items[1:]:
+      if (not mask.any()) if is_and else mask.all():
+        break
+      if is_and:
+        mask &= evaluate(item, get_column)
+      else:
+        mask |= evaluate(item, get_column)
+    return mask
+  if isinstance(node, Not):
+    return ~evaluate(node.item, get_column)
+
+  values, nulls = get_column(node.column)
+  if isinstance(node, IsNull):
+    if nulls is None:
+      return numpy.zeros(len(values), bool)
+    return numpy.array(nulls, bool)
+  try:
+    with numpy.errstate(invalid='ignore'):
+      if isinstance(node, Between):
+        mask = (values >= node.low) & (values <= node.high)
+      else:
+        mask = OPERATORS[node.op](values, node.value)
+  except TypeError:
+    raise PredicateError('can not compare column {!r} with {!r}'.format(
+      node.column, node.value))
+  mask = numpy.array(mask, bool, ndmin=1)
+  if mask.shape != (len(values),):
+    raise PredicateError('can not compare column {!r} with {!r}'.format(
+      node.column, node.value))
+  if nulls is not None:
+    mask &= ~nulls
+  return mask
+
+
+def may_match(node, get_stats):
+  """
+  Returns #False if no row of a block can match *node*. `get_stats(name)`
+  returns the minimum and maximum value of the column in the block and
+  the number of values that can be compared (not null or `NaN`), or #None
+  if that is unknown.
+  """
+
+  if isinstance(node, And):
+    return all(may_match(item, get_stats) for item in node.items)
+  if isinstance(node, Or):
+    return any(may_match(item, get_stats) for item in node.items)
+  if not isinstance(node, (Compare, Between)):
+    return True
+  stats = get_stats(node.column)
+  if stats is None:
+    return True
+  low, high, count = stats
+  if count == 0:
+    return False
+  try:
+    if isinstance(node, Between):
+      return high >= node.low and low <= node.high
+    op, value = node.op, node.value
+    if op == '<': return low < value
+    if op == '<=': return low <= value
+    if op == '>': return high > value
+    if op == '>=': return high >= value
+    if op in ('=', '=='): return low <= value <= high
+    return not (low == high == value)
+  except TypeError:
+    return True
@@ -0,0 +1,196 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+A pool of worker processes for CPU bound stages of a pipeline.
+"""
+
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+
+
+def _worker(function, tasks, results, ignore_sigint):
+  if ignore_sigint:
+    # The parent process handles keyboard interrupts and terminates us.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+  for item in iter(tasks.get, None):
+    try:
+      results.put((item, function(item), None))
+    except Exception as exc:
+      # Exceptions are not necessarily picklable.
+      results.put((item, None, '{}: {}'.format(type(exc).__name__, exc)))
+  results.put(None)
+
+
+class ProcessPool(object):
+  """
+  A pool of *num_workers* processes that call *function* for every item
+  passed to #put(). At most *queue_size* items wait for a free worker,
+  after which #put() blocks until a worker is available.
+
+  Unlike #multiprocessing.Pool, the *function* is never pickled (which is
+  not possible for functions defined in Node.py modules). The workers are
+  forked when the pool is created instead, thus the pool should be created
+  before any other threads are started. Only the items and results must be
+  picklable. On platforms that do not support forking, threads are used
+  instead.
+
+  The *callback* is called from a background thread of the parent process
+  with `(item, result, error)` for every processed item, where *error* is
+  a string describing the exception raised by *function* or #None.
+  """
+
+  def __init__(self, function, num_workers=None, queue_size=None, callback=None):
+    num_workers = num_workers or os.cpu_count() or 1
+    try:
+      context = multiprocessing.get_context('fork')
+    except ValueError:
+      context = None
+    if context:
+      Queue, Worker = context.Queue, context.Process
+    else:
+      Queue, Worker = queue.Queue, threading.Thread
+    self.callback = callback
+    self._tasks = Queue(queue_size or num_workers)
+    self._results = Queue()
+    self._workers = [
+      Worker(target=_worker, args=(function, self._tasks, self._results, bool(context)))
+      for __ in range(num_workers)]
+    for worker in self._workers:
+      worker.daemon = True
+      worker.start()
+    self._collector = threading.Thread(target=self.__collect)
+    self._collector.daemon = True
+    self._collector.start()
+
+  def __collect(self):
+    remaining = len(self._workers)
+    while remaining:
+      result = self._results.get()
+      if result is None:
+        remaining -= 1
+      elif self.callback:
+        self.callback(*result)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, exc_tb):
+    if exc_value is None:
+      self.close()
+    else:
+      self.terminate()
+
+  def put(self, item):
+    """
+    Queue *item* to be processed by one of the workers. Blocks while the
+    queue is full.
+    """
+
+    self._tasks.put(item)
+
+  def close(self):
+    """
+    Wait until all queued items are processed and shut down the workers.
+    """
+
+    for __ in self._workers:
+      self._tasks.put(None)
+    for worker in self._workers:
+      worker.join()
+    self._collector.join()
+
+  def terminate(self):
+    """
+    Stop the workers immediately. Items that are still queued are dropped.
+    """
+
+    for worker in self._workers:
+      if hasattr(worker, 'terminate'):
+        worker.terminate()
+    try:
+      while True:
+        self._tasks.get_nowait()
+    except queue.Empty:
+      pass
+    for worker in self._workers:
+      if not hasattr(worker, 'terminate'):
+        self._tasks.put(None)
+      worker.join()
+
+
+class WorkerError(Exception):
+  """
+  Raised by #map_ordered() if the function of the pool failed for an item.
+  """
+
+
+class OrderedResults(object):
+  """
+  A #ProcessPool callback that collects the results so that they can be
+  retrieved in the order of the items with #map_ordered(). *describe* is
+  called with the item that failed to build the #WorkerError message, and
+  *error_type* is the exception class that is raised.
+  """
+
+  def __init__(self, describe=repr, error_type=WorkerError):
+    self.describe = describe
+    self.error_type = error_type
+    self.results = {}
+    self.error = None
+    self.cond = threading.Condition()
+
+  def __call__(self, item, result, error):
+    with self.cond:
+      if error and not self.error:
+        self.error = '{}: {}'.format(self.describe(item), error)
+      self.results[item] = result
+      self.cond.notify_all()
+
+  def pop(self, item):
+    """
+    Waits for the result of *item* and returns it. Raises the *error_type*
+    if any item failed.
+    """
+
+    with self.cond:
+      while item not in self.results and not self.error:
+        self.cond.wait()
+      if self.error:
+        raise self.error_type(self.error)
+      return self.results.pop(item)
+
+
+def map_ordered(pool, results, items, max_pending):
+  """
+  Puts the *items* into the *pool* whose callback is the #OrderedResults
+  *results* and yields the results in the order of the *items*. Only
+  *max_pending* results are kept in memory at a time. The *items* must be
+  hashable and unique.
+  """
+
+  submitted = 0
+  for index, item in enumerate(items):
+    while submitted < len(items) and submitted - index < max_pending:
+      pool.put(items[submitted])
+      submitted += 1
+    yield results.pop(item)
@@ -0,0 +1,190 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+A token bucket that limits the combined download rate of all workers.
+"""
+
+import datetime
+import logging
+import os
+import re
+import threading
+import time
+
+import {format_size, parse_size} from './units'
+
+#: Values that disable the rate limit.
+UNLIMITED = ('', '0', 'none', 'unlimited')
+
+
+def parse_rate(value):
+  """
+  Parses a rate like `200M` or `200M/s` into bytes per second. Returns
+  #None if the rate is `0` or `unlimited`.
+  """
+
+  value = value.strip()
+  if value.lower() in UNLIMITED:
+    return None
+  if value.lower().endswith('/s'):
+    value = value[:-2]
+  return parse_size(value) or None
+
+
+def parse_schedule(value):
+  """
+  Parses a schedule like `08:00-18:00=50M,18:00-08:00=unlimited` into a
+  list of `(begin, end, rate)` tuples where *begin* and *end* are minutes
+  since midnight. A range may wrap around midnight.
+  """
+
+  def parse_time(s):
+    match = re.match(r'^(\d{1,2}):(\d{2})$', s.strip())
+    if not match or int(match.group(1)) > 24 or int(match.group(2)) > 59:
+      raise ValueError('invalid time: {!r}'.format(s))
+    return int(match.group(1)) * 60 + int(match.group(2))
+
+  schedule = []
+  for entry in filter(None, (x.strip() for x in value.split(','))):
+    times, sep, rate = entry.partition('=')
+    begin, sep2, end = times.partition('-')
+    if not sep or not sep2:
+      raise ValueError('invalid schedule entry: {!r}'.format(entry))
+    schedule.append((parse_time(begin), parse_time(end), parse_rate(rate)))
+  return schedule
+
+
+class RateLimiter(object):
+  """
+  Limits the rate at which all transfers together receive data to *rate*
+  bytes per second. Every chunk reserves its share of the bandwidth in the
+  order in which the chunks arrive, so no transfer can starve the others.
+  Instead of counting tokens, the limiter remembers the point in time at
+  which the bandwidth is paid off, which stays exact at high rates even if
+  the caller only sleeps for longer intervals.
+
+  The rate can be changed while the downloads are running with #set_rate(),
+  with a *schedule* as returned by #parse_schedule() (outside of the
+  schedule, *rate* is used) or with a *control_file*. If the control file
+  exists, it contains the rate that overrides everything else and it is
+  checked for changes every *check_interval* seconds.
+  """
+
+  #: The number of seconds of data that can be received at once after
+  #: the transfers were idle.
+  burst = 0.1
+
+  #: Callers that would have to wait less than this many seconds continue
+  #: immediately, the delay is added to the next reservation.
+  min_delay = 0.005
+
+  def __init__(self, rate=None, schedule=None, control_file=None, check_interval=1.0,
+               logger=None):
+    self.default_rate = rate
+    self.schedule = schedule or []
+    self.control_file = control_file
+    self.check_interval = check_interval
+    self.logger = logger or logging
+    self.rate = None
+    self._lock = threading.Lock()
+    self._paid_until = time.monotonic()
+    self._override = None
+    self._control_mtime = None
+    self._control_rate = None
+    self._next_check = 0
+    self.__update(time.monotonic())
+
+  def set_rate(self, rate):
+    """
+    Overrides the schedule and default rate. Pass #None to remove the
+    override (not to disable the limit, use `0` for that).
+    """
+
+    with self._lock:
+      self._override = rate
+      self.__update(time.monotonic())
+
+  def __read_control_file(self):
+    try:
+      mtime = os.stat(self.control_file).st_mtime
+    except FileNotFoundError:
+      self._control_mtime = None
+      return None
+    if mtime == self._control_mtime:
+      return self._control_rate
+    self._control_mtime = mtime
+    try:
+      with open(self.control_file) as fp:
+        self._control_rate = parse_rate(fp.read()) or 0
+    except (OSError, ValueError) as exc:
+      self.logger.error('Could not read rate from "%s": %s', self.control_file, exc)
+      self._control_rate = None
+    return self._control_rate
+
+  def __scheduled_rate(self):
+    now = datetime.datetime.now()
+    minute = now.hour * 60 + now.minute
+    for begin, end, rate in self.schedule:
+      if begin <= end:
+        if begin <= minute < end:
+          return rate
+      elif minute >= begin or minute < end:
+        return rate
+    return self.default_rate
+
+  def __update(self, now):
+    self._next_check = now + self.check_interval
+    rate = self._override
+    if rate is None and self.control_file:
+      rate = self.__read_control_file()
+    if rate is None:
+      rate = self.__scheduled_rate()
+    rate = rate or None
+    if rate != self.rate:
+      if rate:
+        self.logger.info('Limiting the download rate to %s/s.', format_size(rate))
+      else:
+        self.logger.info('The download rate is no longer limited.')
+      self.rate = rate
+
+  def reserve(self, num_bytes):
+    """
+    Reserves the bandwidth for *num_bytes* and returns the number of
+    seconds that the caller must wait before it continues.
+    """
+
+    with self._lock:
+      now = time.monotonic()
+      if now >= self._next_check:
+        self.__update(now)
+      if not self.rate:
+        return 0
+      self._paid_until = max(self._paid_until, now - self.burst) + num_bytes / self.rate
+      delay = self._paid_until - now
+      return delay if delay >= self.min_delay else 0
+
+  def consume(self, num_bytes):
+    """
+    Like #reserve() but sleeps for the returned number of seconds.
+    """
+
+    delay = self.reserve(num_bytes)
+    if delay:
+      time.sleep(delay)
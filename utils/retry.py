@@ -0,0 +1,159 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Retrying failed downloads with exponential backoff and pausing downloads
+from hosts that are failing.
+"""
+
+import email.utils
+import logging
+import random
+import threading
+import time
+
+
+def parse_retry_after(value):
+  """
+  Parses the value of a `Retry-After` header, which is either a number of
+  seconds or an HTTP date, into a number of seconds. Returns #None if the
+  value can not be parsed.
+  """
+
+  if not value:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  try:
+    date = email.utils.parsedate_to_datetime(value)
+  except (TypeError, ValueError):
+    return None
+  return max(0.0, date.timestamp() - time.time())
+
+
+class RetryPolicy(object):
+  """
+  Describes how often and after which delay a download is attempted again
+  after a transient error. The delay before the *n*-th retry is chosen at
+  random between zero and `backoff * 2 ** n` seconds (capped at
+  *max_backoff*), so that workers that failed at the same time do not
+  retry at the same time. A `Retry-After` sent by the server takes
+  precedence, up to *max_retry_after* seconds.
+  """
+
+  #: HTTP status codes that indicate a temporary problem of the server.
+  #: All other error status codes are considered permanent.
+  transient_status = frozenset([408, 425, 429, 500, 502, 503, 504])
+
+  def __init__(self, retries=5, backoff=1.0, max_backoff=120.0, max_retry_after=3600.0):
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.max_retry_after = max_retry_after
+
+  def is_transient_status(self, status):
+    return status in self.transient_status
+
+  def delay(self, attempt, retry_after=None):
+    """
+    Returns the number of seconds to wait before the retry number *attempt*
+    (starting at zero). *retry_after* is the value of the `Retry-After`
+    header of the failed response, if any.
+    """
+
+    seconds = parse_retry_after(retry_after)
+    if seconds is not None:
+      return min(seconds, self.max_retry_after)
+    return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+  """
+  Pauses all downloads from a host after *threshold* consecutive transient
+  failures. The first request after the pause of *cooldown* seconds probes
+  whether the host is back while the others keep waiting; if it fails too,
+  the pause is doubled (up to *max_cooldown* seconds). A `Retry-After` sent
+  by the host pauses the downloads from that host immediately.
+
+  Call #wait_time() before every request and report its outcome with
+  #success() (any response from the host, even a permanent error) or
+  #failure().
+  """
+
+  def __init__(self, threshold=5, cooldown=30.0, max_cooldown=600.0, logger=None):
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.max_cooldown = max_cooldown
+    self.logger = logger or logging
+    self._lock = threading.Lock()
+    self._failures = {}
+    self._cooldown = {}
+    self._paused_until = {}
+    self._probing = set()
+
+  def wait_time(self, host):
+    """
+    Returns the number of seconds until requests to *host* may be sent
+    again.
+    """
+
+    with self._lock:
+      now = time.monotonic()
+      paused_until = self._paused_until.get(host)
+      if paused_until is None:
+        return 0.0
+      if now < paused_until:
+        return paused_until - now
+      if self._failures.get(host, 0) >= self.threshold:
+        # Let this request probe the host and hold back the others.
+        self._paused_until[host] = now + self.cooldown
+        self._probing.add(host)
+      else:
+        del self._paused_until[host]
+      return 0.0
+
+  def success(self, host):
+    with self._lock:
+      if self._failures.pop(host, 0) >= self.threshold:
+        self.logger.info('Host "%s" is responding again.', host)
+      self._cooldown.pop(host, None)
+      self._paused_until.pop(host, None)
+      self._probing.discard(host)
+
+  def failure(self, host, retry_after=None):
+    with self._lock:
+      now = time.monotonic()
+      failures = self._failures.get(host, 0) + 1
+      self._failures[host] = failures
+      pause = 0
+      # Requests that were already running when the host started failing
+      # do not prolong the pause, only the first failures and the probes.
+      if failures == self.threshold or host in self._probing:
+        self._probing.discard(host)
+        pause = self._cooldown.get(host, self.cooldown)
+        self._cooldown[host] = min(pause * 2, self.max_cooldown)
+      seconds = parse_retry_after(retry_after)
+      if seconds is not None:
+        pause = max(pause, min(seconds, self.max_cooldown))
+      if pause and now + pause > self._paused_until.get(host, 0):
+        self._paused_until[host] = now + pause
+        self.logger.warning('Pausing downloads from "%s" for %.0fs after %d failures.',
+          host, pause, failures)
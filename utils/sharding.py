@@ -0,0 +1,160 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Splitting a download job across multiple machines. Every machine runs the
+same command with a different `--shard i/N` and downloads only the files
+assigned to its shard. The assignment only depends on the URLs (and their
+sizes), so all machines agree on it without talking to each other.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import time
+import urllib.parse
+
+Shard = collections.namedtuple('Shard', 'index count')
+
+#: The strategies to assign files to shards.
+STRATEGIES = ('hash', 'size')
+
+
+def parse_shard(value):
+  """
+  Parses a shard specification `i/N` where *i* is a number from 1 to *N*.
+  """
+
+  index, sep, count = value.partition('/')
+  try:
+    index, count = int(index), int(count)
+  except ValueError:
+    raise ValueError('invalid shard: {!r} (expected i/N)'.format(value))
+  if count < 1 or not 1 <= index <= count:
+    raise ValueError('invalid shard: {!r} (i must be between 1 and N)'.format(value))
+  return Shard(index, count)
+
+
+def hash_bin(url, count):
+  """
+  Returns the shard (from 0 to *count* - 1) of a *url* by the hash of its
+  path, which is the same on every machine and also when the host of the
+  archive changes.
+  """
+
+  key = urllib.parse.urlparse(url).path.encode('utf8')
+  return int(hashlib.sha1(key).hexdigest()[:16], 16) % count
+
+
+def size_bins(urls, sizes, count):
+  """
+  Assigns the *urls* to *count* shards so that the total size of every
+  shard is about the same. The files are placed from the largest to the
+  smallest into the shard with the lowest total so far. Files of unknown
+  size are assigned by #hash_bin(). Returns a list with the shard (from 0
+  to *count* - 1) of every URL.
+  """
+
+  bins = [None] * len(urls)
+  totals = [0] * count
+  order = sorted((i for i in range(len(urls)) if sizes[i] is not None),
+    key=lambda i: (-sizes[i], urls[i]))
+  for i in order:
+    index = min(range(count), key=lambda j: (totals[j], j))
+    bins[i] = index
+    totals[index] += sizes[i]
+  for i, url in enumerate(urls):
+    if bins[i] is None:
+      bins[i] = hash_bin(url, count)
+  return bins
+
+
+def select(urls, shard, strategy='hash', sizes=None):
+  """
+  Returns the subset of *urls* that is assigned to the *shard*. The `size`
+  *strategy* requires the *sizes* of the files.
+  """
+
+  if strategy == 'hash':
+    bins = [hash_bin(url, shard.count) for url in urls]
+  elif strategy == 'size':
+    bins = size_bins(urls, sizes, shard.count)
+  else:
+    raise ValueError('unknown sharding strategy: {!r}'.format(strategy))
+  return [url for url, index in zip(urls, bins) if index == shard.index - 1]
+
+
+class ShardReport(object):
+  """
+  Collects the outcome of every file of a shard and writes it to a JSON
+  file, which looks like this:
+
+  ```json
+  {
+    "shard": "2/8", "strategy": "size", "started": ..., "finished": ...,
+    "summary": {"complete": 10, "skipped": 3, "failed": 1},
+    "failed": ["http://..."],
+    "files": [{"url": "http://...", "file": "...", "status": "complete",
+               "size": 1234, "error": null}, ...]
+  }
+  ```
+
+  The status is one of the statuses of a #DownloadResult or `skipped` for
+  files that were downloaded before. A coordinator can merge the reports of
+  all shards and assign the `failed` and `aborted` files to another run.
+  """
+
+  def __init__(self, filename, shard, strategy):
+    self.filename = filename
+    self.shard = shard
+    self.strategy = strategy
+    self.started = time.time()
+    self.files = []
+
+  def add(self, url, filename, status, size=None, error=None):
+    self.files.append({'url': url, 'file': filename, 'status': status,
+      'size': size, 'error': error})
+
+  def add_download(self, url, filename, future):
+    """
+    Adds the outcome of a download from the *future* returned by the
+    downloader's `submit()` method, after the downloader has finished.
+    """
+
+    if future.cancelled() or not future.done():
+      self.add(url, filename, 'aborted')
+    else:
+      result = future.result()
+      self.add(url, filename, result.status, result.size, result.error)
+
+  def write(self):
+    summary = collections.Counter(entry['status'] for entry in self.files)
+    data = {
+      'shard': '{}/{}'.format(*self.shard),
+      'strategy': self.strategy,
+      'started': self.started,
+      'finished': time.time(),
+      'summary': summary,
+      'failed': [x['url'] for x in self.files if x['status'] in ('failed', 'aborted')],
+      'files': self.files,
+    }
+    with open(self.filename + '.tmp', 'w') as fp:
+      json.dump(data, fp, indent=2)
+    os.replace(self.filename + '.tmp', self.filename)
@@ -0,0 +1,55 @@
+# Copyright (c) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Helpers to parse and format human readable sizes such as `64M` or `1.5G`.
+"""
+
+import re
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value):
+  """
+  Parses a size string like `200M` or `1.5G` into a number of bytes. The
+  suffixes are powers of 1024 and an optional trailing `B` or `iB` is
+  ignored. Raises a #ValueError if *value* can not be parsed.
+  """
+
+  if isinstance(value, int):
+    return value
+  match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$', value, re.I)
+  if not match:
+    raise ValueError('invalid size: {!r}'.format(value))
+  return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+
+def format_size(num_bytes):
+  """
+  Formats a number of bytes as a human readable string.
+  """
+
+  if abs(num_bytes) < 1024:
+    return '{} B'.format(num_bytes)
+  for unit in ('KiB', 'MiB', 'GiB'):
+    num_bytes /= 1024
+    if abs(num_bytes) < 1024:
+      return '{:.1f} {}'.format(num_bytes, unit)
+  return '{:.1f} TiB'.format(num_bytes / 1024)